@@ -0,0 +1,3 @@
+"""
+Benchmarks for qwtd's database and editor hot paths
+"""
@@ -0,0 +1,150 @@
+"""
+Measure the database size and open/save latency of each compression setting
+
+Run with `python -m benchmarks.compression`.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+from qwtd import db_setup
+from qwtd import storage
+
+WORDS: list[str] = (
+    "the of and to in is that for it as with was on be by this are from or at "
+    "note todo meeting idea project fix bug release deploy server client data "
+    "python sqlite prompt toolkit editor markdown search index cache latency"
+).split()
+
+SETTINGS: list[tuple[str, int]] = [
+    ("none", 0),
+    ("zlib", 0),
+    ("zlib", 4096),
+    ("lzma", 4096),
+]
+
+
+def make_note(rng: random.Random, size: int) -> str:
+    """
+    Generate roughly size characters of markdown-like text
+    """
+
+    lines: list[str] = []
+    length = 0
+
+    while length < size:
+        if rng.random() < 0.1:
+            line = "## " + " ".join(rng.choices(WORDS, k=rng.randint(1, 5)))
+        else:
+            line = "- " * rng.randint(0, 1) + " ".join(
+                rng.choices(WORDS, k=rng.randint(3, 15))
+            )
+        lines.append(line)
+        length += len(line) + 1
+
+    return "\n".join(lines)
+
+
+def make_notes(count: int, seed: int) -> list[str]:
+    """
+    Generate notes with a long-tailed size distribution (mostly small notes)
+    """
+
+    rng = random.Random(seed)
+
+    return [
+        make_note(rng, int(min(rng.lognormvariate(7, 1.5), 2_000_000)))
+        for _ in range(count)
+    ]
+
+
+def bench_setting(
+    notes: list[str], codec: str, threshold: int, directory: str
+) -> dict[str, float]:
+    """
+    Save and open every note with one compression setting
+    """
+
+    db_path = os.path.join(directory, f"{codec}-{threshold}.db")
+    connection = sqlite3.connect(db_path)
+    storage.register_functions(connection)
+    db_setup.initialize_latest(connection)
+
+    save_times: list[float] = []
+    for i, content in enumerate(notes):
+        start = time.perf_counter()
+        value, used_codec = storage.encode_content(content, codec, threshold)
+        content_hash = storage.content_hash(content)
+        connection.execute(
+            "INSERT INTO blobs (hash, content, codec, refs) VALUES (?, ?, ?, 0)",
+            (content_hash, value, used_codec),
+        )
+        connection.execute(
+            """
+            INSERT INTO notes (name, content_hash, date_modified, deleted, expires)
+            VALUES (?, ?, ?, 0, ?)
+            """,
+            (f"note {i}", content_hash, datetime.now(), datetime.now()),
+        )
+        connection.commit()
+        save_times.append(time.perf_counter() - start)
+
+    open_times: list[float] = []
+    for i in range(len(notes)):
+        start = time.perf_counter()
+        value, used_codec = connection.execute(
+            """
+            SELECT blobs.content, blobs.codec
+            FROM notes JOIN blobs ON blobs.hash = notes.content_hash
+            WHERE notes.name = ?
+            """,
+            (f"note {i}",),
+        ).fetchone()
+        storage.decode_content(value, used_codec)
+        open_times.append(time.perf_counter() - start)
+
+    connection.execute("VACUUM")
+    connection.close()
+
+    return {
+        "size_mb": os.path.getsize(db_path) / 1e6,
+        "save_ms": statistics.mean(save_times) * 1e3,
+        "save_p99_ms": statistics.quantiles(save_times, n=100)[98] * 1e3,
+        "open_ms": statistics.mean(open_times) * 1e3,
+        "open_p99_ms": statistics.quantiles(open_times, n=100)[98] * 1e3,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--notes", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    notes = make_notes(args.notes, args.seed)
+    total = sum(len(note.encode("utf-8")) for note in notes) / 1e6
+    print(f"{args.notes} notes, {total:.1f} MB of text")
+
+    print(
+        f"{'codec':>6} {'threshold':>9} {'size MB':>8} "
+        f"{'save ms':>8} {'p99':>7} {'open ms':>8} {'p99':>7}"
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        for codec, threshold in SETTINGS:
+            result = bench_setting(notes, codec, threshold, directory)
+            print(
+                f"{codec:>6} {threshold:>9} {result['size_mb']:>8.2f} "
+                f"{result['save_ms']:>8.3f} {result['save_p99_ms']:>7.3f} "
+                f"{result['open_ms']:>8.3f} {result['open_p99_ms']:>7.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Generate synthetic qwtd databases for benchmarking
+
+Run with `python -m benchmarks.generate --notes 100000 notes.db`.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.compression import WORDS
+from qwtd import config
+from qwtd import db_setup
+from qwtd import notes
+from qwtd import storage
+
+FOLDERS: list[str] = (
+    "work personal journal projects meetings reading recipes ideas archive"
+).split()
+
+# Fraction of notes that are deleted, and how many of those have expired
+DELETED_FRACTION: float = 0.05
+EXPIRED_FRACTION: float = 0.5
+
+# Notes are inserted this many at a time
+BATCH_SIZE: int = 5000
+
+# Number of distinct lines that note content is built from. Generating every
+# line from scratch would make generating a million notes very slow.
+LINE_POOL_SIZE: int = 20_000
+
+
+def make_line_pool(rng: random.Random) -> list[str]:
+    """
+    Generate markdown-like lines (headings, list items and prose)
+    """
+
+    pool: list[str] = []
+
+    for _ in range(LINE_POOL_SIZE):
+        roll = rng.random()
+        if roll < 0.08:
+            line = "#" * rng.randint(1, 3) + " " + " ".join(rng.choices(WORDS, k=3))
+        elif roll < 0.4:
+            line = "- " + " ".join(rng.choices(WORDS, k=rng.randint(2, 10)))
+        else:
+            line = " ".join(rng.choices(WORDS, k=rng.randint(5, 20)))
+        pool.append(line)
+
+    return pool
+
+
+def make_name(rng: random.Random, index: int) -> str:
+    """
+    Generate a note name: sometimes in a folder, sometimes dated
+    """
+
+    words = " ".join(rng.choices(WORDS, k=rng.randint(1, 4)))
+    roll = rng.random()
+
+    if roll < 0.3:
+        name = f"{rng.choice(FOLDERS)}/{words}"
+    elif roll < 0.45:
+        day = datetime(2020, 1, 1) + timedelta(days=rng.randrange(2000))
+        name = f"{day:%Y-%m-%d} {words}"
+    else:
+        name = words
+
+    # Names are unique, like in a real database
+    return f"{name} {index}"
+
+
+def make_content(rng: random.Random, pool: list[str], name: str) -> str:
+    """
+    Generate note content with a long-tailed size distribution: most notes are
+    a few hundred bytes, a few are hundreds of kilobytes
+    """
+
+    size = min(rng.lognormvariate(6.5, 1.3), 500_000)
+    lines = [notes.new_note_content(name).rstrip("\n")]
+    length = 0
+
+    while length < size:
+        line = rng.choice(pool)
+        lines.append(line)
+        length += len(line) + 1
+
+    return "\n".join(lines)
+
+
+def make_row(
+    name: str, content: str, modified: datetime
+) -> tuple[dict[str, object], tuple[str, str | bytes, str | None]]:
+    """
+    Build the parameters of notes.UPSERT_NOTE for a note, and the row of blobs
+    holding its content, compressed with the default settings (rather than the
+    user's config)
+    """
+
+    defaults = config.Config()
+    value, codec = storage.encode_content(
+        content, defaults.compression, defaults.compress_threshold
+    )
+    content_hash = storage.content_hash(content)
+
+    note = {
+        "name": name,
+        "codec": None,
+        "content_hash": content_hash,
+        "date_modified": modified,
+        "version": None,
+    }
+
+    return note, (content_hash, value, codec)
+
+
+def generate_db(path: str, count: int, seed: int = 0) -> None:
+    """
+    Create a qwtd database at path with count synthetic notes
+
+    About DELETED_FRACTION of the notes are deleted, and EXPIRED_FRACTION of
+    those have expired. Notes are compressed the same way qwtd would store them,
+    but have no revision history.
+    """
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    rng = random.Random(seed)
+    pool = make_line_pool(rng)
+    now = datetime.now()
+
+    connection = sqlite3.connect(path)
+    storage.register_functions(connection)
+    connection.execute("PRAGMA journal_mode=WAL")
+    db_setup.initialize_latest(connection)
+
+    for start in range(0, count, BATCH_SIZE):
+        rows = []
+        blob_rows = []
+        deleted_rows = []
+
+        for index in range(start, min(count, start + BATCH_SIZE)):
+            name = make_name(rng, index)
+            modified = now - timedelta(seconds=rng.randrange(3 * 365 * 86400))
+            note, blob = make_row(name, make_content(rng, pool, name), modified)
+            rows.append(note)
+            blob_rows.append(blob)
+
+            if rng.random() < DELETED_FRACTION:
+                expired = rng.random() < EXPIRED_FRACTION
+                expires = now + timedelta(days=-1 if expired else 7)
+                deleted_rows.append((expires, name))
+
+        # Blobs have to exist before the notes that refer to them
+        connection.executemany(
+            """
+            INSERT INTO blobs (hash, content, codec, refs) VALUES (?, ?, ?, 0)
+            ON CONFLICT(hash) DO NOTHING
+            """,
+            blob_rows,
+        )
+        connection.executemany(notes.UPSERT_NOTE, rows)
+        connection.executemany(
+            "UPDATE notes SET deleted = 1, expires = ? WHERE name = ?", deleted_rows
+        )
+        connection.commit()
+
+    connection.close()
+
+
+def generate_v0_db(path: str, count: int, seed: int = 0) -> None:
+    """
+    Create a database in the original (version 0) format, to time migrating it
+    """
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    rng = random.Random(seed)
+    pool = make_line_pool(rng)
+    now = datetime.now()
+
+    connection = sqlite3.connect(path)
+    connection.execute(
+        """
+        CREATE TABLE notes(name TEXT PRIMARY KEY, content TEXT, date_modified TIMESTAMP)
+        """
+    )
+    connection.execute("CREATE TABLE last_deleted(name TEXT)")
+    connection.execute("INSERT INTO last_deleted VALUES ('Deleted')")
+
+    for start in range(0, count, BATCH_SIZE):
+        rows = []
+        for index in range(start, min(count, start + BATCH_SIZE)):
+            name = make_name(rng, index)
+            rows.append((name, make_content(rng, pool, name), now))
+
+        connection.executemany("INSERT INTO notes VALUES (?, ?, ?)", rows)
+        connection.commit()
+
+    connection.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", help="where to write the database")
+    parser.add_argument("--notes", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--v0", action="store_true", help="use the version 0 format (unmigrated)"
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.v0:
+        generate_v0_db(args.path, args.notes, args.seed)
+    else:
+        generate_db(args.path, args.notes, args.seed)
+
+    size = os.path.getsize(args.path) / 1e6
+    print(
+        f"Generated {args.notes} notes ({size:.1f} MB) in "
+        f"{time.perf_counter() - start:.1f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
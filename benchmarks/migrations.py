@@ -0,0 +1,166 @@
+"""
+Time migrating large version 0 databases to the latest version, including
+resuming a migration that was killed partway through
+
+Run with `python -m benchmarks.migrations --notes 1000000 2000000`.
+"""
+
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from benchmarks.generate import generate_v0_db
+from benchmarks.suite import use_database
+from qwtd import db_setup
+from qwtd import db_wrapper
+
+
+def fresh_copy(source: str, path: str) -> None:
+    """
+    Replace the database at path with a copy of source
+    """
+
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    shutil.copyfile(source, path)
+
+
+def migrate_all(path: str) -> dict[str, float]:
+    """
+    Migrate a database step by step, timing each step in milliseconds
+    """
+
+    results: dict[str, float] = {}
+
+    connection = db_wrapper.connect(path)
+    version: int = connection.execute("PRAGMA user_version").fetchone()[0]
+
+    while version < db_setup.LATEST_DB_VERSION:
+        start = time.perf_counter()
+        new_version = db_setup.migrate_db(version, connection)
+        results[f"migrate_v{version}_to_v{new_version}_ms"] = (
+            time.perf_counter() - start
+        ) * 1e3
+        version = new_version
+
+    connection.close()
+
+    return results
+
+
+def migrate_in_child(path: str, home: str) -> None:
+    """
+    Migrate a database (in a child process, which is killed partway through)
+    """
+
+    use_database(home, path)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        migrate_all(path)
+
+
+def bench_interrupted(path: str, home: str, after: float) -> dict[str, float]:
+    """
+    Kill a migration after some seconds, then time resuming it
+    """
+
+    child = multiprocessing.Process(target=migrate_in_child, args=(path, home))
+    child.start()
+    child.join(after)
+    if child.is_alive():
+        child.kill()
+        child.join()
+
+    connection = sqlite3.connect(path)
+    killed_at: int = connection.execute("PRAGMA user_version").fetchone()[0]
+    connection.close()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        migrate_all(path)
+    resume_ms = (time.perf_counter() - start) * 1e3
+
+    connection = sqlite3.connect(path)
+    version: int = connection.execute("PRAGMA user_version").fetchone()[0]
+    leftover = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'qwtd_migration'"
+    ).fetchone()
+    connection.close()
+
+    if version != db_setup.LATEST_DB_VERSION or leftover is not None:
+        raise RuntimeError("Resuming the interrupted migration didn't finish it")
+
+    return {"killed_at_version": killed_at, "resume_ms": resume_ms}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--notes", type=int, nargs="+", default=[1000000], help="database sizes"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=db_setup.MIGRATION_BATCH_SIZE,
+        help="rows rewritten per transaction",
+    )
+    parser.add_argument(
+        "--interrupt-after",
+        type=float,
+        default=5.0,
+        help="seconds to let a migration run before killing it (0 to skip)",
+    )
+    args = parser.parse_args()
+
+    db_setup.MIGRATION_BATCH_SIZE = args.batch_size
+
+    with tempfile.TemporaryDirectory() as directory:
+        home = os.path.join(directory, "home")
+        original_home = os.environ.get("HOME")
+
+        try:
+            for count in args.notes:
+                v0_path = os.path.join(directory, f"notes-{count}-v0.db")
+                path = os.path.join(directory, "work.db")
+
+                print(f"[{count} notes] Generating database...", file=sys.stderr)
+                generate_v0_db(v0_path, count, args.seed)
+
+                fresh_copy(v0_path, path)
+                use_database(home, path)
+
+                print(f"[{count} notes] Migrating...", file=sys.stderr)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results = migrate_all(path)
+
+                total = sum(results.values())
+                for metric, value in results.items():
+                    print(f"{count:>9} {metric:<28} {value:>12.1f}")
+                print(f"{count:>9} {'migrate_all_ms':<28} {total:>12.1f}")
+                print(f"{count:>9} {'notes_per_s':<28} {count / total * 1e3:>12.0f}")
+
+                if args.interrupt_after > 0:
+                    fresh_copy(v0_path, path)
+
+                    print(f"[{count} notes] Interrupting...", file=sys.stderr)
+                    interrupted = bench_interrupted(path, home, args.interrupt_after)
+                    for metric, value in interrupted.items():
+                        print(f"{count:>9} {metric:<28} {value:>12.1f}")
+
+                os.remove(v0_path)
+        finally:
+            if original_home is not None:
+                os.environ["HOME"] = original_home
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+"""
+Time qwtd's hot paths against synthetic databases, and compare runs
+
+Run with `python -m benchmarks.suite run --sizes 1000 10000 -o results.json`, and
+check for regressions with `python -m benchmarks.suite compare baseline.json
+results.json` (which exits with status 1 if any are found).
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from datetime import datetime
+
+from benchmarks.generate import generate_db, generate_v0_db
+from qwtd import config
+from qwtd import db_setup
+from qwtd import db_wrapper
+from qwtd import export
+from qwtd import purge
+from qwtd import storage
+
+# Number of times to repeat cheap operations (the median is reported)
+REPEAT: int = 50
+
+# Changes smaller than this many milliseconds are never reported as regressions,
+# since they are mostly noise
+MIN_DELTA_MS: float = 0.05
+
+
+def percentile(samples: list[float], percent: int) -> float:
+    """
+    Get a percentile of a list of samples
+    """
+
+    if len(samples) < 2:
+        return samples[0]
+
+    return statistics.quantiles(samples, n=100, method="inclusive")[percent - 1]
+
+
+def time_ms(func: Callable[[], object]) -> float:
+    """
+    Time one call of a function, in milliseconds
+    """
+
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) * 1e3
+
+
+def use_database(home: str, db_path: str) -> None:
+    """
+    Point qwtd's config at a database, using a separate home directory so the
+    user's own config is never read or written
+    """
+
+    os.makedirs(os.path.join(home, ".config"), exist_ok=True)
+    os.environ["HOME"] = home
+
+    with open(config.get_toml_path(), "w", encoding="utf-8") as file:
+        file.write(f'db = "{db_path}"\n')
+
+    config.get_config.cache_clear()
+
+
+def bench_migrations(v0_path: str) -> dict[str, float]:
+    """
+    Time migrating a version 0 database to the latest version, step by step
+    """
+
+    results: dict[str, float] = {}
+
+    connection = sqlite3.connect(v0_path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    storage.register_functions(connection)
+
+    version = 0
+    total = 0.0
+    while version < db_setup.LATEST_DB_VERSION:
+        start = time.perf_counter()
+        new_version = db_setup.migrate_db(version, connection)
+        elapsed = (time.perf_counter() - start) * 1e3
+
+        results[f"migrate_v{version}_to_v{new_version}_ms"] = elapsed
+        total += elapsed
+        version = new_version
+
+    connection.close()
+
+    results["migrate_all_ms"] = total
+    return results
+
+
+def bench_editor(seed: int) -> dict[str, float]:
+    """
+    Time the editor's note list, opening and saving notes, and name completion
+    """
+
+    # The UI is only imported here, like in qwtd itself
+    from prompt_toolkit.application import DummyApplication
+    from prompt_toolkit.application.current import set_app
+    from prompt_toolkit.buffer import Buffer
+    from prompt_toolkit.completion import CompleteEvent
+    from prompt_toolkit.document import Document
+    from prompt_toolkit.widgets import TextArea
+
+    from qwtd.editor import Editor
+    from qwtd.name_completer import NoteNameCompleter
+
+    rng = random.Random(seed)
+    results: dict[str, float] = {}
+
+    # The editor's database work is awaited, so each call gets an event loop
+    loop = asyncio.new_event_loop()
+
+    # Outside of an app, get_app() builds a new DummyApplication (with every
+    # key binding) on each call, which would swamp what is being timed
+    app = DummyApplication()
+
+    def call(method: Callable[[], object]) -> Callable[[], object]:
+        def run() -> object:
+            with set_app(app):
+                return loop.run_until_complete(method())  # type: ignore[arg-type]
+
+        return run
+
+    connection = db_wrapper.open_db()
+
+    note_name_completer = NoteNameCompleter()
+    editor = Editor(
+        connection,
+        TextArea(),
+        Buffer(),
+        note_name_completer,
+        Buffer(),
+    )
+
+    results["update_name_completer_cold_ms"] = time_ms(
+        call(editor.update_name_completer)
+    )
+
+    names = list(editor.catalog.entries)
+    sample = rng.sample(names, min(REPEAT, len(names)))
+
+    warm: list[float] = []
+    for name in sample:
+        editor.catalog.mark_changed(name)
+        warm.append(time_ms(call(editor.update_name_completer)))
+    results["update_name_completer_warm_ms"] = statistics.median(warm)
+
+    opens = [time_ms(call(lambda: editor.open_note(name))) for name in sample]
+    results["open_note_ms"] = statistics.median(opens)
+    results["open_note_p99_ms"] = percentile(opens, 99)
+
+    # Opening them again hits the content cache
+    opens = [time_ms(call(lambda: editor.open_note(name))) for name in sample]
+    results["open_note_cached_ms"] = statistics.median(opens)
+
+    writes: list[float] = []
+    for name in sample:
+        call(lambda: editor.open_note(name))()
+        editor.text_area.text += "\n- one more line"
+        writes.append(time_ms(call(editor.write)))
+    results["write_ms"] = statistics.median(writes)
+    results["write_p99_ms"] = percentile(writes, 99)
+
+    # Type the start of a few note names, one keystroke at a time
+    completer = note_name_completer
+    keystrokes: list[float] = []
+    for name in sample[:10]:
+        for length in range(1, min(len(name), 12) + 1):
+            document = Document(name[:length])
+            keystrokes.append(
+                time_ms(
+                    lambda: list(
+                        completer.get_completions(
+                            document, CompleteEvent(text_inserted=True)
+                        )
+                    )
+                )
+            )
+    results["completion_keystroke_ms"] = statistics.median(keystrokes)
+    results["completion_keystroke_p99_ms"] = percentile(keystrokes, 99)
+
+    editor.worker.close()
+    loop.close()
+    connection.close()
+
+    return results
+
+
+def bench_size(count: int, seed: int, directory: str) -> dict[str, float]:
+    """
+    Run every benchmark against a database of count notes
+    """
+
+    results: dict[str, float] = {}
+
+    db_path = os.path.join(directory, f"notes-{count}.db")
+    v0_path = os.path.join(directory, f"notes-{count}-v0.db")
+    work_path = os.path.join(directory, "work.db")
+
+    print(f"[{count} notes] Generating databases...", file=sys.stderr)
+    generate_db(db_path, count, seed)
+    generate_v0_db(v0_path, count, seed)
+
+    def fresh_copy() -> str:
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(work_path + suffix):
+                os.remove(work_path + suffix)
+        shutil.copyfile(db_path, work_path)
+        return work_path
+
+    use_database(os.path.join(directory, "home"), work_path)
+
+    print(f"[{count} notes] Running benchmarks...", file=sys.stderr)
+
+    # qwtd reports what it's doing on stdout, which would drown out the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        results.update(bench_migrations(v0_path))
+
+        fresh_copy()
+        opens: list[float] = []
+        for _ in range(5):
+            start = time.perf_counter()
+            connection = db_wrapper.open_db()
+            opens.append((time.perf_counter() - start) * 1e3)
+            connection.close()
+        results["open_db_ms"] = statistics.median(opens)
+
+        connection = db_wrapper.open_db()
+        results["purge_ms"] = time_ms(lambda: purge.purge_expired(connection))
+        connection.close()
+
+        fresh_copy()
+        results.update(bench_editor(seed))
+
+        fresh_copy()
+        connection = db_wrapper.open_db()
+        export_dir = os.path.join(directory, "export")
+        results["export_all_ms"] = time_ms(
+            lambda: export.export_all(connection, export_dir)
+        )
+        connection.close()
+        shutil.rmtree(export_dir)
+
+    return results
+
+
+def run(args: argparse.Namespace) -> int:
+    """
+    Run the benchmarks and write the results as JSON
+    """
+
+    report: dict[str, object] = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "seed": args.seed,
+        },
+        "results": {},
+    }
+
+    results: dict[str, dict[str, float]] = {}
+    report["results"] = results
+
+    with tempfile.TemporaryDirectory() as directory:
+        home = os.environ.get("HOME")
+        try:
+            for count in args.sizes:
+                results[str(count)] = bench_size(count, args.seed, directory)
+        finally:
+            if home is not None:
+                os.environ["HOME"] = home
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    print(text)
+
+    return 0
+
+
+def compare(args: argparse.Namespace) -> int:
+    """
+    Compare two sets of results, flagging metrics that got slower by more than
+    the tolerance
+    """
+
+    with open(args.baseline, encoding="utf-8") as file:
+        baseline: dict[str, dict[str, float]] = json.load(file)["results"]
+    with open(args.current, encoding="utf-8") as file:
+        current: dict[str, dict[str, float]] = json.load(file)["results"]
+
+    regressions = 0
+
+    print(f"{'notes':>8} {'metric':<36} {'baseline':>10} {'current':>10} {'change':>8}")
+
+    for size in sorted(set(baseline) & set(current), key=int):
+        for metric in sorted(set(baseline[size]) & set(current[size])):
+            old, new = baseline[size][metric], current[size][metric]
+            change = (new - old) / old if old else 0.0
+
+            flag = ""
+            if change > args.tolerance and new - old > MIN_DELTA_MS:
+                flag = "  REGRESSION"
+                regressions += 1
+
+            print(
+                f"{size:>8} {metric:<36} {old:>10.3f} {new:>10.3f} "
+                f"{change:>+8.1%}{flag}"
+            )
+
+    print(f"{regressions} regression(s) beyond {args.tolerance:.0%}")
+
+    return 1 if regressions else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000],
+        help="numbers of notes to benchmark with (up to 1000000)",
+    )
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("-o", "--output", help="write the results to a file")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser(
+        "compare", help="compare results against a baseline"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="fraction a metric may get slower by before it's flagged",
+    )
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,6 @@
 Make python -m qwtd an alias for running `qwtd`
 """
 
-from .db_wrapper import run_with_db
+from .cli import main
 
-run_with_db()
+main()
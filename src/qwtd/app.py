@@ -3,9 +3,16 @@ Manages the top level of the qwtd app through prompt_toolkit
 """
 
 from sqlite3 import Connection
+from typing import TYPE_CHECKING
+
 from prompt_toolkit import Application
 from prompt_toolkit.buffer import Buffer
-from prompt_toolkit.completion import FuzzyCompleter, PathCompleter, WordCompleter
+from prompt_toolkit.completion import (
+    PathCompleter,
+    Completer,
+    DynamicCompleter,
+    ThreadedCompleter,
+)
 from prompt_toolkit.cursor_shapes import CursorShape
 from prompt_toolkit.enums import EditingMode
 from prompt_toolkit.filters import Condition
@@ -19,37 +26,90 @@ from prompt_toolkit.layout import (
     FloatContainer,
     FormattedTextControl,
     HSplit,
+    VSplit,
     Window,
 )
+from prompt_toolkit.layout.margins import NumberedMargin
 from prompt_toolkit.layout.layout import Layout
-from prompt_toolkit.lexers import PygmentsLexer
-from pygments.lexers.markup import MarkdownLexer
 from prompt_toolkit.styles import Style
 from prompt_toolkit.widgets import Frame, TextArea
 
+from qwtd import config
 from qwtd.editor import Editor
+from qwtd.links_panel import links_panel
+from qwtd.markdown_lexer import MarkdownLexer
+from qwtd.name_completer import NoteNameCompleter, split_tags
+from qwtd.profiler import Profiler
+from qwtd.startup import StartupTrace
 from qwtd.status_bar import status_bar
 from qwtd.titlebar import TitleBar
 
+if TYPE_CHECKING:
+    from qwtd.search import NoteSearchCompleter
+
 
 kb = KeyBindings()
 
 
-def run_app(connection: Connection):
+def run_app(
+    connection: Connection,
+    trace: StartupTrace | None = None,
+    profiler: Profiler | None = None,
+):
     """
     Create and run the TUI App
+
+    :param trace: Startup trace to record building the layout and the first
+        paint in
+    :type trace: StartupTrace
+    :param profiler: Profiler to record rendering, input, the lexer and editor
+        operations in
+    :type profiler: Profiler
     """
 
+    if trace is None:
+        trace = StartupTrace(False)
+    if profiler is None:
+        profiler = Profiler(False)
+
+    finish_layout = trace.start_phase("layout")
+
     text_area = TextArea(
         line_numbers=True,
         scrollbar=True,
-        lexer=PygmentsLexer(MarkdownLexer),
+        lexer=profiler.wrap_lexer(MarkdownLexer()),
     )
 
-    note_name_completer = WordCompleter([], sentence=True)
+    note_name_completer = NoteNameCompleter()
 
     note_name_buff = Buffer(
-        completer=FuzzyCompleter(note_name_completer),
+        completer=note_name_completer,
+        complete_while_typing=True,
+        multiline=False,
+    )
+
+    note_search: "NoteSearchCompleter | None" = None
+    search_completer: Completer | None = None
+
+    def get_search_completer() -> Completer:
+        """
+        Create the search completer (and its connection) the first time it's used
+        """
+
+        nonlocal note_search, search_completer
+
+        if search_completer is None:
+            from qwtd.search import NoteSearchCompleter
+
+            note_search = NoteSearchCompleter(config.get_db_path(), profiler=profiler)
+            search_completer = ThreadedCompleter(note_search)
+
+        return search_completer
+
+    search_buff = Buffer(
+        completer=DynamicCompleter(
+            lambda: get_search_completer() if editor.is_searching else None
+        ),
         complete_while_typing=True,
         multiline=False,
     )
@@ -61,15 +121,29 @@ def run_app(connection: Connection):
     )
 
     editor: Editor = Editor(
-        connection, text_area, note_name_buff, note_name_completer, export_buff
+        connection,
+        text_area,
+        note_name_buff,
+        note_name_completer,
+        export_buff,
+        profiler,
     )
 
-    editor.update_name_completer()
-
     editing_body = HSplit(
         [
             TitleBar(editor),
-            text_area,
+            VSplit(
+                [
+                    ConditionalContainer(
+                        text_area, Condition(lambda: not editor.is_viewing())
+                    ),
+                    ConditionalContainer(
+                        Window(editor.viewer, left_margins=[NumberedMargin()]),
+                        Condition(editor.is_viewing),
+                    ),
+                    links_panel(editor),
+                ]
+            ),
             status_bar(editor),
         ]
     )
@@ -77,27 +151,107 @@ def run_app(connection: Connection):
     note_select_kb = KeyBindings()
 
     @note_select_kb.add("enter")
-    def _(event: KeyPressEvent):
+    async def _(event: KeyPressEvent):
         """
         Exit the note selector and confirm selection when enter is pressed
         """
-        editor.open_note(note_name_buff.text)
+        name = note_name_buff.text
 
-        app.layout.focus(text_area)
+        # A query with #tags in it only filters existing notes, so open the
+        # highlighted one (or the best one) rather than creating a note
+        if split_tags(name)[0]:
+            state = note_name_buff.complete_state
+            if state is None or not state.completions:
+                return
+
+            name = (state.current_completion or state.completions[0]).text
+
+        await editor.open_note(name)
+
+        app.layout.focus(editor.body())
 
         app.invalidate()
 
+    @note_select_kb.add("c-f")
+    def _(event: KeyPressEvent):
+        """
+        Switch to searching note content when c-f is pressed
+        """
+
+        editor.is_searching = True
+
+        event.app.layout.focus(search_buff)
+        search_buff.text = note_name_buff.text
+        search_buff.start_completion(select_first=False)
+
+    search_kb = KeyBindings()
+
+    @search_kb.add("enter")
+    async def _(event: KeyPressEvent):
+        """
+        Open the highlighted search result (or the best one) when enter is pressed
+        """
+
+        state = search_buff.complete_state
+        if state is None or not state.completions:
+            return
+
+        completion = state.current_completion or state.completions[0]
+
+        editor.is_searching = False
+        search_buff.reset()
+
+        await editor.open_note(completion.text)
+
+        app.layout.focus(editor.body())
+
+        app.invalidate()
+
+    @search_kb.add("c-f")
+    def _(event: KeyPressEvent):
+        """
+        Switch back to selecting notes by name when c-f is pressed again
+        """
+
+        editor.is_searching = False
+        search_buff.reset()
+
+        event.app.layout.focus(note_name_buff)
+        note_name_buff.start_completion(select_first=False)
+
     note_selector = ConditionalContainer(
         Frame(
             HSplit(
                 [
-                    Window(FormattedTextControl("Select note:", style="class:info")),
                     Window(
-                        BufferControl(
-                            note_name_buff,
-                            key_bindings=note_select_kb,
+                        FormattedTextControl(
+                            lambda: (
+                                "Search notes (^F: names):"
+                                if editor.is_searching
+                                else "Select note (^F: search):"
+                            ),
+                            style="class:info",
+                        )
+                    ),
+                    ConditionalContainer(
+                        Window(
+                            BufferControl(
+                                note_name_buff,
+                                key_bindings=note_select_kb,
+                            ),
+                            height=1,
+                        ),
+                        Condition(lambda: not editor.is_searching),
+                    ),
+                    ConditionalContainer(
+                        Window(
+                            BufferControl(
+                                search_buff,
+                                key_bindings=search_kb,
+                            ),
+                            height=1,
                         ),
-                        height=1,
+                        Condition(lambda: editor.is_searching),
                     ),
                 ]
             ),
@@ -111,7 +265,16 @@ def run_app(connection: Connection):
         Frame(
             HSplit(
                 [
-                    Window(FormattedTextControl("Export path:", style="class:info")),
+                    Window(
+                        FormattedTextControl(
+                            lambda: (
+                                "Export all to (^E: note):"
+                                if editor.is_exporting_all
+                                else "Export note to (^E: all):"
+                            ),
+                            style="class:info",
+                        )
+                    ),
                     Window(BufferControl(export_buff), height=1),
                 ]
             ),
@@ -145,6 +308,10 @@ def run_app(connection: Connection):
             ("pygments.generic.heading", "bold fg:#ffaa00"),
             ("completion-menu.completion", "bg:#3d59a1 #a9b1d6"),
             ("completion-menu.completion.current", "#394b70 bg:#a9b1d6"),
+            ("completion-menu.meta.completion", "bg:#3d59a1 #a9b1d6"),
+            ("completion-menu.meta.completion.current", "#394b70 bg:#a9b1d6"),
+            ("search-match", "bold underline"),
+            ("tag", "fg:#9ece6a"),
         ]
     )
 
@@ -160,6 +327,12 @@ def run_app(connection: Connection):
 
     editor.add_bindings(kb)
 
+    profiler.attach(app)
+
+    finish_layout()
+    finish_first_paint = trace.start_phase("first paint")
+    app.after_render += lambda _: finish_first_paint()
+
     def pre_run():
         """
         Initialization to run before the app starts
@@ -170,4 +343,30 @@ def run_app(connection: Connection):
 
         note_name_buff.start_completion(select_first=False)
 
-    app.run(pre_run=pre_run)
+        app.create_background_task(load_note_names())
+        app.create_background_task(editor.autosave_loop())
+        app.create_background_task(editor.purge_loop())
+        app.create_background_task(editor.backup_loop())
+        app.create_background_task(editor.sync_loop())
+
+    async def load_note_names():
+        """
+        Load the note names in the background, so the UI shows up right away
+        """
+
+        await editor.update_name_completer()
+
+        if editor.current_note is None:
+            note_name_buff.start_completion(select_first=False)
+
+        await editor.warm_content_cache()
+
+    try:
+        app.run(pre_run=pre_run)
+    finally:
+        # Let any save that is still running finish
+        editor.worker.close()
+        if note_search is not None:
+            note_search.close()
+        # Don't leave this session's changes for the next one to sync
+        editor.flush_sync_log()
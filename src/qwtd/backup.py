@@ -0,0 +1,164 @@
+"""
+Snapshots of the database taken with SQLite's online backup API, so the
+database can be backed up while qwtd (or several of them) keep writing to it
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from qwtd import config
+from qwtd.db_wrapper import connect
+from qwtd.profiler import Profiler
+
+# How many pages to copy per backup step. The source only needs to be read for
+# this long at a time, so the copy never competes with saving for long.
+BACKUP_PAGES: int = 256
+
+# How long to sleep between steps, in seconds, so a backup of a large database
+# is spread out rather than saturating the disk
+BACKUP_STEP_SLEEP: float = 0.005
+
+# Snapshots are named qwtd-<timestamp>.db, which sort oldest first
+SNAPSHOT_PREFIX: str = "qwtd-"
+SNAPSHOT_SUFFIX: str = ".db"
+TIMESTAMP_FORMAT: str = "%Y%m%d-%H%M%S"
+
+
+class BackupCancelled(Exception):
+    """
+    Raised when a backup is stopped before it finished
+    """
+
+
+def get_backup_dir() -> str:
+    """
+    Read the config file and return the directory that snapshots go in
+    """
+
+    return os.path.expanduser(config.get_config().backup_dir)
+
+
+def list_snapshots(directory: str) -> list[str]:
+    """
+    Get the paths of the snapshots in a directory, oldest first
+    """
+
+    try:
+        filenames = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+
+    return [
+        os.path.join(directory, filename)
+        for filename in sorted(filenames)
+        if filename.startswith(SNAPSHOT_PREFIX) and filename.endswith(SNAPSHOT_SUFFIX)
+    ]
+
+
+def last_backup_time(directory: str) -> float | None:
+    """
+    When the newest snapshot in a directory was taken (as a time.time()), or
+    None if there isn't one
+    """
+
+    snapshots = list_snapshots(directory)
+    if not snapshots:
+        return None
+
+    return os.path.getmtime(snapshots[-1])
+
+
+def backup_db(
+    db_path: str,
+    destination: str,
+    stop: threading.Event | None = None,
+    profiler: Profiler | None = None,
+) -> None:
+    """
+    Copy the database at db_path to destination, BACKUP_PAGES at a time
+
+    The copy is made from a read transaction that stays open until the end, so
+    it is a consistent snapshot of the database as it was when the backup
+    started. (Without one, SQLite restarts the backup whenever another
+    connection commits, so a busy database might never finish.) In WAL mode
+    that transaction doesn't block anyone from saving, but the WAL can't be
+    checkpointed past it, so it grows until the backup is done.
+
+    The snapshot is written next to destination and renamed over it once it is
+    complete, so destination is never left half written.
+
+    :param stop: Event that cancels the backup (raising BackupCancelled) when
+        set, checked between steps
+    :type stop: threading.Event
+    :param profiler: Profiler to time the backup's statements with
+    :type profiler: Profiler
+    """
+
+    directory = os.path.dirname(destination) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    temp_path = os.path.join(directory, "." + os.path.basename(destination) + ".tmp")
+    if os.path.exists(temp_path):
+        # Left over from a backup that was killed
+        os.remove(temp_path)
+
+    def progress(status: int, remaining: int, total: int):
+        if stop is not None and stop.is_set():
+            raise BackupCancelled()
+        if remaining:
+            time.sleep(BACKUP_STEP_SLEEP)
+
+    source = connect(db_path, profiler)
+    target = sqlite3.connect(temp_path)
+    try:
+        # Start the read transaction that every step reads from
+        source.execute("BEGIN")
+        source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+
+        source.backup(target, pages=BACKUP_PAGES, progress=progress)
+
+        # A snapshot is a single file, so it can be copied around like one
+        target.execute("PRAGMA journal_mode=DELETE")
+        target.close()
+
+        with open(temp_path, "rb") as file:
+            os.fsync(file.fileno())
+        os.replace(temp_path, destination)
+    except BaseException:
+        target.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        source.rollback()
+        source.close()
+
+
+def take_snapshot(
+    db_path: str,
+    directory: str,
+    keep: int,
+    stop: threading.Event | None = None,
+    profiler: Profiler | None = None,
+) -> str:
+    """
+    Back the database up to a new timestamped snapshot in directory, then
+    delete the oldest snapshots so that only keep of them are left
+
+    :param keep: How many snapshots to keep (0 keeps every snapshot)
+    :return: The path of the new snapshot
+    """
+
+    name = SNAPSHOT_PREFIX + datetime.now().strftime(TIMESTAMP_FORMAT) + SNAPSHOT_SUFFIX
+    path = os.path.join(directory, name)
+
+    backup_db(db_path, path, stop, profiler)
+
+    if keep > 0:
+        for old in list_snapshots(directory)[:-keep]:
+            os.remove(old)
+
+    return path
@@ -0,0 +1,46 @@
+"""
+Content-addressed storage of note content: every distinct note body is stored
+once in the blobs table, keyed by its content hash, however many notes have it
+
+Notes refer to their content by notes.content_hash. Triggers count how many
+notes refer to each blob (see db_setup.create_blobs_table), and blobs that
+nothing refers to any more are deleted by collect_garbage.
+"""
+
+from sqlite3 import Connection
+
+from qwtd import storage
+
+
+def store_blob(connection: Connection, content_hash: str, content: str):
+    """
+    Store content under its hash, unless a blob with that hash already exists
+    (in which case it isn't even encoded)
+
+    The new blob starts with no references: it's counted once a note refers to
+    it. Like notes.save_note, this doesn't commit.
+    """
+
+    exists = connection.execute(
+        "SELECT 1 FROM blobs WHERE hash = ?", (content_hash,)
+    ).fetchone()
+    if exists is not None:
+        return
+
+    connection.execute(
+        "INSERT INTO blobs (hash, content, codec, refs) VALUES (?, ?, ?, 0)",
+        (content_hash, *storage.encode_content(content)),
+    )
+
+
+def collect_garbage(connection: Connection) -> int:
+    """
+    Delete the blobs that no note refers to any more (using the partial
+    blobs_unreferenced index, so this is cheap when there are none)
+
+    This doesn't commit.
+
+    :return: How many blobs were deleted
+    """
+
+    return connection.execute("DELETE FROM blobs WHERE refs = 0").rowcount
@@ -0,0 +1,180 @@
+"""
+In-memory catalog of note metadata, kept in sync with the database incrementally
+"""
+
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from sqlite3 import Connection
+
+
+@dataclass
+class NoteEntry:
+    """
+    Metadata about a single note (everything but its content)
+    """
+
+    name: str
+    date_modified: datetime
+    deleted: bool
+    expires: datetime
+
+
+class NoteCatalog:
+    """
+    Catalog of every note's metadata, ordered by modification date
+
+    The catalog is loaded from the database once. After that, changes made
+    through this connection are applied one row at a time (see mark_changed),
+    and changes committed by other connections (e.g. another qwtd instance) are
+    detected with PRAGMA data_version, which triggers a full reload.
+    """
+
+    def __init__(self, connection: Connection):
+        """
+        Create a new, empty NoteCatalog
+
+        :param connection: Connection to the database
+        :type connection: sqlite3.Connection
+        """
+
+        self.connection: Connection = connection
+
+        # Ordered from least to most recently modified, so that a modified note
+        # can be moved to the end in constant time
+        self.entries: dict[str, NoteEntry] = {}
+
+        self._data_version: int | None = None
+        # Notes can be marked as changed from another thread than the one that
+        # refreshes the catalog
+        self._pending_lock: threading.Lock = threading.Lock()
+        self._pending: set[str] = set()
+        self._names: list[str] | None = None
+
+    def load(self, data_version: int | None = None) -> None:
+        """
+        Load every note's metadata from the database, discarding the old state
+
+        :param data_version: See refresh
+        """
+
+        self._data_version = (
+            data_version if data_version is not None else self._read_data_version()
+        )
+
+        res = self.connection.execute(
+            """
+            SELECT
+                name,
+                date_modified,
+                deleted,
+                expires
+            FROM notes ORDER BY date_modified ASC
+            """
+        )
+
+        self.entries = {
+            name: NoteEntry(name, date_modified, deleted == 1, expires)
+            for name, date_modified, deleted, expires in res
+        }
+
+        with self._pending_lock:
+            self._pending.clear()
+        self._names = None
+
+    def mark_changed(self, name: str) -> None:
+        """
+        Record that a note was changed through this catalog's connection
+
+        The change is applied on the next call to refresh.
+        """
+
+        with self._pending_lock:
+            self._pending.add(name)
+
+    def refresh(self, data_version: int | None = None) -> set[str] | None:
+        """
+        Bring the catalog up to date with the database
+
+        :param data_version: PRAGMA data_version, if changes are made through
+            another connection than the catalog's (and marked with
+            mark_changed). It has to be read on that connection (see
+            read_data_version), since the catalog's own would count those
+            changes as made by someone else.
+        :return: The names of the notes that changed, or None if the whole
+            catalog had to be reloaded
+        """
+
+        if data_version is None:
+            data_version = self._read_data_version()
+
+        if self._data_version is None or data_version != self._data_version:
+            self.load(data_version)
+            return None
+
+        with self._pending_lock:
+            changed = self._pending
+            self._pending = set()
+
+        for name in changed:
+            self._refresh_note(name)
+
+        return changed
+
+    def names(self) -> list[str]:
+        """
+        Get the names of all notes, most recently modified first
+        """
+
+        if self._names is None:
+            self._names = list(reversed(self.entries))
+
+        return self._names
+
+    def _refresh_note(self, name: str) -> None:
+        """
+        Re-read a single note's metadata from the database
+        """
+
+        row = self.connection.execute(
+            """
+            SELECT
+                date_modified,
+                deleted,
+                expires
+            FROM notes WHERE name = ?
+            """,
+            (name,),
+        ).fetchone()
+
+        old = self.entries.get(name)
+
+        if row is None:
+            if old is not None:
+                del self.entries[name]
+                self._names = None
+            return
+
+        date_modified, deleted, expires = row
+        entry = NoteEntry(name, date_modified, deleted == 1, expires)
+
+        if old is not None and old.date_modified == date_modified:
+            # Order is unchanged, so the entry can be replaced in place
+            self.entries[name] = entry
+            return
+
+        # Modified notes are always the newest, so move them to the end
+        self.entries.pop(name, None)
+        self.entries[name] = entry
+        self._names = None
+
+    def _read_data_version(self) -> int:
+        return read_data_version(self.connection)
+
+
+def read_data_version(connection: Connection) -> int:
+    """
+    Read PRAGMA data_version, which changes whenever another connection commits
+    """
+
+    return connection.execute("PRAGMA data_version").fetchone()[0]
@@ -0,0 +1,100 @@
+"""
+Recording of local changes to notes, for replicating them to other devices
+through a sync folder (see sync.py)
+
+Every change made on this device (saving, deleting or restoring a note) is
+added to the sync_outbox table in the same transaction as the change itself,
+until sync.flush_outbox appends it to this device's log. Changes are stamped
+so that every device resolves conflicting changes the same way: for each note,
+the change with the highest (stamp, device) wins.
+"""
+
+import socket
+import time
+from datetime import datetime
+from sqlite3 import Connection
+
+from qwtd import config
+
+# Kinds of change: a note was created or its content changed (which also
+# restores it), it was deleted, or it was restored
+UPSERT: str = "upsert"
+DELETE: str = "delete"
+RESTORE: str = "restore"
+
+
+def is_enabled() -> bool:
+    """
+    Check whether changes are replicated (sync_dir is set in the config)
+    """
+
+    return bool(config.get_config().sync_dir)
+
+
+def device_name() -> str:
+    """
+    Get the name of this device, which names its log in the sync folder
+    """
+
+    return config.get_config().sync_device or socket.gethostname()
+
+
+def now_stamp() -> int:
+    """
+    The current time as a stamp (microseconds since the epoch)
+    """
+
+    return time.time_ns() // 1000
+
+
+def datetime_stamp(value: datetime) -> int:
+    """
+    Convert a (local, naive) datetime to a stamp
+    """
+
+    return int(value.timestamp() * 1_000_000)
+
+
+def record_change(
+    connection: Connection, op: str, name: str, expires: datetime | None = None
+):
+    """
+    Record a change made to a note on this device, if replication is enabled
+
+    The change is stamped with the current time, or just after the note's
+    latest change if that is later (e.g. one received from a device whose clock
+    is ahead), so that it always wins over the changes it was made on top of.
+    Like notes.save_note, this doesn't commit.
+
+    :param expires: When a deleted note expires (for DELETE)
+    """
+
+    if not is_enabled():
+        return
+
+    row = connection.execute(
+        "SELECT stamp FROM sync_notes WHERE name = ?", (name,)
+    ).fetchone()
+    stamp = now_stamp() if row is None else max(now_stamp(), row[0] + 1)
+
+    set_stamp(connection, name, stamp, device_name())
+    connection.execute(
+        "INSERT INTO sync_outbox (op, name, stamp, expires) VALUES (?, ?, ?, ?)",
+        (op, name, stamp, expires),
+    )
+
+
+def set_stamp(connection: Connection, name: str, stamp: int, device: str):
+    """
+    Remember the (stamp, device) of the latest change to a note
+    """
+
+    connection.execute(
+        """
+        INSERT INTO sync_notes (name, stamp, device) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET
+            stamp = excluded.stamp,
+            device = excluded.device
+        """,
+        (name, stamp, device),
+    )
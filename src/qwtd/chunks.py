@@ -0,0 +1,265 @@
+"""
+Storage of very large notes as fixed-size chunks, read and written with
+incremental blob I/O
+"""
+
+import hashlib
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import AbstractContextManager, nullcontext
+from sqlite3 import Connection
+
+from qwtd import config
+
+# Codec marker for notes whose content is stored in note_chunks. The content
+# column of a chunked note is NULL.
+CHUNKED: str = "chunked"
+
+# Target size of each chunk in bytes. Chunks end at a line break where possible,
+# so most are a little smaller than this.
+CHUNK_SIZE: int = 256 * 1024
+
+# How many decoded chunks a ChunkedNote keeps in memory
+CHUNK_CACHE_SIZE: int = 8
+
+
+def should_chunk(content: str) -> bool:
+    """
+    Check whether content is large enough (chunk_threshold) to store in chunks
+    """
+
+    threshold = config.get_config().chunk_threshold
+    if threshold <= 0:
+        return False
+
+    # A character is at most 4 bytes, so most notes can be ruled out without
+    # encoding them
+    return len(content) * 4 >= threshold and len(content.encode("utf-8")) >= threshold
+
+
+def split_chunks(data: bytes, size: int = CHUNK_SIZE) -> list[bytes]:
+    """
+    Split UTF-8 encoded content into chunks of at most size bytes
+
+    Each chunk ends just after the last line break that fits in it, or (if a
+    line is longer than a whole chunk) on a character boundary, so that chunks
+    can be decoded independently and small edits only change nearby chunks.
+    """
+
+    chunks: list[bytes] = []
+    start = 0
+
+    while len(data) - start > size:
+        end = data.rfind(b"\n", start, start + size) + 1
+        if end <= start:
+            end = start + size
+            # Don't split a multi-byte character (continuation bytes are
+            # 0b10xxxxxx)
+            while data[end] & 0xC0 == 0x80:
+                end -= 1
+
+        chunks.append(data[start:end])
+        start = end
+
+    if start < len(data) or not chunks:
+        chunks.append(data[start:])
+
+    return chunks
+
+
+def write_chunks(connection: Connection, note: str, content: str):
+    """
+    Store a note's content as chunks, only rewriting the chunks that changed
+
+    Chunks whose hash hasn't changed are left alone. Changed chunks of the same
+    length are overwritten in place through a blob handle; the rest are resized
+    with zeroblob() first. Like notes.save_note, this doesn't commit.
+    """
+
+    existing: dict[int, tuple[int, str, int]] = {
+        seq: (rowid, chunk_hash, size)
+        for rowid, seq, chunk_hash, size in connection.execute(
+            """
+            SELECT rowid, seq, hash, length(data) FROM note_chunks WHERE note = ?
+            """,
+            (note,),
+        )
+    }
+
+    chunks = split_chunks(content.encode("utf-8"))
+
+    for seq, data in enumerate(chunks):
+        chunk_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+        old = existing.get(seq)
+
+        if old is not None and old[1] == chunk_hash:
+            continue
+
+        if old is None:
+            rowid = connection.execute(
+                """
+                INSERT INTO note_chunks (note, seq, data, hash, newlines)
+                VALUES (?, ?, zeroblob(?), ?, ?)
+                """,
+                (note, seq, len(data), chunk_hash, data.count(b"\n")),
+            ).lastrowid
+        else:
+            rowid = old[0]
+            if old[2] == len(data):
+                connection.execute(
+                    "UPDATE note_chunks SET hash = ?, newlines = ? WHERE rowid = ?",
+                    (chunk_hash, data.count(b"\n"), rowid),
+                )
+            else:
+                connection.execute(
+                    """
+                    UPDATE note_chunks
+                    SET data = zeroblob(?), hash = ?, newlines = ?
+                    WHERE rowid = ?
+                    """,
+                    (len(data), chunk_hash, data.count(b"\n"), rowid),
+                )
+
+        assert rowid is not None
+        with connection.blobopen(
+            "note_chunks", "data", rowid, readonly=False
+        ) as blob:
+            blob.write(data)
+
+    connection.execute(
+        "DELETE FROM note_chunks WHERE note = ? AND seq >= ?", (note, len(chunks))
+    )
+
+
+def delete_chunks(connection: Connection, note: str):
+    """
+    Remove a note's chunks (when it is saved unchunked). Doesn't commit.
+    """
+
+    connection.execute("DELETE FROM note_chunks WHERE note = ?", (note,))
+
+
+def read_chunk(connection: Connection, rowid: int) -> bytes:
+    """
+    Read one chunk through a blob handle
+    """
+
+    with connection.blobopen("note_chunks", "data", rowid, readonly=True) as blob:
+        return blob.read()
+
+
+def read_chunked(connection: Connection, note: str) -> str:
+    """
+    Read the whole content of a chunked note
+    """
+
+    rowids = connection.execute(
+        "SELECT rowid FROM note_chunks WHERE note = ? ORDER BY seq", (note,)
+    ).fetchall()
+
+    return b"".join(read_chunk(connection, rowid) for rowid, in rowids).decode(
+        "utf-8"
+    )
+
+
+class ChunkedNote:
+    """
+    Line-by-line access to a chunked note that only loads the chunks it needs
+
+    Only the number of line breaks in each chunk is read up front; the chunks
+    themselves are read when one of their lines is asked for, and the most
+    recently used ones are kept in memory.
+    """
+
+    def __init__(
+        self,
+        connection: Connection,
+        note: str,
+        lock: AbstractContextManager[object] | None = None,
+    ):
+        """
+        Create a new ChunkedNote
+
+        :param connection: Connection to the database
+        :type connection: sqlite3.Connection
+        :param note: Name of the note
+        :type note: str
+        :param lock: Lock (or any context manager) to hold while using the
+            connection, if it is shared
+        :type lock: AbstractContextManager
+        """
+
+        self.connection: Connection = connection
+        self.note: str = note
+        self.lock: AbstractContextManager[object] = (
+            lock if lock is not None else nullcontext()
+        )
+
+        with self.lock:
+            rows = connection.execute(
+                """
+                SELECT rowid, newlines FROM note_chunks
+                WHERE note = ? ORDER BY seq
+                """,
+                (note,),
+            ).fetchall()
+
+        self.rowids: list[int] = [rowid for rowid, _ in rows]
+
+        # ends[c] is the number of line breaks in chunks 0 through c
+        self.ends: list[int] = []
+        total = 0
+        for _, newlines in rows:
+            total += newlines
+            self.ends.append(total)
+
+        self.line_count: int = total + 1
+
+        self._chunks: OrderedDict[int, list[str]] = OrderedDict()
+
+    def _chunk_lines(self, index: int) -> list[str]:
+        """
+        Get the text of a chunk split at line breaks, reading it if needed
+        """
+
+        lines = self._chunks.get(index)
+
+        if lines is None:
+            with self.lock:
+                data = read_chunk(self.connection, self.rowids[index])
+            lines = data.decode("utf-8").split("\n")
+
+            self._chunks[index] = lines
+            if len(self._chunks) > CHUNK_CACHE_SIZE:
+                self._chunks.popitem(last=False)
+        else:
+            self._chunks.move_to_end(index)
+
+        return lines
+
+    def line(self, lineno: int) -> str:
+        """
+        Get a line of the note (without its line break)
+        """
+
+        if not self.rowids or not 0 <= lineno < self.line_count:
+            return ""
+
+        # Line n starts just after the nth line break, in the first chunk that
+        # has at least n line breaks up to and including itself
+        index = bisect_left(self.ends, lineno) if lineno > 0 else 0
+        start = self.ends[index - 1] if index > 0 else 0
+
+        lines = self._chunk_lines(index)
+        parts = [lines[lineno - start]]
+        is_last = lineno - start == len(lines) - 1
+
+        # The last line of a chunk continues into the next chunk, and on into
+        # the one after that if the next chunk has no line breaks at all
+        while is_last and index + 1 < len(self.rowids):
+            index += 1
+            lines = self._chunk_lines(index)
+            parts.append(lines[0])
+            is_last = len(lines) == 1
+
+        return "".join(parts)
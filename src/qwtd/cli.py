@@ -0,0 +1,664 @@
+"""
+Command line entry point: the TUI by default, or a headless subcommand
+
+Commands that the daemon can handle ask it first (see client.py), and only open
+the database themselves if it isn't running. Everything that's needed to open
+the database is imported by the commands that do, so that asking the daemon
+doesn't pay for importing it.
+"""
+
+import argparse
+import codecs
+import contextlib
+import os
+import sys
+from collections.abc import Callable
+from typing import TYPE_CHECKING, Any
+
+from qwtd import client
+
+if TYPE_CHECKING:
+    import sqlite3
+
+# How much of stdin to read at a time
+STDIN_CHUNK_SIZE: int = 64 * 1024
+
+# Files that `qwtd import` picks up
+IMPORT_EXTENSIONS: tuple[str, ...] = (".md", ".markdown")
+
+
+def read_stdin() -> str:
+    """
+    Read all of stdin as UTF-8, in chunks so that large input streams through
+    """
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    parts: list[str] = []
+
+    while chunk := sys.stdin.buffer.read(STDIN_CHUNK_SIZE):
+        parts.append(decoder.decode(chunk))
+
+    parts.append(decoder.decode(b"", final=True))
+
+    return "".join(parts)
+
+
+def ask_daemon(op: str, **args: Any) -> dict[str, Any] | None:
+    """
+    Send a request to the daemon, if it's running
+
+    :return: The daemon's answer, or None if the command should open the
+        database itself
+    """
+
+    try:
+        return client.request(op, **args)
+    except client.DaemonUnavailable:
+        return None
+
+
+def flush_changes(connection: "sqlite3.Connection"):
+    """
+    Append the changes a command made to this device's sync log, if syncing is
+    enabled (otherwise they wait for the next sync)
+    """
+
+    from qwtd import changelog
+    from qwtd import sync
+
+    if not changelog.is_enabled():
+        return
+
+    try:
+        sync.flush_outbox(connection, sync.get_sync_dir())
+    except OSError as e:
+        print(f"[QWTD] Warning: Couldn't write to the sync log ({e})", file=sys.stderr)
+
+
+def add(args: argparse.Namespace) -> int:
+    """
+    Create a note with the content of stdin
+    """
+
+    content = read_stdin()
+    exists_error = (
+        f"[QWTD] Error: Note {args.name!r} already exists "
+        "(use `qwtd append`, or `qwtd add --replace` to overwrite it)"
+    )
+
+    try:
+        answer = ask_daemon(
+            "save", name=args.name, content=content, create=not args.replace
+        )
+    except client.DaemonError as e:
+        if e.kind != "exists":
+            raise
+        print(exists_error, file=sys.stderr)
+        return 1
+    if answer is not None:
+        return 0
+
+    from qwtd import notes
+    from qwtd.db_wrapper import open_db
+
+    connection = open_db()
+    try:
+        if notes.read_note(connection, args.name) is not None and not args.replace:
+            print(exists_error, file=sys.stderr)
+            return 1
+
+        notes.save_note(connection, args.name, content)
+        connection.commit()
+
+        flush_changes(connection)
+    finally:
+        connection.close()
+
+    return 0
+
+
+def append(args: argparse.Namespace) -> int:
+    """
+    Append the content of stdin to a note, creating it if it doesn't exist
+    """
+
+    text = read_stdin()
+
+    if ask_daemon("append", name=args.name, text=text) is not None:
+        return 0
+
+    from qwtd import notes
+    from qwtd.db_wrapper import open_db
+
+    connection = open_db()
+    try:
+        while True:
+            existing = notes.read_note(connection, args.name)
+            content = existing[0] if existing else notes.new_note_content(args.name)
+            version = existing[3] if existing else 0
+
+            if content and not content.endswith("\n"):
+                content += "\n"
+
+            try:
+                notes.save_note(connection, args.name, content + text, version=version)
+            except notes.ConflictError:
+                # Saved elsewhere in the meantime, so append to that instead
+                connection.rollback()
+                continue
+
+            connection.commit()
+            break
+
+        flush_changes(connection)
+    finally:
+        connection.close()
+
+    return 0
+
+
+def find_markdown_files(directory: str) -> list[tuple[str, str]]:
+    """
+    Find every markdown file under a directory
+
+    :return: (note name, path) pairs, where the name is the file's path
+        relative to the directory, without its extension
+    """
+
+    found: list[tuple[str, str]] = []
+
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            stem, extension = os.path.splitext(filename)
+            if extension.lower() not in IMPORT_EXTENSIONS:
+                continue
+
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(os.path.join(dirpath, stem), directory)
+            found.append((name.replace(os.sep, "/"), path))
+
+    return sorted(found)
+
+
+def import_dir(args: argparse.Namespace) -> int:
+    """
+    Import every markdown file in a directory as a note, in one transaction
+
+    Files whose content hash matches the note already in the database are
+    skipped.
+    """
+
+    if not os.path.isdir(args.directory):
+        print(f"[QWTD] Error: {args.directory} is not a directory", file=sys.stderr)
+        return 1
+
+    from qwtd import notes
+    from qwtd import storage
+    from qwtd.db_wrapper import open_db
+
+    connection = open_db()
+    try:
+        existing: dict[str, str] = dict(
+            connection.execute("SELECT name, content_hash FROM notes")
+        )
+
+        changed: list[tuple[str, str]] = []
+        unchanged = 0
+
+        for name, path in find_markdown_files(args.directory):
+            with open(path, encoding="utf-8") as file:
+                content = file.read()
+
+            if existing.get(name) == storage.content_hash(content):
+                unchanged += 1
+            else:
+                changed.append((name, content))
+
+        notes.save_notes(connection, changed)
+        connection.commit()
+
+        print(f"[QWTD] Imported {len(changed)} notes ({unchanged} unchanged)")
+
+        flush_changes(connection)
+    finally:
+        connection.close()
+
+    return 0
+
+
+def export_notes(args: argparse.Namespace) -> int:
+    """
+    Export one note, or every note, as markdown
+    """
+
+    from qwtd import export
+    from qwtd import notes
+    from qwtd.db_wrapper import open_db
+
+    if args.incremental and (args.note or export.is_archive(args.destination)):
+        print(
+            "[QWTD] Error: --incremental only works with --all and a directory",
+            file=sys.stderr,
+        )
+        return 1
+
+    connection = open_db()
+    try:
+        if args.all:
+            result = export.export_all(
+                connection, args.destination, incremental=args.incremental
+            )
+            print(f"[QWTD] {result.describe()}")
+            return 0
+
+        note = notes.read_note(connection, args.note)
+        if note is None:
+            print(f"[QWTD] Error: Note {args.note!r} doesn't exist", file=sys.stderr)
+            return 1
+
+        export.write_atomic(args.destination, note[0].encode("utf-8"))
+    finally:
+        connection.close()
+
+    return 0
+
+
+def backup_db(args: argparse.Namespace) -> int:
+    """
+    Snapshot the database, to a file or to a new snapshot in backup_dir
+
+    The database can keep being used (e.g. by an open editor) while this runs.
+    """
+
+    import sqlite3
+
+    from qwtd import backup
+    from qwtd import config
+    from qwtd.db_wrapper import open_db
+
+    # Bring the database up to date first, so the snapshot is never of a
+    # half-migrated database
+    open_db().close()
+
+    try:
+        if args.destination is not None:
+            backup.backup_db(config.get_db_path(), args.destination)
+            path = args.destination
+        else:
+            path = backup.take_snapshot(
+                config.get_db_path(),
+                backup.get_backup_dir(),
+                config.get_config().backup_keep,
+            )
+    except (OSError, sqlite3.Error) as e:
+        print(f"[QWTD] Error: Backup failed ({e})", file=sys.stderr)
+        return 1
+
+    print(f"[QWTD] Backed up to {path}")
+
+    return 0
+
+
+def sync_notes(args: argparse.Namespace) -> int:
+    """
+    Exchange changes with other devices through sync_dir
+    """
+
+    from qwtd import changelog
+    from qwtd import sync
+    from qwtd.db_wrapper import open_db
+
+    if not changelog.is_enabled():
+        print("[QWTD] Error: Set sync_dir in the config to sync", file=sys.stderr)
+        return 1
+
+    connection = open_db()
+    try:
+        result = sync.sync(connection)
+    except OSError as e:
+        print(f"[QWTD] Error: Sync failed ({e})", file=sys.stderr)
+        return 1
+    finally:
+        connection.close()
+
+    print(
+        f"[QWTD] Sent {result.sent} changes, applied {result.applied} from other "
+        f"devices ({result.skipped} superseded)"
+    )
+    if result.unreadable:
+        print(
+            f"[QWTD] Warning: Skipped {result.unreadable} unreadable records",
+            file=sys.stderr,
+        )
+
+    return 0
+
+
+def history(args: argparse.Namespace) -> int:
+    """
+    List a note's revisions, or print, compare or restore them
+    """
+
+    from qwtd import notes
+    from qwtd import revisions
+
+    connection = open_db_for_output()
+    try:
+        found = revisions.list_revisions(connection, args.name)
+        if not found:
+            print(
+                f"[QWTD] Error: Note {args.name!r} has no revisions", file=sys.stderr
+            )
+            return 1
+
+        try:
+            if args.show is not None:
+                sys.stdout.write(
+                    revisions.get_revision(connection, args.name, args.show)
+                )
+            elif args.diff is not None:
+                old, new = args.diff
+                sys.stdout.write(
+                    revisions.diff_revisions(connection, args.name, old, new)
+                )
+            elif args.restore is not None:
+                # Saved as the newest revision, so restoring can be undone too
+                notes.begin_write(connection)
+                content = revisions.get_revision(connection, args.name, args.restore)
+                notes.save_note(connection, args.name, content)
+                connection.commit()
+
+                flush_changes(connection)
+                print(
+                    f"[QWTD] Restored {args.name!r} to revision {args.restore}",
+                    file=sys.stderr,
+                )
+            else:
+                for revision in found:
+                    kind = "full" if revision.keyframe else "delta"
+                    print(
+                        f"{revision.revision}\t{revision.date:%Y-%m-%d %H:%M:%S}"
+                        f"\t{revision.size} chars\t{kind}"
+                    )
+        except KeyError as e:
+            print(f"[QWTD] Error: {e.args[0]}", file=sys.stderr)
+            return 1
+    finally:
+        connection.close()
+
+    return 0
+
+
+def open_db_for_output() -> "sqlite3.Connection":
+    """
+    Open the database for a command whose output is meant for other programs,
+    sending the messages about opening it to stderr instead
+    """
+
+    from qwtd.db_wrapper import open_db
+
+    with contextlib.redirect_stdout(sys.stderr):
+        return open_db()
+
+
+def show_note(args: argparse.Namespace) -> int:
+    """
+    Print a note's content
+    """
+
+    answer = ask_daemon("open", name=args.name)
+    if answer is not None:
+        note = answer["note"]
+        content = note["content"] if note is not None else None
+    else:
+        from qwtd import notes
+
+        connection = open_db_for_output()
+        try:
+            read = notes.read_note(connection, args.name)
+        finally:
+            connection.close()
+        content = read[0] if read is not None else None
+
+    if content is None:
+        print(f"[QWTD] Error: Note {args.name!r} doesn't exist", file=sys.stderr)
+        return 1
+
+    sys.stdout.write(content)
+
+    return 0
+
+
+def list_notes(args: argparse.Namespace) -> int:
+    """
+    Print the names of the notes, most recently modified first
+    """
+
+    answer = ask_daemon("list", deleted=args.deleted)
+    if answer is not None:
+        names: list[str] = answer["names"]
+    else:
+        from qwtd.catalog import NoteCatalog
+
+        connection = open_db_for_output()
+        try:
+            catalog = NoteCatalog(connection)
+            catalog.load()
+        finally:
+            connection.close()
+
+        names = [
+            name
+            for name in catalog.names()
+            if catalog.entries[name].deleted == args.deleted
+        ]
+
+    for name in names:
+        print(name)
+
+    return 0
+
+
+def search_notes(args: argparse.Namespace) -> int:
+    """
+    Print the notes that best match a search, with a snippet of each
+    """
+
+    text = " ".join(args.query)
+
+    answer = ask_daemon("search", text=text, limit=args.limit)
+    if answer is not None:
+        results: list[tuple[str, str]] = answer["results"]
+    else:
+        import sqlite3
+
+        from qwtd import search
+
+        query = search.build_match_query(text)
+        if not query:
+            return 0
+
+        connection = open_db_for_output()
+        try:
+            found = search.search_notes(connection, query, args.limit)
+        except sqlite3.OperationalError as e:
+            print(f"[QWTD] Error: Couldn't search for {text!r} ({e})", file=sys.stderr)
+            return 1
+        finally:
+            connection.close()
+
+        results = [(name, search.plain_snippet(snippet)) for name, snippet in found]
+
+    for name, snippet in results:
+        print(f"{name}\t{snippet}")
+
+    return 0
+
+
+def run_daemon(args: argparse.Namespace) -> int:
+    """
+    Run the daemon in the foreground, or stop the one that is running
+    """
+
+    if args.stop:
+        if ask_daemon("stop") is None:
+            print("[QWTD] The daemon isn't running", file=sys.stderr)
+            return 1
+        return 0
+
+    from qwtd import daemon
+
+    return daemon.run_daemon()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Build the parser for qwtd's command line
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="qwtd",
+        description="Quickly make and manage notes from the commandline. "
+        "Without a command, opens the editor.",
+    )
+    parser.add_argument(
+        "--startup-trace",
+        action="store_true",
+        help="report how long each phase of startup took",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="profile the session, writing a Chrome trace (JSON) to PATH on exit",
+    )
+
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+
+    add_parser = commands.add_parser("add", help="create a note from stdin")
+    add_parser.add_argument("name", metavar="NAME")
+    add_parser.add_argument(
+        "--replace", action="store_true", help="overwrite the note if it exists"
+    )
+    add_parser.set_defaults(func=add)
+
+    append_parser = commands.add_parser("append", help="append stdin to a note")
+    append_parser.add_argument("name", metavar="NAME")
+    append_parser.set_defaults(func=append)
+
+    import_parser = commands.add_parser(
+        "import", help="import a directory of markdown files"
+    )
+    import_parser.add_argument("directory", metavar="DIR")
+    import_parser.set_defaults(func=import_dir)
+
+    export_parser = commands.add_parser(
+        "export", help="export notes to a directory or .tar.gz archive"
+    )
+    which = export_parser.add_mutually_exclusive_group(required=True)
+    which.add_argument("--all", action="store_true", help="export every note")
+    which.add_argument("--note", metavar="NAME", help="export a single note")
+    export_parser.add_argument(
+        "destination",
+        metavar="DEST",
+        help="a directory or FILE.tar.gz for --all, or a file for --note",
+    )
+    export_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only rewrite notes whose content changed since the last export to DEST",
+    )
+    export_parser.set_defaults(func=export_notes)
+
+    backup_parser = commands.add_parser(
+        "backup", help="snapshot the database (safe while qwtd is running)"
+    )
+    backup_parser.add_argument(
+        "destination",
+        metavar="DEST",
+        nargs="?",
+        help="file to write the snapshot to (default: a new snapshot in backup_dir)",
+    )
+    backup_parser.set_defaults(func=backup_db)
+
+    sync_parser = commands.add_parser(
+        "sync", help="exchange changes with other devices through sync_dir"
+    )
+    sync_parser.set_defaults(func=sync_notes)
+
+    history_parser = commands.add_parser(
+        "history", help="list a note's revisions, or show, compare or restore one"
+    )
+    history_parser.add_argument("name", metavar="NAME")
+    action = history_parser.add_mutually_exclusive_group()
+    action.add_argument(
+        "--show", type=int, metavar="N", help="print the note as it was at revision N"
+    )
+    action.add_argument(
+        "--diff",
+        type=int,
+        nargs=2,
+        metavar=("A", "B"),
+        help="show the changes from revision A to revision B",
+    )
+    action.add_argument(
+        "--restore",
+        type=int,
+        metavar="N",
+        help="save the note as it was at revision N (as a new revision)",
+    )
+    history_parser.set_defaults(func=history)
+
+    show_parser = commands.add_parser("show", help="print a note")
+    show_parser.add_argument("name", metavar="NAME")
+    show_parser.set_defaults(func=show_note)
+
+    list_parser = commands.add_parser(
+        "list", help="list notes, most recently modified first"
+    )
+    list_parser.add_argument(
+        "--deleted", action="store_true", help="list the deleted notes instead"
+    )
+    list_parser.set_defaults(func=list_notes)
+
+    search_parser = commands.add_parser("search", help="search the notes' content")
+    search_parser.add_argument("query", metavar="QUERY", nargs="+")
+    search_parser.add_argument(
+        "--limit",
+        type=int,
+        default=20,
+        help="the most results to print (default: %(default)s)",
+    )
+    search_parser.set_defaults(func=search_notes)
+
+    daemon_parser = commands.add_parser(
+        "daemon",
+        help="keep the database open in the background, so that commands "
+        "finish right away",
+    )
+    daemon_parser.add_argument(
+        "--stop", action="store_true", help="stop the daemon that is running"
+    )
+    daemon_parser.set_defaults(func=run_daemon)
+
+    return parser
+
+
+def main(argv: list[str] | None = None) -> None:
+    """
+    Run qwtd from the command line
+    """
+
+    args = build_parser().parse_args(argv)
+
+    if args.command is None:
+        from qwtd.db_wrapper import run_with_db
+
+        run_with_db(args.startup_trace, args.profile)
+        return
+
+    func: Callable[[argparse.Namespace], int] = args.func
+    try:
+        sys.exit(func(args))
+    except client.DaemonError as e:
+        print(f"[QWTD] Error: {e}", file=sys.stderr)
+        sys.exit(1)
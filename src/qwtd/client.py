@@ -0,0 +1,96 @@
+"""
+Client for the qwtd daemon (see daemon.py), which answers over a Unix domain
+socket so that commands don't have to open the database themselves
+
+A request is one line of JSON with an "op" and its arguments, and the daemon
+answers it with one line of JSON:
+
+    {"op": "append", "name": "inbox", "text": "milk\\n"}
+    {"ok": true, "version": 3}
+
+On failure the answer is {"ok": false, "error": "..."}, with "kind" set to
+"unavailable" if the daemon didn't handle the request (e.g. the config changed
+since it started), in which case the command should access the database
+itself.
+
+This module is imported by every command before anything else, so it only
+uses the standard library's lightest modules (not even the config).
+"""
+
+import json
+import os
+import socket
+from typing import Any
+
+SOCKETPATH: str = "~/.qwtd.sock"
+
+# How long to wait for the daemon to answer, in seconds
+CLIENT_TIMEOUT: float = 30.0
+
+
+class DaemonUnavailable(Exception):
+    """
+    Raised when no daemon is running, or it declined a request without doing
+    anything
+    """
+
+
+class DaemonError(Exception):
+    """
+    Raised when the daemon failed to handle a request
+    """
+
+    def __init__(self, message: str, kind: str = "error"):
+        super().__init__(message)
+        # What went wrong (e.g. "conflict" or "exists"), so that callers can
+        # handle some errors themselves
+        self.kind: str = kind
+
+
+def get_socket_path() -> str:
+    """
+    Extend the SOCKETPATH constant into a full OS path
+    """
+
+    return os.path.expanduser(SOCKETPATH)
+
+
+def request(op: str, **args: Any) -> dict[str, Any]:
+    """
+    Send a request to the daemon and wait for its answer
+
+    :raises DaemonUnavailable: If the request wasn't handled, so the caller can
+        safely do it itself
+    :raises DaemonError: If the daemon failed to handle the request, or stopped
+        answering after it was sent (in which case it may have been handled)
+    :return: The answer (without "ok")
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CLIENT_TIMEOUT)
+
+    with sock:
+        try:
+            sock.connect(get_socket_path())
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise DaemonUnavailable(str(e)) from e
+
+        try:
+            sock.sendall(json.dumps({"op": op, **args}).encode() + b"\n")
+            with sock.makefile("rb") as file:
+                line = file.readline()
+        except OSError as e:
+            raise DaemonError(f"Lost the connection to the daemon ({e})") from e
+
+    if not line.endswith(b"\n"):
+        raise DaemonError("The daemon stopped without answering")
+
+    answer: dict[str, Any] = json.loads(line)
+
+    if not answer.pop("ok"):
+        kind = answer.get("kind", "error")
+        if kind == "unavailable":
+            raise DaemonUnavailable(answer["error"])
+        raise DaemonError(answer["error"], kind)
+
+    return answer
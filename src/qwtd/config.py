@@ -15,6 +15,45 @@ TOMLPATH: str = "~/.config/qwtd.toml"
 class Config:
     db: str = "~/.config/qwtd.toml"
     days_to_delete: int | float = 7
+    # Store a full copy of a note every this many revisions (deltas otherwise)
+    revision_keyframe_interval: int = 20
+    # Keep at most this many revisions per note (0 keeps every revision)
+    max_revisions: int = 100
+    # Codec used to compress large notes at rest ("zlib", "lzma" or "none")
+    compression: str = "zlib"
+    # Notes smaller than this many bytes are stored uncompressed
+    compress_threshold: int = 4096
+    # Notes at least this many bytes long are stored in chunks and opened in a
+    # viewer that loads them as you scroll (press i to edit one), 0 disables
+    # chunking
+    chunk_threshold: int = 8 * 1024 * 1024
+    # Save automatically after typing has been idle this many seconds (0 disables,
+    # so that abandoning a note discards every change since it was saved)
+    autosave_delay: int | float = 0
+    # Purge expired deleted notes every this many seconds while the app is open
+    purge_interval: int | float = 600
+    # Keep up to this many bytes of recently opened notes in memory (0 disables)
+    content_cache_size: int = 16 * 1024 * 1024
+    # Snapshot the database every this many seconds while the app is open, once
+    # typing has been idle for a while (0, the default, disables scheduled
+    # backups)
+    backup_interval: int | float = 0
+    # Directory that snapshots are written to
+    backup_dir: str = "~/qwtd-backups"
+    # Keep this many of the newest snapshots (0 keeps every snapshot)
+    backup_keep: int = 7
+    # Replicate notes to other devices through this folder (e.g. one synced by
+    # Syncthing), with one log of changes per device ("" disables)
+    sync_dir: str = ""
+    # This device's name, which names its log in sync_dir ("" uses the hostname)
+    sync_device: str = ""
+    # Exchange changes through sync_dir every this many seconds while the app is
+    # open
+    sync_interval: int | float = 30
+    # Profile every session, writing the profile to this path ("" disables)
+    profile: str = ""
+    # Show the latest profiling measurements in the status bar while profiling
+    profile_overlay: bool = True
 
 
 def get_toml_path() -> str:
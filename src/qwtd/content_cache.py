@@ -0,0 +1,110 @@
+"""
+In-memory cache of recently opened notes' content, so switching between a few
+notes doesn't wait on the database
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+# A note as notes.read_note returns it: (content, deleted, expires, version)
+CachedNote = tuple[str, bool, datetime, int]
+
+
+class ContentCache:
+    """
+    Least recently used cache of note contents, bounded by their total size
+
+    The cache belongs to one connection (the editor's writer connection), and
+    is only valid as long as nothing else changed the database: every lookup
+    and insertion passes that connection's PRAGMA data_version, and the whole
+    cache is dropped when it changes. Changes made through the connection
+    itself don't change data_version, so whoever makes them has to update the
+    cache (see put and invalidate).
+
+    Entries can be added from the reader thread while the UI looks them up, so
+    every method holds a lock.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Create a new, empty ContentCache
+
+        :param max_bytes: The total size (UTF-8 encoded) of the content to keep,
+            or 0 to disable the cache
+        :type max_bytes: int
+        """
+
+        self.max_bytes: int = max_bytes
+        self.size: int = 0
+
+        self._entries: OrderedDict[str, tuple[CachedNote, int]] = OrderedDict()
+        self._data_version: int | None = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            return name in self._entries
+
+    def get(self, name: str, data_version: int) -> CachedNote | None:
+        """
+        Look up a note, marking it as the most recently used
+        """
+
+        with self._lock:
+            self._check_version(data_version)
+
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+
+            self._entries.move_to_end(name)
+            return entry[0]
+
+    def put(self, name: str, note: CachedNote, data_version: int):
+        """
+        Add or replace a note, evicting the least recently used ones if the
+        cache gets too large
+
+        :param data_version: data_version as it was before the note was read
+        """
+
+        size = len(note[0].encode("utf-8"))
+        if size > self.max_bytes:
+            self.invalidate(name)
+            return
+
+        with self._lock:
+            self._check_version(data_version)
+
+            old = self._entries.pop(name, None)
+            if old is not None:
+                self.size -= old[1]
+
+            self._entries[name] = (note, size)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def invalidate(self, name: str):
+        """
+        Forget a note (e.g. after it was deleted or restored)
+        """
+
+        with self._lock:
+            old = self._entries.pop(name, None)
+            if old is not None:
+                self.size -= old[1]
+
+    def _check_version(self, data_version: int):
+        """
+        Drop every entry if someone else changed the database since they were
+        read (with the lock held)
+        """
+
+        if data_version != self._data_version:
+            self._entries.clear()
+            self.size = 0
+            self._data_version = data_version
@@ -0,0 +1,491 @@
+"""
+Resident qwtd process that keeps the database open, with the note catalog and
+content cache warm, and answers requests from client.py over a Unix domain
+socket, so that quick commands (`qwtd add`, `qwtd list`, ...) don't pay for
+starting up and opening the database every time
+
+Requests are handled one at a time, on one connection. Meanwhile, a thread
+purges expired notes and exchanges changes through sync_dir, like the app does,
+on a connection of its own (so the catalog and cache see its changes like they
+see other qwtd instances').
+"""
+
+import json
+import os
+import signal
+import socket
+import socketserver
+import sqlite3
+import sys
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+from qwtd import changelog
+from qwtd import client
+from qwtd import config
+from qwtd import notes
+from qwtd import purge
+from qwtd import search
+from qwtd import sync
+from qwtd.catalog import NoteCatalog, read_data_version
+from qwtd.content_cache import ContentCache
+from qwtd.db_wrapper import connect, open_db
+
+# How often to check whether the daemon was asked to stop while no requests come
+# in (in seconds)
+POLL_INTERVAL: float = 1.0
+
+# How long to wait for the next line from a client before hanging up, in
+# seconds (requests are handled one at a time, so a client that stops sending
+# would hold up everyone else)
+REQUEST_TIMEOUT: float = 5.0
+
+# The most search results to answer with
+MAX_SEARCH_LIMIT: int = 1000
+
+
+class RequestError(Exception):
+    """
+    Raised by a request handler to answer with an error
+    """
+
+    def __init__(self, message: str, kind: str = "error"):
+        super().__init__(message)
+        self.kind: str = kind
+
+
+def config_mtime() -> int:
+    """
+    When the config file was last modified
+    """
+
+    return os.stat(config.get_toml_path()).st_mtime_ns
+
+
+class Daemon:
+    """
+    Handles the requests sent to the daemon, on one connection to the database
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        """
+        Create a new Daemon, loading the note catalog
+
+        :param connection: Connection to the (up to date) database
+        :type connection: sqlite3.Connection
+        """
+
+        self.connection: sqlite3.Connection = connection
+
+        self.catalog: NoteCatalog = NoteCatalog(connection)
+        self.catalog.load()
+        self.cache: ContentCache = ContentCache(
+            config.get_config().content_cache_size
+        )
+
+        # The daemon keeps using the settings it started with, so it stops once
+        # the config changes (the next command then starts without it)
+        self.config_mtime: int = config_mtime()
+        self.stopping: bool = False
+
+        self.handlers: dict[str, Callable[[dict[str, Any]], dict[str, Any]]] = {
+            "ping": self.ping,
+            "open": self.open_note,
+            "save": self.save_note,
+            "append": self.append,
+            "list": self.list_notes,
+            "search": self.search,
+            "stop": self.stop,
+        }
+
+    def handle(self, request: dict[str, Any]) -> dict[str, Any]:
+        """
+        Handle a request, and make the answer to send back
+        """
+
+        if config_mtime() != self.config_mtime:
+            self.stopping = True
+            return {
+                "ok": False,
+                "kind": "unavailable",
+                "error": "The config changed since the daemon started",
+            }
+
+        op = request.get("op")
+        if not isinstance(op, str):
+            return {"ok": False, "error": f"Bad request (op is {op!r})"}
+
+        handler = self.handlers.get(op)
+        if handler is None:
+            return {"ok": False, "error": f"Unknown request {op!r}"}
+
+        try:
+            answer = handler(request)
+        except RequestError as e:
+            self.connection.rollback()
+            return {"ok": False, "kind": e.kind, "error": str(e)}
+        except (KeyError, TypeError, ValueError) as e:
+            self.connection.rollback()
+            return {"ok": False, "error": f"Bad request ({e!r})"}
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            return {"ok": False, "error": f"Database error ({e})"}
+
+        return {"ok": True, **answer}
+
+    def ping(self, _: dict[str, Any]) -> dict[str, Any]:
+        """
+        Check that the daemon is running, and which database it serves
+        """
+
+        return {"db": config.get_db_path(), "pid": os.getpid()}
+
+    def open_note(self, request: dict[str, Any]) -> dict[str, Any]:
+        """
+        Read a note, from the cache if it was read recently
+
+        Answers with "note": null if it doesn't exist.
+        """
+
+        name: str = request["name"]
+
+        data_version = read_data_version(self.connection)
+        note = self.cache.get(name, data_version)
+        if note is None:
+            note = notes.read_note(self.connection, name)
+            if note is None:
+                return {"note": None}
+            self.cache.put(name, note, data_version)
+
+        content, deleted, expires, version = note
+
+        return {
+            "note": {
+                "content": content,
+                "deleted": deleted,
+                "expires": expires.isoformat(),
+                "version": version,
+            }
+        }
+
+    def save_note(self, request: dict[str, Any]) -> dict[str, Any]:
+        """
+        Save a note (see notes.save_note)
+
+        With "version", the save fails with kind "conflict" if the note was
+        saved since, and with "create", it fails with kind "exists" if the note
+        already exists.
+        """
+
+        name: str = request["name"]
+
+        if request.get("create"):
+            exists = self.connection.execute(
+                "SELECT 1 FROM notes WHERE name = ?", (name,)
+            ).fetchone()
+            if exists is not None:
+                raise RequestError(f"Note {name!r} already exists", "exists")
+
+        try:
+            version = notes.save_note(
+                self.connection,
+                name,
+                request["content"],
+                version=request.get("version"),
+            )
+        except notes.ConflictError as e:
+            self.connection.rollback()
+            raise RequestError(str(e), "conflict") from e
+        except BaseException:
+            self.connection.rollback()
+            raise
+
+        self.commit(name)
+
+        return {"version": version}
+
+    def append(self, request: dict[str, Any]) -> dict[str, Any]:
+        """
+        Append text to a note on a line of its own, creating the note if it
+        doesn't exist
+        """
+
+        name: str = request["name"]
+        text: str = request["text"]
+
+        # Read the note in the save's transaction, so nobody else can save it
+        # in between
+        notes.begin_write(self.connection)
+        try:
+            existing = notes.read_note(self.connection, name)
+            content = existing[0] if existing else notes.new_note_content(name)
+
+            if content and not content.endswith("\n"):
+                content += "\n"
+
+            version = notes.save_note(self.connection, name, content + text)
+        except BaseException:
+            self.connection.rollback()
+            raise
+
+        self.commit(name)
+
+        return {"version": version}
+
+    def list_notes(self, request: dict[str, Any]) -> dict[str, Any]:
+        """
+        List the names of the notes, most recently modified first (only the
+        deleted ones with "deleted": true)
+        """
+
+        deleted = bool(request.get("deleted", False))
+
+        self.catalog.refresh()
+        names = [
+            name
+            for name in self.catalog.names()
+            if self.catalog.entries[name].deleted == deleted
+        ]
+
+        return {"names": names}
+
+    def search(self, request: dict[str, Any]) -> dict[str, Any]:
+        """
+        Search the content of the notes (see search.build_match_query)
+
+        Answers with up to "limit" [name, snippet] pairs, best match first.
+        """
+
+        query = search.build_match_query(request["text"])
+        limit = min(int(request.get("limit", 20)), MAX_SEARCH_LIMIT)
+        if not query:
+            return {"results": []}
+
+        try:
+            results = search.search_notes(self.connection, query, limit)
+        except sqlite3.OperationalError as e:
+            raise RequestError(f"Couldn't search for {request['text']!r} ({e})")
+
+        return {
+            "results": [
+                [name, search.plain_snippet(snippet)] for name, snippet in results
+            ]
+        }
+
+    def stop(self, _: dict[str, Any]) -> dict[str, Any]:
+        """
+        Stop the daemon once the answer has been sent
+        """
+
+        self.stopping = True
+        return {}
+
+    def commit(self, name: str):
+        """
+        Commit a change made to a note through the daemon's connection
+
+        Changes made through the connection itself don't change its
+        data_version, so the catalog and cache are updated here. The change is
+        appended to the sync log right away, like the commands do.
+        """
+
+        self.connection.commit()
+
+        self.catalog.mark_changed(name)
+        self.cache.invalidate(name)
+
+        if not changelog.is_enabled():
+            return
+
+        try:
+            sync.flush_outbox(self.connection, sync.get_sync_dir())
+        except OSError as e:
+            print(
+                f"[QWTD] Warning: Couldn't write to the sync log ({e})",
+                file=sys.stderr,
+            )
+
+
+def run_background_tasks(stop: threading.Event):
+    """
+    Purge expired notes every purge_interval seconds, and sync every
+    sync_interval seconds (if enabled), until stop is set
+
+    Both run once right away, and are skipped from then on if their interval
+    isn't positive.
+    """
+
+    settings = config.get_config()
+    intervals: dict[Callable[[sqlite3.Connection], Any], float] = {
+        purge.purge_expired: settings.purge_interval
+    }
+    if changelog.is_enabled():
+        intervals[sync.sync] = settings.sync_interval
+
+    due = {task: time.monotonic() for task in intervals}
+
+    while due:
+        now = time.monotonic()
+
+        for task, interval in intervals.items():
+            if task not in due or due[task] > now:
+                continue
+
+            run_on_own_connection(task)
+
+            if interval > 0:
+                due[task] = now + interval
+            else:
+                del due[task]
+
+        if due and stop.wait(max(min(due.values()) - time.monotonic(), 0)):
+            return
+
+
+def run_on_own_connection(task: Callable[[sqlite3.Connection], Any]):
+    """
+    Run a background task on a connection of its own, reporting errors rather
+    than stopping the daemon
+    """
+
+    connection = connect(config.get_db_path())
+    try:
+        task(connection)
+    except (OSError, sqlite3.Error) as e:
+        print(f"[QWTD] Warning: Background task failed ({e})", file=sys.stderr)
+    finally:
+        connection.close()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Answers each line sent over a connection to the daemon's socket
+    """
+
+    server: "DaemonServer"
+    timeout = REQUEST_TIMEOUT
+
+    def handle(self):
+        try:
+            self.answer_lines()
+        except (TimeoutError, ConnectionError):
+            # The client went away, or stopped sending
+            pass
+
+    def answer_lines(self):
+        """
+        Answer every line until the client closes the connection
+        """
+
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                request = None
+                error = f"Bad request ({e})"
+            else:
+                error = "Bad request (not a JSON object)"
+
+            if isinstance(request, dict):
+                answer = self.server.daemon.handle(request)
+            else:
+                answer = {"ok": False, "error": error}
+
+            self.wfile.write(
+                json.dumps(answer, ensure_ascii=False).encode("utf-8") + b"\n"
+            )
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """
+    Server for the daemon's socket, handing requests to a Daemon
+    """
+
+    def __init__(self, path: str, daemon: Daemon):
+        self.daemon: Daemon = daemon
+        self.timeout = POLL_INTERVAL
+
+        # Only the user running the daemon can connect to it
+        umask = os.umask(0o077)
+        try:
+            super().__init__(path, RequestHandler)
+        finally:
+            os.umask(umask)
+
+
+def is_running(path: str) -> bool:
+    """
+    Check whether a daemon is listening on the socket at path
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+
+    return True
+
+
+@contextmanager
+def listen(path: str, daemon: Daemon) -> Iterator[DaemonServer]:
+    """
+    Listen on the socket at path (replacing a socket left behind by a daemon
+    that didn't stop cleanly), removing it again afterwards
+    """
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    server = DaemonServer(path, daemon)
+    try:
+        yield server
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def run_daemon() -> int:
+    """
+    Serve requests until asked to stop (by a "stop" request, SIGTERM or
+    Ctrl-C), or until the config changes
+    """
+
+    path = client.get_socket_path()
+    if is_running(path):
+        print(f"[QWTD] Error: The daemon is already running ({path})", file=sys.stderr)
+        return 1
+
+    connection = open_db()
+    try:
+        daemon = Daemon(connection)
+
+        def request_stop(*_: Any):
+            daemon.stopping = True
+
+        signal.signal(signal.SIGTERM, request_stop)
+
+        stop = threading.Event()
+        background = threading.Thread(target=run_background_tasks, args=(stop,))
+        background.start()
+
+        try:
+            with listen(path, daemon) as server:
+                print(f"[QWTD] Listening on {path}")
+
+                while not daemon.stopping:
+                    server.handle_request()
+        finally:
+            # Let a purge or sync that is still running finish
+            stop.set()
+            background.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("[QWTD] Closing db connection.")
+        connection.close()
+
+    return 0
@@ -2,8 +2,18 @@
 Utilities to initialize and update the database to the latest version.
 """
 
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from sqlite3 import Connection
+from typing import Any
+
+from qwtd import chunks
+from qwtd import links
+from qwtd import purge
+from qwtd import storage
 
 
 """
@@ -53,10 +63,301 @@ Version 1:
                 If the deleted == 1, expires indicates the time at which this
                 note should be permanently deleted.
         - PRAGMA user_version 1
+Version 2:
+    Database Version 2 adds an index on date_modified, so that the note catalog
+    can be loaded in order without sorting the whole table.
+
+    Format:
+        - table notes: (unchanged from version 1)
+        - index notes_date_modified ON notes(date_modified)
+        - PRAGMA user_version 2
+Version 3:
+    Database Version 3 adds a full-text index over note names and content. The
+    index is an external content FTS5 table, so the text itself is only stored
+    once (in notes), and it is kept in sync with notes by triggers.
+
+    Format:
+        - table notes: (unchanged from version 2)
+        - virtual table notes_fts USING fts5:
+            - name
+            - content
+            content='notes', content_rowid='rowid'
+        - triggers notes_fts_insert, notes_fts_delete, notes_fts_update
+            Mirror every change to notes into notes_fts. Notes must be updated
+            with UPDATE or an upsert rather than INSERT OR REPLACE, since the
+            delete trigger doesn't fire for rows removed by REPLACE.
+        - PRAGMA user_version 3
+Version 4:
+    Database Version 4 adds a revision history: every save stores a revision,
+    either as the full content (a keyframe) or as a delta against the previous
+    revision. See revisions.py for the delta format.
+
+    Format:
+        - table notes: (unchanged from version 3)
+        - table revisions:
+            - note TEXT
+            - revision INTEGER
+                Numbered from 1 per note. (note, revision) is the primary key
+            - date TIMESTAMP
+            - keyframe INTEGER (boolean)
+                Whether data holds the full content rather than a delta
+            - size INTEGER
+                Length of the full content at this revision
+            - data TEXT
+        - trigger notes_revisions_delete
+            Removes a note's revisions when the note is permanently deleted
+        - PRAGMA user_version 4
+Version 5:
+    Database Version 5 compresses large notes at rest. Content that is at least
+    compress_threshold bytes long is stored as a compressed BLOB, with the codec
+    that was used recorded next to it (see storage.py). Revision keyframes are
+    compressed the same way.
+
+    Since the full-text index can no longer read content straight from notes, it
+    now reads it through a view that decodes it with the qwtd_decode function.
+
+    Format:
+        - table notes:
+            - (columns from version 4)
+            - codec TEXT
+                NULL if content is plain text, otherwise the codec used to
+                compress it ("zlib" or "lzma")
+        - table revisions:
+            - (columns from version 4)
+            - codec TEXT
+                As in notes, for the data column
+        - view notes_text(note_id, name, content)
+            notes with decoded content, used as the content table of notes_fts
+        - virtual table notes_fts USING fts5:
+            - name
+            - content
+            content='notes_text', content_rowid='note_id'
+        - triggers notes_fts_insert, notes_fts_delete, notes_fts_update
+            (as in version 3, but indexing decoded content)
+        - PRAGMA user_version 5
+Version 6:
+    Database Version 6 stores a hash of every note's (decoded) content, so that
+    bulk imports can tell which notes changed without reading their content.
+
+    Format:
+        - table notes:
+            - (columns from version 5)
+            - content_hash TEXT
+                storage.content_hash of the note's content
+        - PRAGMA user_version 6
+Version 7:
+    Database Version 7 stores very large notes (at least chunk_threshold bytes)
+    as fixed-size chunks in a separate table, which are read and written with
+    incremental blob I/O so that only the chunks that changed are rewritten
+    (see chunks.py). A chunked note has a codec of "chunked" and NULL content,
+    so it isn't included in the full-text index.
+
+    Format:
+        - table notes: (unchanged from version 6)
+        - table note_chunks:
+            - note TEXT
+            - seq INTEGER
+                Position of the chunk in the note, from 0. (note, seq) is the
+                primary key
+            - data BLOB
+            - hash TEXT
+                Hash of data, to skip rewriting chunks that didn't change
+            - newlines INTEGER
+                Number of line breaks in data, to find lines without reading it
+        - trigger notes_chunks_delete
+            Removes a note's chunks when the note is permanently deleted
+        - PRAGMA user_version 7
+Version 8:
+    Database Version 8 makes purging expired notes cheap enough to do while the
+    app is running (see purge.py): a partial index finds expired notes without
+    scanning every note, and the database uses incremental auto-vacuum, so the
+    space freed by a purge can be returned to the filesystem.
+
+    Migrating runs a full VACUUM to switch auto_vacuum on. Since VACUUM can
+    renumber the rowids of notes, the full-text index is rebuilt afterwards.
+
+    Format:
+        - table notes: (unchanged from version 7)
+        - index notes_expired ON notes(expires) WHERE deleted = 1
+        - PRAGMA auto_vacuum INCREMENTAL
+        - PRAGMA user_version 8
+Version 9:
+    Database Version 9 lets several qwtd instances edit the same database
+    safely. Every note has a version, which is incremented each time it's
+    saved. The editor remembers the version of the note it opened, and a save
+    only goes through if the note is still at that version, so changes saved
+    elsewhere in the meantime are merged instead of being overwritten.
+
+    Format:
+        - table notes:
+            - (columns from version 8)
+            - version INTEGER NOT NULL DEFAULT 0
+                Number of times the note was saved (since version 9)
+        - PRAGMA user_version 9
+Version 10:
+    Database Version 10 indexes the links between notes ([[note name]]) and
+    their #tags (see links.py), which are updated whenever a note is saved, so
+    that backlinks and the notes with a tag don't need a scan of every note.
+
+    Format:
+        - table notes: (unchanged from version 9)
+        - table links (WITHOUT ROWID):
+            - source TEXT
+                The note the link is in
+            - target TEXT
+                The name of the note it links to, which may not exist.
+                (source, target) is the primary key
+        - index links_target ON links(target, source)
+        - table tags (WITHOUT ROWID):
+            - note TEXT
+            - tag TEXT
+                Lowercased, without the #. (note, tag) is the primary key
+        - index tags_tag ON tags(tag, note)
+        - trigger notes_links_delete
+            Removes a note's links and tags when the note is permanently
+            deleted
+        - PRAGMA user_version 10
+Version 11:
+    Database Version 11 stores note content by its hash, in a blobs table, so
+    that notes with the same content (copies, templates, imported duplicates)
+    share one copy of it. A note refers to its content by content_hash, and
+    saving a note whose content didn't change only updates its metadata.
+
+    Every blob counts the notes that refer to it, which triggers keep up to
+    date. Blobs that nothing refers to any more are deleted by whoever made
+    them unreferenced (saving a note, or purging expired ones, see blobs.py).
+
+    The search index reads content from blobs from now on. Its triggers only
+    reindex a note when its name or content_hash changes.
+
+    Format:
+        - table notes:
+            - (columns from version 10)
+            - content
+                No longer used, always NULL (SQLite only recently gained
+                ALTER TABLE DROP COLUMN)
+            - codec
+                "chunked" for chunked notes, NULL otherwise
+        - table blobs:
+            - hash TEXT PRIMARY KEY
+                storage.content_hash of the content
+            - content TEXT
+            - codec TEXT
+                As content and codec were in notes (see version 5)
+            - refs INTEGER NOT NULL
+                How many notes (that aren't chunked) have this content_hash
+        - index blobs_unreferenced ON blobs(hash) WHERE refs = 0
+        - triggers notes_blobs_insert, notes_blobs_delete, notes_blobs_update
+            Maintain blobs.refs
+        - view notes_text(note_id, name, content)
+            notes with their decoded content, read from blobs
+        - triggers notes_fts_insert, notes_fts_delete, notes_fts_update
+            (as in version 5, but reading content from blobs)
+        - PRAGMA user_version 11
+Version 12:
+    Database Version 12 can replicate notes to other devices through a sync
+    folder (see changelog.py and sync.py). Changes made on this device are
+    queued until they are appended to its log, and the latest change to each
+    note and how far every other device's log was read are remembered.
+
+    Format:
+        - table notes: (unchanged from version 11)
+        - table sync_outbox:
+            - seq INTEGER PRIMARY KEY AUTOINCREMENT
+                Numbers changes in order, never reusing a number
+            - op TEXT NOT NULL
+                "upsert", "delete" or "restore"
+            - name TEXT NOT NULL
+            - stamp INTEGER NOT NULL
+            - expires TIMESTAMP
+                When the note expires, for "delete"
+        - table sync_notes (WITHOUT ROWID):
+            - name TEXT PRIMARY KEY
+            - stamp INTEGER NOT NULL
+                When the latest change to the note was made, in microseconds
+            - device TEXT NOT NULL
+                The device it was made on. Rows are kept after notes are
+                purged, so older changes don't bring them back
+        - table sync_peers (WITHOUT ROWID):
+            - device TEXT PRIMARY KEY
+            - position INTEGER NOT NULL
+                How many bytes of the device's log were read
+            - seq INTEGER NOT NULL
+                The seq of the last record of it that was applied
+        - PRAGMA user_version 12
+
+Migrating:
+    Each version is reached by one Migration in MIGRATIONS (at the bottom of
+    this file). A migration's schema changes run in a single transaction, and
+    the new user_version is only set in the transaction that finishes it, so an
+    interrupted migration never leaves a database that claims a version it
+    doesn't have.
+
+    Migrations that rewrite every row (backfills) do so in batches, each in its
+    own transaction. While one is in progress, a qwtd_migration table records
+    how far it got, and the next time the database is opened the migration
+    picks up where it left off. The table is dropped when the migration
+    finishes.
 """
 
 
-LATEST_DB_VERSION = 1
+# Rows rewritten per transaction by a backfill
+MIGRATION_BATCH_SIZE: int = 1000
+
+# Report a backfill's progress at most once every this many seconds
+PROGRESS_INTERVAL: float = 1.0
+
+
+@dataclass(frozen=True)
+class Backfill:
+    """
+    A rewrite of existing rows that a migration makes, done in batches
+
+    Rows are visited in rowid order, and every batch is committed along with
+    the rowid it reached, so rowids must not change while a backfill is in
+    progress (VACUUM only runs before or after every backfill, see
+    after_vacuum).
+    """
+
+    # What is being done, for the progress output
+    description: str
+    # Table whose rows are rewritten
+    table: str
+    # SET clause of the UPDATE, with a ? for each value convert returns
+    update: str = ""
+    # Columns read from each row and passed to convert (or apply)
+    columns: tuple[str, ...] = ()
+    # Computes the values to update a row with (None when update has no ?s)
+    convert: Callable[..., tuple[Any, ...]] | None = None
+    # Called with the connection and each row's columns instead of updating it,
+    # for backfills that write to other tables
+    apply: Callable[..., None] | None = None
+    # Only rows matching this SQL condition are rewritten
+    where: str = "1"
+    # Run after the migration's vacuum rather than before it (for backfills
+    # that depend on rowids, which VACUUM can change). Backfills with this set
+    # must come last.
+    after_vacuum: bool = False
+
+
+@dataclass(frozen=True)
+class Migration:
+    """
+    One step of the schema history, bringing a database to version
+    """
+
+    # The version the database is at afterwards
+    version: int
+    # Changes the schema, in one transaction (and can't be resumed)
+    schema: Callable[[Connection], None] | None = None
+    # Rewrites of existing rows, done after schema, in order
+    backfills: tuple[Backfill, ...] = ()
+    # Runs outside of any transaction after the backfills (or before the ones
+    # marked after_vacuum), for VACUUM. It must be safe to run again if it's
+    # interrupted.
+    vacuum: Callable[[Connection], None] | None = None
+    # Runs last, in the transaction that sets the new version
+    finish: Callable[[Connection], None] | None = None
 
 
 def ensure_db(connection: Connection, just_created: bool):
@@ -81,6 +382,42 @@ def ensure_db(connection: Connection, just_created: bool):
         print(f"[QWTD] Database was already up to date (version {user_version})")
 
 
+@contextmanager
+def transaction(connection: Connection) -> Iterator[None]:
+    """
+    Run the body of a with block in one (write) transaction, which is rolled
+    back if it raises
+
+    Schema changes don't start a transaction by themselves in sqlite3, so
+    without this each statement would be committed on its own.
+
+    If the caller already has a transaction open, the body runs in a savepoint
+    instead: it's still undone as a whole if it raises, but it's only committed
+    along with the caller's transaction.
+    """
+
+    if connection.in_transaction:
+        connection.execute("SAVEPOINT nested_transaction")
+        try:
+            yield
+        except BaseException:
+            connection.execute("ROLLBACK TO nested_transaction")
+            connection.execute("RELEASE nested_transaction")
+            raise
+
+        connection.execute("RELEASE nested_transaction")
+        return
+
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        connection.rollback()
+        raise
+
+    connection.commit()
+
+
 def initialize_latest(connection: Connection):
     """
     Initialize the database with the latest schema.
@@ -89,26 +426,55 @@ def initialize_latest(connection: Connection):
     no tables exist before it is executed.
     """
 
-    # Ensure that table exists
-    connection.execute(
-        """
-        CREATE TABLE IF NOT EXISTS notes(
-            name TEXT PRIMARY KEY,
-            content TEXT,
-            date_modified TIMESTAMP,
-            deleted INTEGER,
-            expires TIMESTAMP
+    # Switching to WAL has already written the database header, so auto_vacuum
+    # only takes effect after a VACUUM (which is instant while it's empty)
+    connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    connection.execute("VACUUM")
+
+    # If this is interrupted, the database is left empty (at version 0) rather
+    # than half created
+    with transaction(connection):
+        # Ensure that table exists
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS notes(
+                name TEXT PRIMARY KEY,
+                content TEXT,
+                date_modified TIMESTAMP,
+                deleted INTEGER,
+                expires TIMESTAMP,
+                codec TEXT,
+                content_hash TEXT,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+            """
         )
-        """
-    )
 
-    connection.execute(
-        """
-        PRAGMA user_version=1
-        """
-    )
+        connection.execute(
+            """
+            CREATE INDEX IF NOT EXISTS notes_date_modified ON notes(date_modified)
+            """
+        )
 
-    connection.commit()
+        create_expired_index(connection)
+
+        create_search_index(connection)
+
+        create_revisions_table(connection)
+
+        create_chunks_table(connection)
+
+        create_links_tables(connection)
+
+        create_blobs_table(connection)
+
+        create_sync_tables(connection)
+
+        connection.execute(
+            f"""
+            PRAGMA user_version={LATEST_DB_VERSION}
+            """
+        )
 
 
 def migrate_db(version: int, connection: Connection) -> int:
@@ -118,25 +484,185 @@ def migrate_db(version: int, connection: Connection) -> int:
     It may be necessary to call this function multiple times to get up to date.
     """
 
-    match version:
-        case 0:
-            return migrate_v0_to_v1(connection)
+    if version == LATEST_DB_VERSION:
         # Don't migrate if it's the latest version
-        case 1:
-            return 1
-        case _:
-            msg = f"Invalid db version {version} passed to migrate_version\n"
-            msg += "  This is most likely QWTD issue, not the user's fault\n"
-            msg += "  If this issue is unexpected (e.g. you did not manually\n"
-            msg += "  edit the database), please report it on github!\n"
-            msg += "  https://github.com/aidnem/qwtd\n"
+        return version
+
+    if not 0 <= version < LATEST_DB_VERSION:
+        msg = f"Invalid db version {version} passed to migrate_version\n"
+        msg += "  This is most likely QWTD issue, not the user's fault\n"
+        msg += "  If this issue is unexpected (e.g. you did not manually\n"
+        msg += "  edit the database), please report it on github!\n"
+        msg += "  https://github.com/aidnem/qwtd\n"
+
+        raise ValueError(msg)
+
+    return run_migration(connection, MIGRATIONS[version])
+
+
+def run_migration(connection: Connection, migration: Migration) -> int:
+    """
+    Run a migration, or resume it if it was interrupted
+
+    :return: The version the database is at afterwards
+    """
+
+    progress = read_progress(connection)
+
+    if progress is not None and progress[0] == migration.version:
+        _, step, position = progress
+        print(f"[QWTD] Resuming interrupted migration to version {migration.version}")
+    else:
+        with transaction(connection):
+            if migration.schema is not None:
+                migration.schema(connection)
+
+            if migration.backfills or migration.vacuum is not None:
+                connection.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS qwtd_migration(
+                        version INTEGER NOT NULL,
+                        step INTEGER NOT NULL,
+                        position INTEGER NOT NULL
+                    )
+                    """
+                )
+                connection.execute("DELETE FROM qwtd_migration")
+                connection.execute(
+                    "INSERT INTO qwtd_migration VALUES (?, 0, 0)",
+                    (migration.version,),
+                )
+            else:
+                finish_migration(connection, migration)
+                return migration.version
+
+        step, position = 0, 0
+
+    # The vacuum runs right before the first backfill marked after_vacuum, or
+    # after every backfill if none is
+    vacuum_step = next(
+        (
+            index
+            for index, backfill in enumerate(migration.backfills)
+            if backfill.after_vacuum
+        ),
+        len(migration.backfills),
+    )
+
+    for index in range(step, len(migration.backfills)):
+        # Once a backfill after the vacuum has made progress, the vacuum is done
+        if index == vacuum_step and position == 0 and migration.vacuum is not None:
+            migration.vacuum(connection)
+
+        run_backfill(connection, migration.backfills[index], index, position)
+        position = 0
+
+    if vacuum_step == len(migration.backfills) and migration.vacuum is not None:
+        migration.vacuum(connection)
+
+    with transaction(connection):
+        finish_migration(connection, migration)
+        connection.execute("DROP TABLE IF EXISTS qwtd_migration")
+
+    return migration.version
+
+
+def read_progress(connection: Connection) -> tuple[int, int, int] | None:
+    """
+    Get the (version, step, position) of an interrupted migration, if any
+    """
+
+    exists = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'qwtd_migration'"
+    ).fetchone()
+    if exists is None:
+        return None
 
-            raise ValueError(msg)
+    return connection.execute(
+        "SELECT version, step, position FROM qwtd_migration"
+    ).fetchone()
 
 
-def migrate_v0_to_v1(connection) -> int:
+def run_backfill(connection: Connection, backfill: Backfill, step: int, after: int):
+    """
+    Rewrite the rows a backfill applies to, from rowid after onwards, in
+    batches that each commit the progress made
+
+    :param step: The position of the backfill in its migration
     """
-    Migrate a database from format 0 to format 1
+
+    select = f"""
+        SELECT rowid{"".join(", " + column for column in backfill.columns)}
+        FROM {backfill.table}
+        WHERE rowid > ? AND ({backfill.where})
+        ORDER BY rowid
+        LIMIT ?
+    """
+    update = f"UPDATE {backfill.table} SET {backfill.update} WHERE rowid = ?"
+
+    total: int = connection.execute(
+        f"SELECT count(*) FROM {backfill.table} WHERE rowid > ? AND ({backfill.where})",
+        (after,),
+    ).fetchone()[0]
+    done = 0
+    reported = time.perf_counter()
+
+    while True:
+        with transaction(connection):
+            rows = connection.execute(select, (after, MIGRATION_BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+
+            convert = backfill.convert
+            if backfill.apply is not None:
+                for _, *values in rows:
+                    backfill.apply(connection, *values)
+            else:
+                connection.executemany(
+                    update,
+                    (
+                        (*convert(*values), rowid) if convert is not None else (rowid,)
+                        for rowid, *values in rows
+                    ),
+                )
+
+            after = rows[-1][0]
+            connection.execute(
+                "UPDATE qwtd_migration SET step = ?, position = ?", (step, after)
+            )
+
+        done += len(rows)
+        if time.perf_counter() - reported >= PROGRESS_INTERVAL:
+            print(f"[QWTD]   {backfill.description}: {done}/{total}")
+            reported = time.perf_counter()
+
+    with transaction(connection):
+        connection.execute(
+            "UPDATE qwtd_migration SET step = ?, position = 0", (step + 1,)
+        )
+
+    if total:
+        print(f"[QWTD]   {backfill.description}: done ({done} rows)")
+
+
+def finish_migration(connection: Connection, migration: Migration):
+    """
+    Run the last part of a migration and set the new version (in the caller's
+    transaction)
+    """
+
+    if migration.finish is not None:
+        migration.finish(connection)
+
+    connection.execute(f"PRAGMA user_version={migration.version}")
+
+
+def migrate_v0_to_v1(connection: Connection):
+    """
+    Change the schema from format 0 to format 1
+
+    The expiration date of every note is then set to its modification date (as
+    for new notes) by a backfill.
     """
 
     # First, add the necessary columns to the table
@@ -147,15 +673,11 @@ def migrate_v0_to_v1(connection) -> int:
     )
 
     connection.execute(
-        f"""
-        ALTER TABLE notes
-        ADD COLUMN expires TIMESTAMP
-        DEFAULT '{datetime.now()}'
+        """
+        ALTER TABLE notes ADD COLUMN expires TIMESTAMP
         """
     )
 
-    connection.commit()
-
     # After updating database structure, reformat the deleted note
     last_deleted: str = connection.execute("SELECT * FROM last_deleted").fetchone()[0]
 
@@ -180,21 +702,774 @@ def migrate_v0_to_v1(connection) -> int:
     # Finally, delete the last_deleted database
     connection.execute("DROP TABLE last_deleted")
 
-    connection.execute("PRAGMA user_version=1")
 
-    connection.commit()
+def migrate_v1_to_v2(connection: Connection):
+    """
+    Change the schema from format 1 to format 2
+    """
+
+    connection.execute(
+        """
+        CREATE INDEX IF NOT EXISTS notes_date_modified ON notes(date_modified)
+        """
+    )
+
+
+def migrate_v2_to_v3(connection: Connection):
+    """
+    Change the schema from format 2 to format 3
+
+    Existing notes are then added to the index by a backfill.
+    """
+
+    connection.execute(
+        """
+        CREATE VIRTUAL TABLE notes_fts USING fts5(
+            name,
+            content,
+            content='notes',
+            content_rowid='rowid',
+            prefix='2 3'
+        )
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts(rowid, name, content)
+            VALUES (new.rowid, new.name, new.content);
+        END
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, name, content)
+            VALUES ('delete', old.rowid, old.name, old.content);
+        END
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER notes_fts_update
+        AFTER UPDATE OF name, content ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, name, content)
+            VALUES ('delete', old.rowid, old.name, old.content);
+            INSERT INTO notes_fts(rowid, name, content)
+            VALUES (new.rowid, new.name, new.content);
+        END
+        """
+    )
+
+
+def migrate_v3_to_v4(connection: Connection):
+    """
+    Change the schema from format 3 to format 4
+    """
+
+    connection.execute(
+        """
+        CREATE TABLE revisions(
+            note TEXT NOT NULL,
+            revision INTEGER NOT NULL,
+            date TIMESTAMP,
+            keyframe INTEGER,
+            size INTEGER,
+            data TEXT,
+            PRIMARY KEY (note, revision)
+        )
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER notes_revisions_delete
+        AFTER DELETE ON notes BEGIN
+            DELETE FROM revisions WHERE note = old.name;
+        END
+        """
+    )
+
+
+def migrate_v4_to_v5(connection: Connection):
+    """
+    Change the schema from format 4 to format 5
+
+    Notes and keyframes are then compressed by backfills, and the search index
+    is filled in again by a backfill once they're done.
+    """
+
+    connection.execute("ALTER TABLE notes ADD COLUMN codec TEXT")
+    connection.execute("ALTER TABLE revisions ADD COLUMN codec TEXT")
+
+    # The index has to read content through notes_text from now on, so it's
+    # recreated empty. Its triggers are only created once it's filled in again,
+    # so compressing doesn't reindex every note.
+    connection.execute("DROP TRIGGER notes_fts_insert")
+    connection.execute("DROP TRIGGER notes_fts_delete")
+    connection.execute("DROP TRIGGER notes_fts_update")
+    connection.execute("DROP TABLE notes_fts")
+
+    create_search_index_v5(connection)
+
+
+def migrate_v5_to_v6(connection: Connection):
+    """
+    Change the schema from format 5 to format 6
+
+    Content hashes are then filled in by a backfill.
+    """
+
+    connection.execute("ALTER TABLE notes ADD COLUMN content_hash TEXT")
+
+
+def migrate_v6_to_v7(connection: Connection):
+    """
+    Change the schema from format 6 to format 7
+
+    Existing notes are left as they are until they are saved again.
+    """
+
+    create_chunks_table(connection)
+
+
+def migrate_v7_to_v8(connection: Connection):
+    """
+    Change the schema from format 7 to format 8
+
+    The VACUUM that follows can renumber the rowids of notes, which the search
+    index refers to, so the index is emptied here and filled in again by a
+    backfill after it.
+    """
+
+    create_expired_index(connection)
+    connection.execute("INSERT INTO notes_fts(notes_fts) VALUES('delete-all')")
+
+
+def vacuum_v7_to_v8(connection: Connection):
+    """
+    Switch an existing database to incremental auto-vacuum
+
+    VACUUM can't run inside a transaction, and is what actually applies the new
+    auto_vacuum mode to an existing database.
+    """
+
+    connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    connection.execute("VACUUM")
+
+
+def migrate_v8_to_v9(connection: Connection):
+    """
+    Change the schema from format 8 to format 9
+    """
+
+    connection.execute(
+        "ALTER TABLE notes ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+    )
+
+
+def migrate_v10_to_v11(connection: Connection):
+    """
+    Change the schema from format 10 to format 11
+
+    Content is then moved into blobs by a backfill. The search index's entries
+    stay valid (the content they index doesn't change), so only its view and
+    triggers are replaced.
+    """
+
+    create_blobs_table(connection)
+
+    connection.execute("DROP TRIGGER notes_fts_insert")
+    connection.execute("DROP TRIGGER notes_fts_delete")
+    connection.execute("DROP TRIGGER notes_fts_update")
+    connection.execute("DROP VIEW notes_text")
+
+    create_search_index(connection)
+
+
+def move_to_blob(
+    connection: Connection,
+    name: str,
+    content: str | bytes | None,
+    codec: str | None,
+    content_hash: str,
+):
+    """
+    Move one note's content into blobs (a backfill)
+
+    Content is moved as it's stored, without being decoded or recompressed.
+    Every note has had a content_hash since version 6, and it doesn't change
+    here, so the triggers don't count the reference: it's counted here.
+    """
+
+    connection.execute(
+        """
+        INSERT INTO blobs (hash, content, codec, refs) VALUES (?, ?, ?, 1)
+        ON CONFLICT(hash) DO UPDATE SET refs = refs + 1
+        """,
+        (content_hash, content, codec),
+    )
+
+    connection.execute(
+        "UPDATE notes SET content = NULL, codec = NULL WHERE name = ?", (name,)
+    )
+
+
+def index_links_row(
+    connection: Connection, name: str, content: str | bytes | None, codec: str | None
+):
+    """
+    Index one note's links and tags (a backfill)
+    """
+
+    if codec == chunks.CHUNKED:
+        text = chunks.read_chunked(connection, name)
+    else:
+        text = storage.decode_content(content, codec)
+
+    links.index_note(connection, name, text)
+
+
+def index_search_row(
+    connection: Connection,
+    rowid: int,
+    name: str,
+    content: str | bytes | None,
+    codec: str | None = None,
+):
+    """
+    Add one note to the (empty) full-text index (a backfill)
+
+    Chunked notes have no content in notes, so only their name is indexed, as
+    the index's content table has it.
+    """
+
+    connection.execute(
+        "INSERT INTO notes_fts(rowid, name, content) VALUES (?, ?, ?)",
+        (rowid, name, storage.decode_content(content, codec)),
+    )
+
+
+def create_expired_index(connection: Connection):
+    """
+    Create the partial index used to find deleted notes that have expired
+    """
+
+    connection.execute(
+        """
+        CREATE INDEX IF NOT EXISTS notes_expired ON notes(expires) WHERE deleted = 1
+        """
+    )
+
+
+def create_search_index(connection: Connection):
+    """
+    Create the full-text index over notes and the triggers that maintain it
+
+    The index reads content through the notes_text view, which looks it up in
+    blobs and decodes it with qwtd_decode (see storage.register_functions).
+    Chunked notes aren't indexed. The triggers read content the same way, so
+    the blob a note refers to must exist before the note does (and is only
+    deleted once nothing refers to it, after the triggers ran).
+    """
+
+    connection.execute(
+        """
+        CREATE VIEW IF NOT EXISTS notes_text AS
+        SELECT
+            notes.rowid AS note_id,
+            notes.name,
+            qwtd_decode(blobs.content, blobs.codec) AS content
+        FROM notes
+        LEFT JOIN blobs
+            ON blobs.hash = notes.content_hash AND notes.codec IS NOT 'chunked'
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            name,
+            content,
+            content='notes_text',
+            content_rowid='note_id',
+            prefix='2 3'
+        )
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts(rowid, name, content)
+            VALUES (
+                new.rowid,
+                new.name,
+                (
+                    SELECT qwtd_decode(content, codec) FROM blobs
+                    WHERE hash = new.content_hash AND new.codec IS NOT 'chunked'
+                )
+            );
+        END
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, name, content)
+            VALUES (
+                'delete',
+                old.rowid,
+                old.name,
+                (
+                    SELECT qwtd_decode(content, codec) FROM blobs
+                    WHERE hash = old.content_hash AND old.codec IS NOT 'chunked'
+                )
+            );
+        END
+        """
+    )
+
+    # Saving a note without changing its content sets content_hash to the same
+    # value, which shouldn't reindex it
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update
+        AFTER UPDATE OF name, content_hash, codec ON notes
+        WHEN old.name IS NOT new.name
+            OR old.content_hash IS NOT new.content_hash
+            OR (old.codec IS 'chunked') IS NOT (new.codec IS 'chunked')
+        BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, name, content)
+            VALUES (
+                'delete',
+                old.rowid,
+                old.name,
+                (
+                    SELECT qwtd_decode(content, codec) FROM blobs
+                    WHERE hash = old.content_hash AND old.codec IS NOT 'chunked'
+                )
+            );
+            INSERT INTO notes_fts(rowid, name, content)
+            VALUES (
+                new.rowid,
+                new.name,
+                (
+                    SELECT qwtd_decode(content, codec) FROM blobs
+                    WHERE hash = new.content_hash AND new.codec IS NOT 'chunked'
+                )
+            );
+        END
+        """
+    )
+
+
+def create_search_index_v5(connection: Connection):
+    """
+    Create the full-text index over notes and the triggers that maintain it,
+    as they were from version 5 to 10 (when content was stored in notes)
+
+    The index reads content through the notes_text view, which decodes
+    compressed content with qwtd_decode (see storage.register_functions).
+    The triggers are created separately (see create_search_triggers_v5), once
+    the index has been filled in.
+    """
+
+    connection.execute(
+        """
+        CREATE VIEW IF NOT EXISTS notes_text AS
+        SELECT
+            rowid AS note_id,
+            name,
+            qwtd_decode(content, codec) AS content
+        FROM notes
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            name,
+            content,
+            content='notes_text',
+            content_rowid='note_id',
+            prefix='2 3'
+        )
+        """
+    )
+
+
+def create_search_triggers_v5(connection: Connection):
+    """
+    Create the triggers that kept the full-text index in sync with notes from
+    version 5 to 10
+    """
+
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts(rowid, name, content)
+            VALUES (new.rowid, new.name, qwtd_decode(new.content, new.codec));
+        END
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, name, content)
+            VALUES (
+                'delete', old.rowid, old.name, qwtd_decode(old.content, old.codec)
+            );
+        END
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update
+        AFTER UPDATE OF name, content, codec ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, name, content)
+            VALUES (
+                'delete', old.rowid, old.name, qwtd_decode(old.content, old.codec)
+            );
+            INSERT INTO notes_fts(rowid, name, content)
+            VALUES (new.rowid, new.name, qwtd_decode(new.content, new.codec));
+        END
+        """
+    )
 
-    # This results in a user version of 1
-    return 1
 
+def create_revisions_table(connection: Connection):
+    """
+    Create the revision history table and the trigger that cleans it up
+    """
+
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS revisions(
+            note TEXT NOT NULL,
+            revision INTEGER NOT NULL,
+            date TIMESTAMP,
+            keyframe INTEGER,
+            size INTEGER,
+            data TEXT,
+            codec TEXT,
+            PRIMARY KEY (note, revision)
+        )
+        """
+    )
 
-def delete_expired_notes(connection: Connection):
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_revisions_delete
+        AFTER DELETE ON notes BEGIN
+            DELETE FROM revisions WHERE note = old.name;
+        END
+        """
+    )
+
+
+def create_chunks_table(connection: Connection):
     """
-    The final step of database initialization, delete all notes that have been
-    deleted and have expired.
+    Create the table that holds the content of chunked notes, and the trigger
+    that cleans it up
     """
 
     connection.execute(
-        "DELETE FROM notes WHERE deleted == 1 AND expires < ?",
-        (datetime.now(),),
+        """
+        CREATE TABLE IF NOT EXISTS note_chunks(
+            note TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            hash TEXT NOT NULL,
+            newlines INTEGER NOT NULL,
+            PRIMARY KEY (note, seq)
+        )
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_chunks_delete
+        AFTER DELETE ON notes BEGIN
+            DELETE FROM note_chunks WHERE note = old.name;
+        END
+        """
     )
+
+
+def create_links_tables(connection: Connection):
+    """
+    Create the tables that index links and tags (see links.py), and the trigger
+    that cleans them up
+    """
+
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS links(
+            source TEXT NOT NULL,
+            target TEXT NOT NULL,
+            PRIMARY KEY (source, target)
+        ) WITHOUT ROWID
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE INDEX IF NOT EXISTS links_target ON links(target, source)
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tags(
+            note TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (note, tag)
+        ) WITHOUT ROWID
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE INDEX IF NOT EXISTS tags_tag ON tags(tag, note)
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_links_delete
+        AFTER DELETE ON notes BEGIN
+            DELETE FROM links WHERE source = old.name;
+            DELETE FROM tags WHERE note = old.name;
+        END
+        """
+    )
+
+
+def create_blobs_table(connection: Connection):
+    """
+    Create the table that holds note content by its hash (see blobs.py), and
+    the triggers that count the notes referring to each blob
+
+    Chunked notes keep their content in note_chunks, so they aren't counted.
+    """
+
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS blobs(
+            hash TEXT PRIMARY KEY,
+            content TEXT,
+            codec TEXT,
+            refs INTEGER NOT NULL
+        )
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE INDEX IF NOT EXISTS blobs_unreferenced ON blobs(hash) WHERE refs = 0
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_blobs_insert
+        AFTER INSERT ON notes WHEN new.codec IS NOT 'chunked' BEGIN
+            UPDATE blobs SET refs = refs + 1 WHERE hash = new.content_hash;
+        END
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_blobs_delete
+        AFTER DELETE ON notes WHEN old.codec IS NOT 'chunked' BEGIN
+            UPDATE blobs SET refs = refs - 1 WHERE hash = old.content_hash;
+        END
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_blobs_update
+        AFTER UPDATE OF content_hash, codec ON notes
+        WHEN old.content_hash IS NOT new.content_hash
+            OR (old.codec IS 'chunked') IS NOT (new.codec IS 'chunked')
+        BEGIN
+            UPDATE blobs SET refs = refs - 1
+            WHERE hash = old.content_hash AND old.codec IS NOT 'chunked';
+            UPDATE blobs SET refs = refs + 1
+            WHERE hash = new.content_hash AND new.codec IS NOT 'chunked';
+        END
+        """
+    )
+
+
+def create_sync_tables(connection: Connection):
+    """
+    Create the tables that replication to other devices uses (see sync.py)
+    """
+
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_outbox(
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL,
+            name TEXT NOT NULL,
+            stamp INTEGER NOT NULL,
+            expires TIMESTAMP
+        )
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_notes(
+            name TEXT PRIMARY KEY,
+            stamp INTEGER NOT NULL,
+            device TEXT NOT NULL
+        ) WITHOUT ROWID
+        """
+    )
+
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_peers(
+            device TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            seq INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """
+    )
+
+
+def hash_row(content: str | bytes | None, codec: str | None) -> tuple[str]:
+    """
+    Hash one row's decoded content (a backfill conversion)
+    """
+
+    return (storage.content_hash(storage.decode_content(content, codec)),)
+
+
+# Every migration, in order: MIGRATIONS[n] migrates from version n to n + 1
+MIGRATIONS: tuple[Migration, ...] = (
+    Migration(
+        1,
+        schema=migrate_v0_to_v1,
+        backfills=(
+            Backfill(
+                "Setting expiration dates",
+                "notes",
+                update="expires = date_modified",
+                where="deleted = 0",
+            ),
+        ),
+    ),
+    Migration(2, schema=migrate_v1_to_v2),
+    Migration(
+        3,
+        schema=migrate_v2_to_v3,
+        backfills=(
+            Backfill(
+                "Indexing notes for search",
+                "notes",
+                columns=("rowid", "name", "content"),
+                apply=index_search_row,
+            ),
+        ),
+    ),
+    Migration(4, schema=migrate_v3_to_v4),
+    Migration(
+        5,
+        schema=migrate_v4_to_v5,
+        backfills=(
+            Backfill(
+                "Compressing notes",
+                "notes",
+                update="content = ?, codec = ?",
+                columns=("content",),
+                convert=storage.encode_content,
+                where="content IS NOT NULL",
+            ),
+            Backfill(
+                "Compressing revisions",
+                "revisions",
+                update="data = ?, codec = ?",
+                columns=("data",),
+                convert=storage.encode_content,
+                where="keyframe = 1",
+            ),
+            Backfill(
+                "Indexing notes for search",
+                "notes",
+                columns=("rowid", "name", "content", "codec"),
+                apply=index_search_row,
+            ),
+        ),
+        finish=create_search_triggers_v5,
+    ),
+    Migration(
+        6,
+        schema=migrate_v5_to_v6,
+        backfills=(
+            Backfill(
+                "Hashing notes",
+                "notes",
+                update="content_hash = ?",
+                columns=("content", "codec"),
+                convert=hash_row,
+            ),
+        ),
+    ),
+    Migration(7, schema=migrate_v6_to_v7),
+    Migration(
+        8,
+        schema=migrate_v7_to_v8,
+        backfills=(
+            Backfill(
+                "Indexing notes for search",
+                "notes",
+                columns=("rowid", "name", "content", "codec"),
+                apply=index_search_row,
+                after_vacuum=True,
+            ),
+        ),
+        vacuum=vacuum_v7_to_v8,
+    ),
+    Migration(9, schema=migrate_v8_to_v9),
+    Migration(
+        10,
+        schema=create_links_tables,
+        backfills=(
+            Backfill(
+                "Indexing links and tags",
+                "notes",
+                columns=("name", "content", "codec"),
+                apply=index_links_row,
+            ),
+        ),
+    ),
+    Migration(
+        11,
+        schema=migrate_v10_to_v11,
+        backfills=(
+            Backfill(
+                "Deduplicating note content",
+                "notes",
+                columns=("name", "content", "codec", "content_hash"),
+                apply=move_to_blob,
+                where="codec IS NOT 'chunked'",
+            ),
+        ),
+        vacuum=purge.vacuum,
+    ),
+    Migration(12, schema=create_sync_tables),
+)
+
+LATEST_DB_VERSION: int = len(MIGRATIONS)
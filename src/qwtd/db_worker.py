@@ -0,0 +1,122 @@
+"""
+Run the editor's database work on worker threads, so the UI never waits on it
+"""
+
+import asyncio
+import sqlite3
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Concatenate, ParamSpec, TypeVar
+
+from qwtd.db_wrapper import connect
+from qwtd.profiler import Profiler
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+class DatabaseWorker:
+    """
+    Owns the editor's connections, each on its own worker thread
+
+    Everything that writes runs on the writer thread, one job at a time and in
+    the order the jobs were submitted, so saves never interleave. A second,
+    read-only connection has a thread of its own, so reads (such as refreshing
+    the note catalog) can run while a save is in progress (WAL mode means
+    neither blocks the other).
+
+    A third read-only connection is for the UI thread's own quick lookups (the
+    chunked note viewer and the note selector's tag filter), so that those never
+    wait behind a reader job such as loading the note catalog.
+
+    Jobs are functions taking the connection as their first argument, and are
+    awaited from the UI's event loop.
+    """
+
+    def __init__(
+        self, connection: sqlite3.Connection, profiler: Profiler | None = None
+    ):
+        """
+        Create a new DatabaseWorker, opening the read-only connections
+
+        :param connection: Connection to write with, which the worker owns from
+            now on
+        :type connection: sqlite3.Connection
+        :param profiler: Profiler to time the read connections' statements with
+        :type profiler: Profiler
+        """
+
+        self.connection: sqlite3.Connection = connection
+
+        db_path: str = connection.execute("PRAGMA database_list").fetchone()[2]
+        self.read_connection: sqlite3.Connection = connect(db_path, profiler)
+        self.read_connection.execute("PRAGMA query_only=ON")
+
+        self.ui_connection: sqlite3.Connection = connect(db_path, profiler)
+        self.ui_connection.execute("PRAGMA query_only=ON")
+        # Held while using the UI connection. Reader jobs only take it to open
+        # a ChunkedNote on it (a single small query).
+        self.ui_lock: threading.Lock = threading.Lock()
+
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="qwtd-db-write")
+        self._reader = ThreadPoolExecutor(1, thread_name_prefix="qwtd-db-read")
+
+        # Jobs that have been submitted but haven't finished, for the UI to show
+        self.pending_writes: int = 0
+        self.pending_reads: int = 0
+
+    async def write(
+        self,
+        func: Callable[Concatenate[sqlite3.Connection, P], T],
+        *args: P.args,
+        **kwargs: P.kwargs,
+    ) -> T:
+        """
+        Run func(connection, *args, **kwargs) on the writer thread
+        """
+
+        self.pending_writes += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._writer, lambda: func(self.connection, *args, **kwargs)
+            )
+        finally:
+            self.pending_writes -= 1
+
+    async def read(
+        self,
+        func: Callable[Concatenate[sqlite3.Connection, P], T],
+        *args: P.args,
+        **kwargs: P.kwargs,
+    ) -> T:
+        """
+        Run func(read_connection, *args, **kwargs) on the reader thread
+        """
+
+        self.pending_reads += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._reader, lambda: func(self.read_connection, *args, **kwargs)
+            )
+        finally:
+            self.pending_reads -= 1
+
+    def is_busy(self) -> bool:
+        """
+        Check whether any job is still running (or waiting to)
+        """
+
+        return self.pending_writes > 0 or self.pending_reads > 0
+
+    def close(self) -> None:
+        """
+        Wait for every job to finish, then close the read connections (the
+        write connection belongs to whoever opened it)
+        """
+
+        self._writer.shutdown(wait=True)
+        self._reader.shutdown(wait=True)
+
+        self.read_connection.close()
+        self.ui_connection.close()
@@ -5,33 +5,118 @@ Wrapper around TUI app to ensure the proper closing of the database.
 import os
 import sqlite3
 
-from qwtd import app
 from qwtd import config
 from qwtd import db_setup
+from qwtd import storage
+from qwtd.profiler import Profiler
+from qwtd.startup import StartupTrace
 
+# How long to wait for another connection (e.g. another qwtd instance) to finish
+# writing before giving up with "database is locked", in seconds. Only writers
+# ever wait: in WAL mode, readers never block or get blocked.
+BUSY_TIMEOUT: float = 10.0
 
-def run_with_db() -> None:
+
+def connect(db_path: str, profiler: Profiler | None = None) -> sqlite3.Connection:
     """
-    Open a connection to the database, run the app, and close connection when done
+    Open a connection to the database file, without checking its schema
+
+    Every connection to the database (including ones used by background threads)
+    should be made through this function.
+
+    :param profiler: Profiler to time every statement run on the connection with
+    :type profiler: Profiler
+    """
+
+    if profiler is None:
+        profiler = Profiler(False)
+
+    # The editor's connections are used from its DatabaseWorker's threads
+    connection = sqlite3.connect(
+        db_path,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+        check_same_thread=False,
+        timeout=BUSY_TIMEOUT,
+        factory=profiler.connection_factory(),
+    )
+    storage.register_functions(connection)
+
+    # In WAL mode, readers and writers don't block each other and commits don't
+    # wait on fsync (with synchronous=NORMAL), so saving doesn't stall the UI
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+
+    return connection
+
+
+def open_db(
+    trace: StartupTrace | None = None, profiler: Profiler | None = None
+) -> sqlite3.Connection:
+    """
+    Open a connection to the database and bring it up to the latest schema
+
+    :param trace: Startup trace to record the connect and migrate phases in
+    :type trace: StartupTrace
+    :param profiler: Profiler to time every statement run on the connection with
+        (including migrations)
+    :type profiler: Profiler
     """
 
-    db_path = config.get_db_path()
+    if trace is None:
+        trace = StartupTrace(False)
+
+    with trace.phase("config"):
+        db_path = config.get_db_path()
 
     first_open: bool = not os.path.exists(db_path)
 
     print(f"[QWTD] Opening database at {db_path}")
 
-    connection = sqlite3.connect(
-        db_path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
-    )
+    with trace.phase("connect"):
+        connection = connect(db_path, profiler)
 
     try:
-        db_setup.ensure_db(connection, first_open)
+        with trace.phase("migrate"):
+            db_setup.ensure_db(connection, first_open)
+    except BaseException:
+        connection.close()
+        raise
+
+    return connection
+
+
+def run_with_db(startup_trace: bool = False, profile: str | None = None) -> None:
+    """
+    Open a connection to the database, run the app, and close connection when done
 
-        db_setup.delete_expired_notes(connection)
+    :param startup_trace: Whether to report how long each phase of startup took
+    :type startup_trace: bool
+    :param profile: Where to write a profile of the session (overriding the
+        config's `profile`), or None to use the config
+    :type profile: str
+    """
+
+    trace = StartupTrace(startup_trace)
+
+    if profile is None:
+        profile = config.get_config().profile
+    profiler = Profiler(bool(profile), profile)
+
+    connection = open_db(trace, profiler)
+
+    try:
+        # prompt_toolkit is by far the slowest import, so only pay for it once
+        # everything before it has succeeded
+        with trace.phase("import"):
+            from qwtd import app
 
         # Launch app
-        app.run_app(connection)
+        app.run_app(connection, trace, profiler)
     finally:
         print("[QWTD] Closing db connection.")
         connection.close()
+
+        trace.report()
+
+        profiler.write()
+        profiler.report()
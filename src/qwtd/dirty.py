@@ -0,0 +1,88 @@
+"""
+Track whether a buffer has changed since it was last saved
+"""
+
+import hashlib
+
+from prompt_toolkit.buffer import Buffer
+
+
+def digest(text: str) -> bytes:
+    """
+    Hash text for comparison with the saved version of a note
+    """
+
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass")).digest()
+
+
+class DirtyTracker:
+    """
+    Tracks unsaved changes to a buffer without keeping a copy of its text
+
+    Every change to the buffer bumps a generation counter. As long as the
+    generation matches the one that was saved (or last checked), whether the
+    buffer is dirty is already known. Otherwise, the text is compared to the
+    saved version by length, and only if the lengths are equal, by hash. This
+    means the check runs at most once per edit, no matter how often the UI
+    asks for it, and most edits (which change the length) never hash anything.
+    """
+
+    def __init__(self, buffer: Buffer):
+        """
+        Create a new DirtyTracker and start following changes to the buffer
+
+        :param buffer: The buffer to track
+        :type buffer: prompt_toolkit.buffer.Buffer
+        """
+
+        self.buffer: Buffer = buffer
+        self.generation: int = 0
+
+        self._saved_length: int = len(buffer.text)
+        self._saved_digest: bytes = digest(buffer.text)
+
+        self._checked_generation: int = 0
+        self._dirty: bool = False
+
+        buffer.on_text_changed += self._on_text_changed
+
+    def mark_saved(self, text: str) -> None:
+        """
+        Record the text that was just saved as the clean state of the buffer
+
+        :param text: The saved text (normally the buffer's current text)
+        :type text: str
+        """
+
+        self._saved_length = len(text)
+        self._saved_digest = digest(text)
+
+        if text is self.buffer.text:
+            self._checked_generation = self.generation
+            self._dirty = False
+        else:
+            # The buffer changed while saving; compare on the next check
+            self._checked_generation = self.generation - 1
+
+    def is_dirty(self) -> bool:
+        """
+        Check whether the buffer has changed since it was last saved
+        """
+
+        if self._checked_generation == self.generation:
+            return self._dirty
+
+        text = self.buffer.text
+
+        if len(text) != self._saved_length:
+            dirty = True
+        else:
+            dirty = digest(text) != self._saved_digest
+
+        self._checked_generation = self.generation
+        self._dirty = dirty
+
+        return dirty
+
+    def _on_text_changed(self, _: Buffer) -> None:
+        self.generation += 1
@@ -2,14 +2,20 @@
 Class for handling the state of the text editor
 """
 
+import asyncio
 import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
 from datetime import datetime
-from sqlite3 import Connection, Cursor
+from sqlite3 import Connection
 
 from prompt_toolkit import Application
 from prompt_toolkit.application import get_app
 from prompt_toolkit.buffer import Buffer
-from prompt_toolkit.completion import WordCompleter
 from prompt_toolkit.filters import Condition
 from prompt_toolkit.formatted_text import FormattedText
 from prompt_toolkit.key_binding import KeyBindings, KeyPressEvent
@@ -17,8 +23,38 @@ from prompt_toolkit.key_binding.vi_state import InputMode
 from prompt_toolkit.layout import UIControl
 from prompt_toolkit.widgets import TextArea
 
+from qwtd import backup
+from qwtd import catalog
+from qwtd import changelog
 from qwtd import config
 from qwtd import dateutils
+from qwtd import export
+from qwtd import links
+from qwtd import merge
+from qwtd import notes
+from qwtd import purge
+from qwtd import revisions
+from qwtd import sync
+from qwtd.catalog import NoteCatalog, NoteEntry
+from qwtd.chunks import ChunkedNote
+from qwtd.content_cache import ContentCache
+from qwtd.db_worker import DatabaseWorker
+from qwtd.db_wrapper import connect
+from qwtd.dirty import DirtyTracker
+from qwtd.links import NoteLinks
+from qwtd.name_completer import NoteNameCompleter
+from qwtd.profiler import Profiler, profiled
+from qwtd.viewer import ChunkedNoteControl
+
+# How many notes' completion menu text to keep formatted
+COMPLETION_META_CACHE_SIZE: int = 500
+
+# How many of the most recently modified notes to load into the content cache
+# at startup
+CONTENT_CACHE_WARM_NOTES: int = 20
+
+# Only start a scheduled backup once typing has been idle for this many seconds
+BACKUP_IDLE_DELAY: float = 30.0
 
 
 class Editor:
@@ -31,30 +67,59 @@ class Editor:
         connection: Connection,
         text_area: TextArea,
         note_name_buff: Buffer,
-        note_name_completer: WordCompleter,
+        note_name_completer: NoteNameCompleter,
         export_buff: Buffer,
+        profiler: Profiler | None = None,
     ):
         """
         Create a new Editor
 
-        :param connection: Connection to the database
+        :param connection: Connection to the database, which the editor's
+            DatabaseWorker owns from now on
         :type connection: sqlite3.Connection
         :param text_area: Main editor text area
         :type text_area: TextArea
+        :param profiler: Profiler to record the editor's operations in
+        :type profiler: Profiler
         """
 
-        self.connection: Connection = connection
+        self.profiler: Profiler = profiler if profiler is not None else Profiler(False)
+        # Every use of the database goes through the worker, so it never blocks
+        # the UI
+        self.worker: DatabaseWorker = DatabaseWorker(connection, self.profiler)
         self.text_area: TextArea = text_area
         self.note_name_buff: Buffer = note_name_buff
-        self.note_name_completer: WordCompleter = note_name_completer
+        self.note_name_completer: NoteNameCompleter = note_name_completer
         self.export_buff: Buffer = export_buff
 
+        # Only used on the worker's reader thread (apart from mark_changed)
+        self.catalog: NoteCatalog = NoteCatalog(self.worker.read_connection)
+        # The catalog's entries as of the last update_name_completer, for the
+        # UI thread (the catalog changes them on the reader thread)
+        self.note_entries: dict[str, NoteEntry] = {}
+
+        # Formatted completion menu text of the notes shown most recently, see
+        # completion_meta
+        self.completion_meta_cache: OrderedDict[str, tuple[NoteEntry, str]] = (
+            OrderedDict()
+        )
+        note_name_completer.display_meta = self.completion_meta
+        note_name_completer.tag_filter = self.notes_with_tag
+
+        # Content of recently opened (or prefetched) notes, valid as long as
+        # the writer connection's data_version doesn't change
+        self.content_cache: ContentCache = ContentCache(
+            config.get_config().content_cache_size
+        )
+        # Prefetch the note highlighted in the selector while moving through it
+        note_name_buff.on_text_changed += self.prefetch_highlighted
+
         def handle_command(buff: Buffer) -> bool:
             """
             Handle when enter is pressed in the command line
             """
 
-            self.handle_command(buff.text)
+            get_app().create_background_task(self.handle_command(buff.text))
 
             get_app().layout.focus(self.last_focused)
             get_app().vi_state.input_mode = InputMode.NAVIGATION
@@ -69,224 +134,912 @@ class Editor:
 
         self.current_note_deleted: bool = False
         self.current_note: str | None = None
-        self.last_saved_content: str = ""
+        # The version of the current note that the text is based on, and its
+        # content at that version (the base of a merge if the note is saved
+        # elsewhere in the meantime). The writer thread uses them too, so they
+        # (and current_note) are only changed holding note_lock.
+        self.note_lock: threading.Lock = threading.Lock()
+        self.current_version: int = 0
+        self.base_content: str = ""
+        # Does the text have merge conflicts that the user hasn't resolved?
+        self.has_conflicts: bool = False
+        self.dirty: DirtyTracker = DirtyTracker(self.text_area.buffer)
         self.current_expiration: datetime = datetime.now()
 
         # Should the export dialog be open currently?
         self.is_exporting: bool = False
+        # Is the export dialog exporting every note rather than the current one?
+        self.is_exporting_all: bool = False
+
+        # Short message shown in the status bar (e.g. the result of an export)
+        self.message: str | None = None
+
+        # Is the note selector searching note content rather than names?
+        self.is_searching: bool = False
+
+        # Is the panel with the current note's tags and backlinks shown, and
+        # what it shows (loaded when the note is opened or saved)
+        self.show_links: bool = False
+        self.links: NoteLinks | None = None
 
         self.last_focused: UIControl = self.text_area.control
 
-    def update_name_completer(self) -> None:
+        # Chunked (very large) notes are shown read-only in this viewer instead
+        # of being loaded into the text area
+        self.viewer: ChunkedNoteControl = ChunkedNoteControl()
+
+        # Set whenever the text changes, to (re)start the autosave idle timer
+        self.autosave_event: asyncio.Event = asyncio.Event()
+        self.text_area.buffer.on_text_changed += lambda _: self.autosave_event.set()
+
+        # When the text last changed (a time.monotonic()), so that backups wait
+        # until the user isn't typing
+        self.last_edit: float = time.monotonic()
+        self.text_area.buffer.on_text_changed += self.record_edit
+
+    @profiled
+    async def update_name_completer(self) -> None:
         """
-        Update the list of note names in the note name completer from the database
+        Update the note name completer's index from the catalog
+
+        Only the notes that changed since the last update are re-indexed,
+        unless the catalog had to be reloaded.
         """
 
-        res = self.connection.execute(
-            """
-            SELECT
-                name,
-                date_modified,
-                deleted,
-                expires
-            FROM notes ORDER BY date_modified DESC
-            """
-        )
+        # Only the connection that saves notes can tell whether anyone else
+        # changed the database (see NoteCatalog.refresh)
+        data_version = await self.worker.write(catalog.read_data_version)
+        changed, entries = await self.worker.read(self.refresh_catalog, data_version)
+
+        completer = self.note_name_completer
+        if changed is None:
+            self.note_entries = {
+                name: entry for name, entry in entries if entry is not None
+            }
+            completer.rebuild(
+                (name, entry.date_modified)
+                for name, entry in self.note_entries.items()
+            )
+        else:
+            for name, entry in entries:
+                if entry is None:
+                    self.note_entries.pop(name, None)
+                    completer.remove(name)
+                else:
+                    self.note_entries[name] = entry
+                    completer.update(name, entry.date_modified)
+
+        # Forget the menu text of changed notes; it's recomputed when next shown
+        if changed is None:
+            self.completion_meta_cache.clear()
+        else:
+            for name in changed:
+                self.completion_meta_cache.pop(name, None)
 
-        notes = res.fetchall()
-        self.note_name_completer.words = [tup[0] for tup in notes]
-
-        # Track the longest name to make the completions menu a constant width
-        name_col_width = max([len(tup[0]) for tup in notes])
-
-        self.note_name_completer.display_dict = {}
-        for note in notes:
-            name: str
-            date_modified: datetime
-            deleted: int
-            expires: datetime
-
-            name, date_modified, deleted, expires = note
-            if deleted == 1:
-                self.note_name_completer.display_dict[name] = FormattedText(
-                    [
-                        (
-                            "class:completion-menu.completion",
-                            name.ljust(name_col_width + 1),
-                        ),
-                        (
-                            "class:completion-menu.completion fg:ansired",
-                            f"Deleted - expires {
-                                expires.strftime('%Y-%m-%d %H:%M:%S')
-                            } ({(dateutils.fmtdelta(expires - datetime.now()))})",
-                        ),
-                    ]
-                )
-            else:
-                self.note_name_completer.display_dict[name] = FormattedText(
-                    [
-                        (
-                            "class:completion-menu.completion",
-                            name.ljust(name_col_width + 1),
-                        ),
-                        (
-                            "class:completion-menu.completion",
-                            f"Modified {date_modified.strftime('%Y-%m-%d %H:%M:%S')}",
-                        ),
-                    ]
-                )
+    def refresh_catalog(
+        self, connection: Connection, data_version: int
+    ) -> tuple[set[str] | None, list[tuple[str, NoteEntry | None]]]:
+        """
+        Bring the catalog up to date (a job for the reader thread)
+
+        :return: The names of the notes that changed (or None if the catalog was
+            reloaded), and the entries of those notes (or of every note), which
+            are None for notes that no longer exist
+        """
+
+        changed = self.catalog.refresh(data_version)
+        names = self.catalog.entries if changed is None else changed
+
+        return changed, [(name, self.catalog.entries.get(name)) for name in names]
+
+    def notes_with_tag(self, prefix: str) -> set[str]:
+        """
+        Get the notes with a tag starting with prefix, for the note selector
 
-    def open_note(self, note_name: str):
+        This is called from the completer on the UI thread, so it uses the
+        worker's UI connection (like the chunked note viewer) rather than
+        waiting on the reader thread: it's a single index lookup.
+        """
+
+        with self.worker.ui_lock:
+            return links.notes_with_tag(self.worker.ui_connection, prefix)
+
+    def completion_meta(self, name: str) -> FormattedText:
+        """
+        Get the text shown next to a note in the completion menu
+
+        This is called every time the menu is rendered, for every completion
+        (not only the visible ones: the menu measures them all to size its
+        column), so up to the completer's limit per render. The dates are
+        formatted once per note (keeping only the COMPLETION_META_CACHE_SIZE
+        most recently shown), but the time left before a deleted note expires
+        is recomputed on every render.
+        """
+
+        cache = self.completion_meta_cache
+        cached = cache.get(name)
+
+        if cached is None:
+            entry = self.note_entries.get(name)
+            if entry is None:
+                return FormattedText([])
+
+            cached = (entry, self.format_completion(entry))
+            cache[name] = cached
+            if len(cache) > COMPLETION_META_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(name)
+
+        entry, text = cached
+
+        if entry.deleted:
+            delta = dateutils.fmtdelta(entry.expires - datetime.now())
+            return FormattedText([("fg:ansired", f"{text} ({delta})")])
+        else:
+            return FormattedText([("", text)])
+
+    def format_completion(self, entry: NoteEntry) -> str:
+        """
+        Format the (unchanging part of the) completion menu text for a note
+        """
+
+        if entry.deleted:
+            return f"Deleted - expires {entry.expires.strftime('%Y-%m-%d %H:%M:%S')}"
+        else:
+            return f"Modified {entry.date_modified.strftime('%Y-%m-%d %H:%M:%S')}"
+
+    @profiled
+    async def open_note(self, note_name: str):
         """
         Open a note and update its content in the textarea
+
+        Notes in the content cache are opened without reading them again.
         """
 
-        cursor: Cursor = self.connection.execute(
-            """
-            SELECT content, deleted, expires FROM notes WHERE name=?
-            """,
+        result: tuple[str | ChunkedNote, bool, datetime, int] | None = None
+
+        if self.content_cache.max_bytes:
+            data_version = await self.worker.write(catalog.read_data_version)
+            result = self.content_cache.get(note_name, data_version)
+
+            if result is None:
+                result = await self.worker.read(self.read_note, note_name)
+                self.cache_note(note_name, result, data_version)
+        else:
+            result = await self.worker.read(self.read_note, note_name)
+
+        content: str | ChunkedNote
+        if result is None:
+            content = notes.new_note_content(note_name)
+            self.current_note_deleted = False
+            version = 0
+        else:
+            content, self.current_note_deleted, self.current_expiration, version = (
+                result
+            )
+
+        with self.note_lock:
+            self.current_note = note_name
+            self.current_version = version
+            self.base_content = content if isinstance(content, str) else ""
+
+        self.has_conflicts = False
+
+        if isinstance(content, ChunkedNote):
+            self.viewer.open(content)
+            self.text_area.buffer.text = ""
+        else:
+            self.viewer.open(None)
+            self.text_area.buffer.text = content
+
+            if result is None:
+                self.text_area.control.move_cursor_down()
+                self.text_area.control.move_cursor_down()
+
+        self.dirty.mark_saved(self.text_area.buffer.text)
+
+        self.links = None
+        if self.show_links:
+            get_app().create_background_task(self.refresh_links())
+
+        get_app().vi_state.input_mode = InputMode.NAVIGATION
+
+    def read_note(
+        self, connection: Connection, note_name: str
+    ) -> tuple[str | ChunkedNote, bool, datetime, int] | None:
+        """
+        Read a note to open it (a job for the reader thread)
+
+        Chunked notes aren't read, but opened as a ChunkedNote for the viewer,
+        which loads their chunks as they are shown. The viewer reads them on the
+        UI thread, so it uses the worker's UI connection.
+
+        :return: As notes.read_note
+        """
+
+        if not notes.is_chunked(connection, note_name):
+            return notes.read_note(connection, note_name)
+
+        deleted, expires, version = connection.execute(
+            "SELECT deleted, expires, version FROM notes WHERE name = ?",
             (note_name,),
+        ).fetchone()
+
+        chunked = ChunkedNote(
+            self.worker.ui_connection, note_name, self.worker.ui_lock
         )
 
-        self.current_note_deleted = False
+        return chunked, deleted != 0, expires, version
 
-        result: tuple[str, int, datetime] | None = cursor.fetchone()
-        if result:
-            self.text_area.buffer.text = result[0]
-            self.current_note_deleted = result[1] != 0
-            self.current_expiration = result[2]
+    def cache_note(
+        self,
+        name: str,
+        result: tuple[str | ChunkedNote, bool, datetime, int] | None,
+        data_version: int,
+    ):
+        """
+        Add a note read with read_note to the content cache (unless it doesn't
+        exist, or is chunked)
+        """
+
+        if result is None:
+            return
+
+        content, deleted, expires, version = result
+        if isinstance(content, str):
+            self.content_cache.put(
+                name, (content, deleted, expires, version), data_version
+            )
+
+    async def prefetch(self, names: list[str]):
+        """
+        Load notes into the content cache in the background
+        """
+
+        names = [name for name in names if name not in self.content_cache]
+        if not names or not self.content_cache.max_bytes:
+            return
+
+        data_version = await self.worker.write(catalog.read_data_version)
+
+        for name in names:
+            if name not in self.content_cache:
+                result = await self.worker.read(self.read_note, name)
+                self.cache_note(name, result, data_version)
+
+    def prefetch_highlighted(self, buff: Buffer):
+        """
+        Prefetch the note highlighted in the note selector's completion menu
+
+        Moving through the menu replaces the buffer's text with the highlighted
+        note's name (and complete_state isn't set yet when that happens), so
+        any text that names an existing note is prefetched.
+        """
+
+        name = buff.text
+        if name in self.note_name_completer and name not in self.content_cache:
+            get_app().create_background_task(self.prefetch([name]))
+
+    async def warm_content_cache(self):
+        """
+        Load the most recently modified notes into the content cache (after the
+        catalog is loaded)
+        """
+
+        names = await self.worker.read(
+            lambda _: [
+                name
+                for name in self.catalog.names()[: CONTENT_CACHE_WARM_NOTES * 2]
+                if not self.catalog.entries[name].deleted
+            ][:CONTENT_CACHE_WARM_NOTES]
+        )
+
+        await self.prefetch(names)
+
+    def is_viewing(self) -> bool:
+        """
+        Check whether the current note is a chunked note shown in the viewer
+        """
+
+        return self.viewer.note is not None
+
+    @profiled
+    async def edit_chunked(self):
+        """
+        Load the whole of the chunked note in the viewer into the text area, so
+        that it can be edited
+
+        Saving it stores it in chunks again (only rewriting the chunks that
+        changed), as long as it's still at least chunk_threshold bytes long.
+        """
+
+        note = self.current_note
+        if note is None or not self.is_viewing():
+            return
+
+        self.message = "Loading the whole note..."
+        get_app().invalidate()
+
+        result = await self.worker.read(notes.read_note, note)
+        if self.current_note != note or not self.is_viewing():
+            return
+
+        if result is None:
+            # Permanently deleted since it was opened
+            content, version = "", 0
         else:
-            self.text_area.buffer.text = f"# {note_name}\n\n"
-            self.text_area.control.move_cursor_down()
-            self.text_area.control.move_cursor_down()
+            content, self.current_note_deleted, self.current_expiration, version = (
+                result
+            )
+
+        with self.note_lock:
+            self.current_version = version
+            self.base_content = content
+
+        line = self.viewer.cursor_line
+        self.viewer.open(None)
+        self.text_area.buffer.text = content
+        self.text_area.buffer.cursor_position = (
+            self.text_area.document.translate_row_col_to_index(line, 0)
+        )
+        self.dirty.mark_saved(content)
+        self.message = None
 
-        self.current_note = note_name
-        self.last_saved_content = self.text_area.buffer.text
+        get_app().layout.focus(self.text_area)
 
-        get_app().vi_state.input_mode = InputMode.NAVIGATION
+    def body(self) -> TextArea | ChunkedNoteControl:
+        """
+        Get whatever shows the current note (to focus it)
+        """
 
-    def write(self):
+        return self.viewer if self.is_viewing() else self.text_area
+
+    async def write(self) -> bool:
         """
         Write the current note to the database
+
+        If the note was saved elsewhere since it was opened (or last saved), the
+        changes are merged instead (see merge_saved_elsewhere).
+
+        :return: Whether the note was saved (or there was nothing to save,
+            since the viewer is read-only)
         """
-        if self.current_note is None:
+        if self.current_note is None or self.is_viewing():
+            return True
+
+        note, content = self.current_note, self.text_area.text
+
+        try:
+            await self.worker.write(self.save_note, note, content)
+        except notes.ConflictError:
+            return await self.merge_saved_elsewhere()
+        except sqlite3.OperationalError as e:
+            # Most likely another instance held the write lock for too long
+            self.message = f"Error: Couldn't save ({e})"
+            return False
+
+        self.catalog.mark_changed(note)
+
+        if self.current_note == note:
+            self.dirty.mark_saved(content)
+            self.has_conflicts = False
+
+            # Saving re-indexes the note's tags
+            if self.show_links:
+                await self.refresh_links()
+
+        return True
+
+    async def refresh_links(self):
+        """
+        Load the current note's tags and backlinks for the links panel
+        """
+
+        note = self.current_note
+        if note is None:
             return
 
-        data = {
-            "name": self.current_note,
-            "content": self.text_area.text,
-            "date_modified": datetime.now(),
-        }
+        result = await self.worker.read(links.note_links, note)
 
-        self.connection.execute(
-            """
-            INSERT OR REPLACE
-            INTO notes (name, content, date_modified, deleted, expires)
-            VALUES(:name, :content, :date_modified, 0, :date_modified)
-            """,
-            data,
-        )
+        if self.current_note == note:
+            self.links = result
+            get_app().invalidate()
+
+    @profiled
+    def save_note(self, connection: Connection, note: str, content: str):
+        """
+        Save content to a note in the database and commit (a job for the writer
+        thread)
+
+        If note is the current note, the save only goes through if nobody else
+        saved it since current_version.
+
+        :raises notes.ConflictError: If someone else saved the note since
+        """
+
+        # Only the current note's version is known. Other notes (e.g. one that
+        # was being autosaved as another was opened) are overwritten.
+        with self.note_lock:
+            is_current = note == self.current_note
+            version = self.current_version if is_current else None
+
+        now = datetime.now()
+
+        # Whatever goes wrong, don't leave the write transaction (and the write
+        # lock) open for the next job to carry on in
+        try:
+            new_version = notes.save_note(connection, note, content, now, version)
+        except BaseException:
+            connection.rollback()
+            raise
+
+        connection.commit()
+
+        # Saving doesn't change this connection's data_version, so the cached
+        # copy is still valid once it's replaced (saving restores deleted notes
+        # and sets expires to the modification date, like UPSERT_NOTE)
+        if self.content_cache.max_bytes:
+            self.content_cache.put(
+                note,
+                (content, False, now, new_version),
+                catalog.read_data_version(connection),
+            )
+
+        with self.note_lock:
+            if note == self.current_note:
+                self.current_version = new_version
+                self.base_content = content
+
+    async def merge_saved_elsewhere(self) -> bool:
+        """
+        Merge the changes saved elsewhere (e.g. in another qwtd instance) into
+        the text, after a save found that the current note had changed
+
+        The merge is three-way, from the content the text was based on. If it's
+        clean, the merged text is saved. Otherwise, the text is left with
+        conflict markers for the user to resolve before saving again.
+
+        :return: Whether the merged text was saved
+        """
+
+        note = self.current_note
+        assert note is not None
+
+        result = await self.worker.write(notes.read_note, note)
+        if self.current_note != note:
+            return False
 
-        self.last_saved_content = self.text_area.text
-        self.connection.commit()
+        # Merge into whatever has been typed in the meantime
+        with self.note_lock:
+            if result is None:
+                # Permanently deleted elsewhere, so there's nothing to merge
+                self.current_version = 0
+                theirs = ""
+                merged, conflicts = self.text_area.text, 0
+            else:
+                theirs, deleted, expires, self.current_version = result
+                merged, conflicts = merge.merge3(
+                    self.base_content, self.text_area.text, theirs
+                )
+                self.current_note_deleted = deleted
+                self.current_expiration = expires
+
+            self.base_content = theirs
+
+        self.text_area.buffer.text = merged
+        self.dirty.mark_saved(theirs)
+
+        if conflicts:
+            self.has_conflicts = True
+            self.message = (
+                f"Saved elsewhere: resolve {conflicts} "
+                f"conflict{dateutils.pluralstr(conflicts)}, then save"
+            )
+            return False
+
+        self.message = "Merged changes saved elsewhere"
+        return await self.write()
+
+    async def autosave_loop(self):
+        """
+        Save the current note in the background once typing has been idle for
+        autosave_delay seconds
+
+        This runs as a background task for the lifetime of the app. The database
+        work happens on the writer thread, so saving never blocks typing.
+        """
+
+        delay = config.get_config().autosave_delay
+        if delay <= 0:
+            return
+
+        while True:
+            await self.autosave_event.wait()
+            self.autosave_event.clear()
+
+            # Keep waiting until nothing has changed for a whole delay
+            while True:
+                try:
+                    await asyncio.wait_for(self.autosave_event.wait(), delay)
+                except TimeoutError:
+                    break
+                self.autosave_event.clear()
+
+            # Deleted notes are only saved explicitly, since saving restores
+            # them, and so is text with merge conflicts in it
+            if self.current_note_deleted or self.has_conflicts or not self.unsaved():
+                continue
+
+            await self.write()
+            get_app().invalidate()
+
+    async def purge_loop(self):
+        """
+        Permanently delete expired notes in the background: once right after
+        startup, then every purge_interval seconds
+
+        This runs as a background task for the lifetime of the app, on its own
+        connection and thread, so that saves don't wait for a whole purge. The
+        note that is currently open is never purged out from under the editor.
+        """
+
+        loop = asyncio.get_running_loop()
+        interval = config.get_config().purge_interval
+
+        def run() -> list[str]:
+            connection = connect(config.get_db_path(), self.profiler)
+            try:
+                return purge.purge_expired(connection, keep=self.current_note)
+            finally:
+                connection.close()
+
+        while True:
+            purged = await loop.run_in_executor(None, run)
+
+            if purged:
+                await self.update_name_completer()
+                get_app().invalidate()
+
+            if interval <= 0:
+                return
+
+            await asyncio.sleep(interval)
+
+    def record_edit(self, _: Buffer):
+        """
+        Remember when the text last changed
+        """
+
+        self.last_edit = time.monotonic()
+
+    async def wait_until_idle(self, idle: float):
+        """
+        Wait until nothing has been typed for idle seconds and no save is
+        running
+        """
+
+        while True:
+            elapsed = time.monotonic() - self.last_edit
+            if elapsed >= idle and not self.worker.pending_writes:
+                return
+
+            await asyncio.sleep(max(idle - elapsed, 1.0))
+
+    async def backup_loop(self):
+        """
+        Snapshot the database into backup_dir every backup_interval seconds,
+        keeping the newest backup_keep snapshots
+
+        This runs as a background task for the lifetime of the app. Snapshots
+        are due backup_interval seconds after the newest one in backup_dir (so
+        the schedule carries over between sessions), and are only started once
+        typing has been idle for BACKUP_IDLE_DELAY seconds. The backup copies a
+        few pages at a time on its own connection and thread, so saving isn't
+        held up by it even when it takes a while. If the app exits while a
+        backup is running, the backup is abandoned.
+        """
+
+        loop = asyncio.get_running_loop()
+        settings = config.get_config()
+        interval = settings.backup_interval
+        if interval <= 0:
+            return
+
+        directory = backup.get_backup_dir()
+        stop = threading.Event()
+
+        def run() -> str:
+            return backup.take_snapshot(
+                config.get_db_path(),
+                directory,
+                settings.backup_keep,
+                stop,
+                self.profiler,
+            )
+
+        while True:
+            last = await loop.run_in_executor(None, backup.last_backup_time, directory)
+            if last is not None:
+                await asyncio.sleep(max(last + interval - time.time(), 0))
+
+            await self.wait_until_idle(BACKUP_IDLE_DELAY)
+
+            try:
+                await loop.run_in_executor(None, run)
+            except asyncio.CancelledError:
+                # The app is exiting: stop the backup at its next step, rather
+                # than making exit wait for it
+                stop.set()
+                raise
+            except (OSError, sqlite3.Error) as e:
+                self.message = f"Error: Backup failed ({e})"
+                get_app().invalidate()
+                await asyncio.sleep(interval)
+
+    async def sync_loop(self):
+        """
+        Exchange changes with other devices through sync_dir: once right after
+        startup, then every sync_interval seconds
+
+        This runs as a background task for the lifetime of the app, on its own
+        connection and thread (like purge_loop). A change received for the note
+        that is open changes its version, so it's merged into the text the next
+        time the note is saved, like one saved by another qwtd instance.
+        """
+
+        if not changelog.is_enabled():
+            return
+
+        loop = asyncio.get_running_loop()
+        interval = config.get_config().sync_interval
+
+        def run() -> sync.SyncResult:
+            connection = connect(config.get_db_path(), self.profiler)
+            try:
+                return sync.sync(connection)
+            finally:
+                connection.close()
+
+        while True:
+            try:
+                result = await loop.run_in_executor(None, run)
+            except (OSError, sqlite3.Error) as e:
+                self.message = f"Error: Sync failed ({e})"
+            else:
+                if result.applied:
+                    await self.update_name_completer()
+
+            get_app().invalidate()
+
+            if interval <= 0:
+                return
+
+            await asyncio.sleep(interval)
+
+    def flush_sync_log(self):
+        """
+        Append the changes that haven't been synced yet to this device's sync
+        log, so they don't wait for the next session (when the app exits)
+        """
+
+        if not changelog.is_enabled():
+            return
+
+        connection = connect(config.get_db_path(), self.profiler)
+        try:
+            sync.flush_outbox(connection, sync.get_sync_dir())
+        except (OSError, sqlite3.Error) as e:
+            print(
+                f"[QWTD] Warning: Couldn't write to the sync log ({e})",
+                file=sys.stderr,
+            )
+        finally:
+            connection.close()
+
+    @profiled
+    async def restore_revision(self, revision: int):
+        """
+        Replace the editor's text with an earlier revision of the current note
+
+        The restored text isn't saved until the note is written, at which point
+        it becomes the newest revision.
+        """
+
+        if self.current_note is None:
+            return
+        if self.is_viewing():
+            self.message = "Error: Large notes can only be restored with `qwtd history`"
+            return
+
+        try:
+            self.text_area.buffer.text = await self.worker.read(
+                revisions.get_revision, self.current_note, revision
+            )
+        except KeyError as e:
+            self.message = f"Error: {e.args[0]}"
+            return
+
+        self.message = f"Restored revision {revision} (save to keep it)"
 
     def unsaved(self) -> bool:
         """
         Check whether there are unsaved changes
         """
 
-        return (
-            self.current_note is not None
-            and self.last_saved_content != self.text_area.text
-        )
+        return self.current_note is not None and self.dirty.is_dirty()
 
-    def delete(self):
+    @profiled
+    async def delete(self):
         """
         Delete the currently open note (set it to deleted and add expiration)
         """
 
-        self.connection.execute(
-            """
-            UPDATE notes
-            SET deleted = 1,
-                expires = ?
-            WHERE name = ?
-            """,
-            (
-                config.generate_expiration(),
-                self.current_note if self.current_note else "",
-            ),
-        )
+        if self.current_note is None:
+            return
 
-        self.connection.commit()
+        await self.worker.write(
+            self.set_deleted, self.current_note, config.generate_expiration()
+        )
+        self.catalog.mark_changed(self.current_note)
 
-    def restore(self):
+    @profiled
+    async def restore(self):
         """
         Restore the deleted note to its previous location
         """
 
-        self.connection.execute(
-            """
-            UPDATE notes
-            SET deleted = 0
-            WHERE name = ?
-            """,
-            (self.current_note if self.current_note else "",),
-        )
+        if self.current_note is None:
+            return
+
+        await self.worker.write(self.set_deleted, self.current_note, None)
+        self.catalog.mark_changed(self.current_note)
 
-        self.connection.commit()
+    def set_deleted(
+        self, connection: Connection, note: str, expires: datetime | None
+    ):
+        """
+        Delete a note until expires, or restore it if expires is None (a job for
+        the writer thread)
+        """
+
+        try:
+            notes.set_deleted(connection, note, expires)
+        except BaseException:
+            connection.rollback()
+            raise
+
+        connection.commit()
+
+        self.content_cache.invalidate(note)
 
     def start_export(self):
         """
         Start an export (open the export menu)
         """
         self.is_exporting = True
+        self.is_exporting_all = False
+        self.export_buff.reset()
 
     def finish_export(self):
         """
-        Finish an export (write the file to disk)
+        Finish an export, writing the file(s) to disk in the background
         """
         self.is_exporting = False
 
-        if os.path.exists(self.export_buff.text):
-            print(f"[QWTD] Error: File {self.export_buff.text} already exists.")
+        destination = self.export_buff.text
+        if not destination:
+            return
+
+        if self.is_exporting_all:
+            get_app().create_background_task(self.export_all(destination))
             return
 
-        with open(self.export_buff.text, "w+", encoding="utf-8") as file:
-            file.write(self.text_area.text)
+        if os.path.exists(destination):
+            self.message = f"Error: File {destination} already exists"
+            return
+
+        content = self.text_area.text
+        note, db_path = self.current_note, config.get_db_path()
+        viewing = self.is_viewing()
+
+        def run() -> str:
+            nonlocal content
+
+            if viewing and note is not None:
+                # The viewer only has part of the note in memory, so read all
+                # of it on a separate connection
+                connection = connect(db_path, self.profiler)
+                try:
+                    result = notes.read_note(connection, note)
+                finally:
+                    connection.close()
+
+                if result is not None:
+                    content = result[0]
+
+            export.write_atomic(destination, content.encode("utf-8"))
+            return f"Exported note to {destination}"
+
+        get_app().create_background_task(self.run_export(run))
+
+    async def export_all(self, destination: str):
+        """
+        Export every note to a directory or archive, on an executor thread
+
+        The export gets its own connection, so it doesn't keep the worker's
+        threads (and saving) waiting while it streams through the notes.
+        """
+
+        db_path = config.get_db_path()
+
+        def run() -> str:
+            # Directories are exported incrementally, so exporting to the same
+            # place again only rewrites the notes that changed
+            incremental = not export.is_archive(destination)
+
+            connection = connect(db_path, self.profiler)
+            try:
+                with self.profiler.operation("export_all"):
+                    result = export.export_all(connection, destination, incremental)
+            finally:
+                connection.close()
+
+            return result.describe()
+
+        await self.run_export(run)
+
+    async def run_export(self, run: Callable[[], str]):
+        """
+        Run an export on an executor thread, showing the message it returns (or
+        its error) in the status bar
+        """
+
+        self.message = "Exporting..."
+        try:
+            self.message = await asyncio.get_running_loop().run_in_executor(None, run)
+        except (OSError, ValueError) as e:
+            self.message = f"Error: Export failed ({e})"
+
+        get_app().invalidate()
 
-    def close(self, app: Application):
+    async def close(self, app: Application):
         """
         Close the current note, prompting the user for a new one
         """
 
-        self.current_note = None
+        with self.note_lock:
+            self.current_note = None
         self.current_note_deleted = False
+        self.message = None
+        self.viewer.open(None)
         self.note_name_buff.text = ""
         self.text_area.text = " * in limbo (no note selected) *"
 
-        self.update_name_completer()
-
         app.layout.focus(self.note_name_buff)
-        self.note_name_buff.start_completion(select_first=False)
 
-    def save_and_exit(self, app: Application):
+        await self.update_name_completer()
+
+        if self.current_note is None:
+            self.note_name_buff.start_completion(select_first=False)
+
+    async def save_and_exit(self, app: Application):
         """
-        Save the note and quit the app
+        Save the note and quit the app (unless it couldn't be saved)
         """
 
-        self.write()
-        app.exit()
+        if await self.write():
+            app.exit()
 
-    def exit_without_saving(self, app: Application):
+    async def exit_without_saving(self, app: Application):
         """
         Quit the app without saving, rolling back the db
         """
 
-        self.connection.rollback()
+        await self.worker.write(Connection.rollback)
         app.exit()
 
-    def handle_command(self, command: str):
+    async def handle_command(self, command: str):
         """
         Handle a command from the command line input
         """
@@ -297,11 +1050,20 @@ class Editor:
             c = command_chars.pop()
 
             if c == "w":
-                self.write()
+                await self.write()
+            elif c == "r":
+                # :r N replaces the text with revision N of the note
+                number = ""
+                while command_chars and command_chars[-1] == " ":
+                    command_chars.pop()
+                while command_chars and command_chars[-1].isdigit():
+                    number += command_chars.pop()
+                if number:
+                    await self.restore_revision(int(number))
             elif c == "q":
                 if self.unsaved() and len(command_chars):
                     if command_chars.pop() == "!":
-                        self.exit_without_saving(get_app())
+                        await self.exit_without_saving(get_app())
                 elif not self.unsaved():
                     get_app().exit()
 
@@ -321,54 +1083,68 @@ class Editor:
         :type kb: KeyBindings
         """
 
+        # Handlers that use the database are coroutines, which prompt_toolkit
+        # runs as background tasks
+
+        @kb.add(
+            "i",
+            filter=Condition(
+                lambda: self.is_viewing() and get_app().layout.has_focus(self.viewer)
+            ),
+        )
+        async def _(event: KeyPressEvent):
+            """
+            Edit the chunked note in the viewer when i is pressed
+            """
+
+            await self.edit_chunked()
+
         @kb.add("c-w")
-        def _(event: KeyPressEvent):
+        async def _(event: KeyPressEvent):
             """
             Save on c-w
             """
 
-            self.write()
+            await self.write()
 
         @kb.add("c-q")
-        def _(event: KeyPressEvent):
+        async def _(event: KeyPressEvent):
             """
             Exit app when c-q is pressed
             """
 
-            self.save_and_exit(event.app)
+            await self.save_and_exit(event.app)
 
         @kb.add("c-a", "c-a", "c-a")
-        def _(event: KeyPressEvent):
+        async def _(event: KeyPressEvent):
             """
             Exit app when c-a is pressed thrice
             """
 
-            self.exit_without_saving(event.app)
+            await self.exit_without_saving(event.app)
 
         @kb.add("c-d", "c-d", "c-d")
-        def _(event: KeyPressEvent):
+        async def _(event: KeyPressEvent):
             """
             Delete the note when c-d is pressed thrice
             """
 
-            self.delete()
-            self.connection.commit()
+            await self.delete()
 
-            self.close(event.app)
+            await self.close(event.app)
 
         @kb.add("c-r", filter=Condition(lambda: self.current_note_deleted))
-        def _(event: KeyPressEvent):
+        async def _(event: KeyPressEvent):
             """
             Restore the note when c-r is pressed in Deleted
             """
 
-            self.restore()
-            self.connection.commit()
+            await self.restore()
             # print("[QWTD] Restored note.")
 
-            self.close(event.app)
+            await self.close(event.app)
 
-        @kb.add("c-e")
+        @kb.add("c-e", filter=Condition(lambda: not self.is_exporting))
         def _(event: KeyPressEvent):
             """
             Export when c-e is pressed
@@ -377,6 +1153,7 @@ class Editor:
             self.start_export()
 
             event.app.layout.focus(self.export_buff)
+            event.app.vi_state.input_mode = InputMode.INSERT
 
         @kb.add("enter", filter=Condition(lambda: self.is_exporting))
         def _(event: KeyPressEvent):
@@ -386,18 +1163,41 @@ class Editor:
 
             self.finish_export()
 
+            event.app.layout.focus(self.body())
+            event.app.vi_state.input_mode = InputMode.NAVIGATION
+
+        @kb.add("c-e", filter=Condition(lambda: self.is_exporting))
+        def _(event: KeyPressEvent):
+            """
+            Switch between exporting the current note and every note when c-e is
+            pressed again
+            """
+
+            self.is_exporting_all = not self.is_exporting_all
+
+        @kb.add("c-l", filter=Condition(lambda: self.current_note is not None))
+        async def _(event: KeyPressEvent):
+            """
+            Show or hide the current note's tags and backlinks when c-l is pressed
+            """
+
+            self.show_links = not self.show_links
+
+            if self.show_links:
+                await self.refresh_links()
+
         @kb.add(
             "c-o",
             filter=Condition(
                 lambda: self.current_note is not None and not self.unsaved()
             ),
         )
-        def _(event: KeyPressEvent):
+        async def _(event: KeyPressEvent):
             """
             Close note to open a new one when c-o is pressed
             """
 
-            self.close(event.app)
+            await self.close(event.app)
 
         @kb.add(
             ":",
@@ -0,0 +1,319 @@
+"""
+Export notes as markdown files, to a directory or a .tar.gz archive
+"""
+
+import io
+import json
+import os
+import secrets
+import tarfile
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from sqlite3 import Connection
+
+from qwtd import chunks
+from qwtd import storage
+
+# Written to the root of an export directory, recording which notes it holds and
+# the hash of each one's content, to make incremental exports possible
+MANIFEST_NAME: str = ".qwtd-export.json"
+
+ARCHIVE_EXTENSIONS: tuple[str, ...] = (".tar.gz", ".tgz")
+
+# How many notes may be read ahead of the ones being written, per worker
+READ_AHEAD: int = 4
+
+
+@dataclass
+class ExportResult:
+    """
+    What an export did
+    """
+
+    written: int
+    destination: str
+    # Files of notes that were deleted since the last export to the directory
+    removed: int = 0
+
+    def describe(self) -> str:
+        """
+        Describe the export in a sentence, for the status bar or the terminal
+        """
+
+        description = f"Exported {self.written} notes to {self.destination}"
+        if self.removed:
+            description += f" (removed {self.removed} deleted notes)"
+
+        return description
+
+
+def is_archive(path: str) -> bool:
+    """
+    Check whether an export destination is an archive rather than a directory
+    """
+
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def note_path(name: str) -> str:
+    """
+    Get the relative path a note is exported to
+
+    Slashes in note names become directories (the reverse of `qwtd import`),
+    and path components that could escape the export directory are replaced.
+    """
+
+    parts = [
+        "_" if part in ("", ".", "..") else part.replace("\0", "_")
+        for part in name.split("/")
+    ]
+
+    return os.path.join(*parts) + ".md"
+
+
+def create_temp_file(directory: str) -> tuple[int, str]:
+    """
+    Create a new, empty temporary file in a directory, to be renamed over an
+    exported file
+
+    Unlike tempfile.mkstemp (which makes files only their owner can read), the
+    file gets the permissions of any new file (0666 minus the umask), so the
+    exported file does too.
+
+    :return: The file's descriptor (open for writing) and path
+    """
+
+    while True:
+        path = os.path.join(directory, f".qwtd-{secrets.token_hex(8)}.tmp")
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            continue
+
+        return fd, path
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """
+    Write a file by writing a temporary file next to it and renaming it over
+    the destination, so that the file is never seen half written
+    """
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    fd, temp_path = create_temp_file(directory)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def read_manifest(directory: str) -> dict[str, str]:
+    """
+    Read which notes a previous export to a directory wrote, and the content
+    hash of each one ({} if there was none, or it was made by a version of qwtd
+    that only recorded when it ran)
+    """
+
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), encoding="utf-8") as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+    exported = manifest.get("notes") if isinstance(manifest, dict) else None
+
+    return exported if isinstance(exported, dict) else {}
+
+
+def iter_notes(
+    connection: Connection, names: Iterable[str] | None = None
+) -> Iterator[tuple[str, str, str | bytes, str | None, datetime]]:
+    """
+    Stream (name, content hash, stored content, codec, date_modified) for every
+    live note, or only for the live notes among names
+
+    Rows are read from the cursor as they are needed rather than all at once.
+    Chunked notes are read in full, and yielded as plain text.
+    """
+
+    select = """
+        SELECT notes.name, notes.content_hash, notes.codec, blobs.content,
+            blobs.codec, date_modified
+        FROM notes LEFT JOIN blobs ON blobs.hash = notes.content_hash
+        WHERE deleted = 0
+    """
+
+    if names is None:
+        rows: Iterable[tuple] = connection.execute(select)
+    else:
+        rows = (
+            row
+            for name in names
+            for row in connection.execute(select + " AND notes.name = ?", (name,))
+        )
+
+    for name, content_hash, note_codec, content, codec, date_modified in rows:
+        if note_codec == chunks.CHUNKED:
+            content, codec = chunks.read_chunked(connection, name), None
+
+        yield name, content_hash, content, codec, date_modified
+
+
+def remove_exported(directory: str, name: str) -> bool:
+    """
+    Remove the file a note was exported to, along with the directories that
+    only held it
+
+    :return: Whether there was a file to remove
+    """
+
+    path = note_path(name)
+
+    try:
+        os.remove(os.path.join(directory, path))
+    except FileNotFoundError:
+        return False
+
+    parent = os.path.dirname(path)
+    while parent:
+        try:
+            os.rmdir(os.path.join(directory, parent))
+        except OSError:
+            # Not empty
+            break
+        parent = os.path.dirname(parent)
+
+    return True
+
+
+def export_all(
+    connection: Connection,
+    destination: str,
+    incremental: bool = False,
+    workers: int = 8,
+) -> ExportResult:
+    """
+    Export every note that isn't deleted
+
+    :param destination: A directory, or a path ending in .tar.gz or .tgz
+    :param incremental: Only rewrite the notes whose content changed since the
+        last export to the same directory (not supported for archives)
+    :param workers: Number of threads decoding and writing files
+    """
+
+    if is_archive(destination):
+        if incremental:
+            raise ValueError("Incremental exports are only supported to directories")
+        return export_archive(connection, destination)
+
+    return export_directory(connection, destination, incremental, workers)
+
+
+def export_directory(
+    connection: Connection, directory: str, incremental: bool, workers: int
+) -> ExportResult:
+    """
+    Export every live note to a file in a directory, using a pool of threads
+
+    The notes in the directory's manifest that were deleted since are removed
+    from it. An incremental export only writes the notes whose content hash
+    differs from the one in the manifest (or that aren't in it).
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    exported = read_manifest(directory)
+    live: dict[str, str] = dict(
+        connection.execute("SELECT name, content_hash FROM notes WHERE deleted = 0")
+    )
+
+    names: list[str] | None = None
+    if incremental:
+        names = [
+            name
+            for name, content_hash in live.items()
+            if exported.get(name) != content_hash
+        ]
+
+    # The manifest records the hash of what was actually written, so a note
+    # saved again while exporting is rewritten by the next export
+    manifest: dict[str, str] = {
+        name: content_hash
+        for name, content_hash in exported.items()
+        if name in live
+    }
+
+    def write_note(name: str, content: str | bytes, codec: str | None):
+        data = storage.decode_content(content, codec).encode("utf-8")
+        write_atomic(os.path.join(directory, note_path(name)), data)
+
+    written = 0
+    pending: deque[Future[None]] = deque()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for name, content_hash, content, codec, _ in iter_notes(connection, names):
+            pending.append(pool.submit(write_note, name, content, codec))
+            manifest[name] = content_hash
+            written += 1
+
+            # Don't read the whole database into memory ahead of the writers
+            while len(pending) > workers * READ_AHEAD:
+                pending.popleft().result()
+
+        while pending:
+            pending.popleft().result()
+
+    removed = 0
+    deleted = [name for name in exported if name not in live]
+    if deleted:
+        # Different names can be exported to the same path (see note_path)
+        live_paths = {note_path(name) for name in live}
+        for name in deleted:
+            if note_path(name) not in live_paths and remove_exported(directory, name):
+                removed += 1
+
+    write_atomic(
+        os.path.join(directory, MANIFEST_NAME),
+        json.dumps({"notes": manifest}, ensure_ascii=False).encode("utf-8"),
+    )
+
+    return ExportResult(written, directory, removed)
+
+
+def export_archive(connection: Connection, path: str) -> ExportResult:
+    """
+    Export every live note into a .tar.gz archive, written atomically
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = create_temp_file(directory)
+
+    written = 0
+    try:
+        with os.fdopen(fd, "wb") as file, tarfile.open(
+            fileobj=file, mode="w:gz"
+        ) as archive:
+            for name, _, content, codec, date_modified in iter_notes(connection):
+                data = storage.decode_content(content, codec).encode("utf-8")
+
+                info = tarfile.TarInfo(note_path(name).replace(os.sep, "/"))
+                info.size = len(data)
+                info.mtime = int(date_modified.timestamp())
+
+                archive.addfile(info, io.BytesIO(data))
+                written += 1
+
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    return ExportResult(written, path)
@@ -0,0 +1,165 @@
+"""
+Index of the links between notes ([[note name]]) and of their #tags
+
+Links and tags are parsed from a note's Markdown whenever it's saved, and
+stored in the links and tags tables, so backlinks and the notes with a tag are
+found with an index lookup rather than by reading every note.
+"""
+
+import re
+from dataclasses import dataclass
+from sqlite3 import Connection
+
+# [[note name]], [[note name|shown text]] or [[note name#heading]]
+LINK_RE = re.compile(r"\[\[([^\]|#]+)(?:[|#][^\]]*)?\]\]")
+# #tag, but not a heading ("# Title"), a fragment in a URL or an issue number
+TAG_RE = re.compile(r"(?<![\w#&/])#([\w/-]*[^\W\d][\w/-]*)")
+CODE_SPAN_RE = re.compile(r"(`+).+?\1")
+FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+
+
+@dataclass
+class NoteLinks:
+    """
+    What the index knows about one note
+    """
+
+    # The note's own tags, sorted
+    tags: list[str]
+    # Notes that link to this one (and aren't deleted), sorted
+    backlinks: list[str]
+
+
+def parse(content: str) -> tuple[set[str], set[str]]:
+    """
+    Find the links and tags in a note's Markdown, skipping code
+
+    Tags are lowercased, so #Todo and #todo are the same tag.
+
+    :return: The names of the notes linked to, and the tags
+    """
+
+    links: set[str] = set()
+    tags: set[str] = set()
+
+    fence: str | None = None
+
+    for line in content.splitlines():
+        match = FENCE_RE.match(line)
+        if fence is not None:
+            # A fence is closed by one of the same character, at least as long
+            marker = match.group(1) if match else ""
+            if marker[:1] == fence[0] and len(marker) >= len(fence):
+                fence = None
+            continue
+        if match:
+            fence = match.group(1)
+            continue
+
+        if "[[" not in line and "#" not in line:
+            continue
+
+        line = CODE_SPAN_RE.sub("", line)
+
+        for match in LINK_RE.finditer(line):
+            name = match.group(1).strip()
+            if name:
+                links.add(name)
+
+        tags.update(tag.lower() for tag in TAG_RE.findall(line))
+
+    return links, tags
+
+
+def index_note(connection: Connection, name: str, content: str):
+    """
+    Update the index after a note is saved
+
+    The note's links and tags are compared with the ones already indexed, and
+    only the differences are written. This doesn't commit.
+    """
+
+    links, tags = parse(content)
+
+    update_rows(connection, "links", "source", "target", name, links)
+    update_rows(connection, "tags", "note", "tag", name, tags)
+
+
+def update_rows(
+    connection: Connection,
+    table: str,
+    key: str,
+    column: str,
+    name: str,
+    values: set[str],
+):
+    """
+    Make the rows of table for a note hold exactly values, changing only the
+    ones that differ
+    """
+
+    indexed = {
+        value
+        for (value,) in connection.execute(
+            f"SELECT {column} FROM {table} WHERE {key} = ?", (name,)
+        )
+    }
+
+    removed = indexed - values
+    if removed:
+        connection.executemany(
+            f"DELETE FROM {table} WHERE {key} = ? AND {column} = ?",
+            ((name, value) for value in removed),
+        )
+
+    added = values - indexed
+    if added:
+        connection.executemany(
+            f"INSERT INTO {table} ({key}, {column}) VALUES (?, ?)",
+            ((name, value) for value in added),
+        )
+
+
+def note_links(connection: Connection, name: str) -> NoteLinks:
+    """
+    Get a note's tags and backlinks
+    """
+
+    tags = [
+        tag
+        for (tag,) in connection.execute(
+            "SELECT tag FROM tags WHERE note = ? ORDER BY tag", (name,)
+        )
+    ]
+
+    backlinks = [
+        source
+        for (source,) in connection.execute(
+            """
+            SELECT links.source
+            FROM links JOIN notes ON notes.name = links.source
+            WHERE links.target = ? AND notes.deleted = 0
+            ORDER BY links.source
+            """,
+            (name,),
+        )
+    ]
+
+    return NoteLinks(tags, backlinks)
+
+
+def notes_with_tag(connection: Connection, prefix: str) -> set[str]:
+    """
+    Get the notes with a tag that starts with prefix (case-insensitively)
+    """
+
+    prefix = prefix.lower()
+
+    # A range over the (tag, note) index rather than LIKE, which can't use it
+    return {
+        note
+        for (note,) in connection.execute(
+            "SELECT note FROM tags WHERE tag >= ? AND tag < ?",
+            (prefix, prefix + "\U0010ffff"),
+        )
+    }
@@ -0,0 +1,52 @@
+"""
+Side panel showing the current note's tags and the notes that link to it
+"""
+
+from prompt_toolkit.filters import Condition
+from prompt_toolkit.formatted_text import StyleAndTextTuples
+from prompt_toolkit.layout import (
+    ConditionalContainer,
+    Dimension,
+    FormattedTextControl,
+    Window,
+)
+from prompt_toolkit.widgets import Frame
+
+from qwtd.editor import Editor
+
+
+def links_panel(editor: Editor) -> ConditionalContainer:
+    """
+    Layout for the links panel, shown while editor.show_links is set
+    """
+
+    def get_text() -> StyleAndTextTuples:
+        if editor.links is None:
+            return [("class:info", "Loading...")]
+
+        out: StyleAndTextTuples = [("class:info", "Tags\n")]
+
+        if editor.links.tags:
+            out += [("class:tag", f"#{tag}\n") for tag in editor.links.tags]
+        else:
+            out.append(("", "(none)\n"))
+
+        out.append(("class:info", "\nLinked from\n"))
+
+        if editor.links.backlinks:
+            out += [("", f"{name}\n") for name in editor.links.backlinks]
+        else:
+            out.append(("", "(nothing)\n"))
+
+        return out
+
+    return ConditionalContainer(
+        Frame(
+            Window(FormattedTextControl(get_text), wrap_lines=True),
+            title="Links",
+            width=Dimension(preferred=30, max=40),
+        ),
+        filter=Condition(
+            lambda: editor.show_links and editor.current_note is not None
+        ),
+    )
@@ -0,0 +1,324 @@
+"""
+Incremental Markdown lexer that caches lexer state at every line boundary
+"""
+
+import re
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Any
+
+from prompt_toolkit.document import Document
+from prompt_toolkit.formatted_text import StyleAndTextTuples
+from prompt_toolkit.lexers import Lexer
+
+# The state of the lexer at the start of a line: either ("text",) or
+# ("fence", fence, language) inside a fenced code block
+State = tuple[str, ...]
+
+TEXT_STATE: State = ("text",)
+
+# How many (state, line) -> fragments results to remember
+TOKEN_CACHE_SIZE: int = 20_000
+
+FENCE_OPEN_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})\s*([\w+#.-]*)")
+FENCE_CLOSE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})\s*$")
+HEADING_RE = re.compile(r"^ {0,3}(#{1,6})(?:\s|$)")
+SETEXT_RE = re.compile(r"^ {0,3}(=+|-{2,})\s*$")
+QUOTE_RE = re.compile(r"^(\s*>+\s?)")
+LIST_RE = re.compile(r"^(\s*)([-*+]|\d+[.)])(\s+)(\[[ xX]\]\s)?")
+INLINE_RE = re.compile(
+    r"(?P<code>(`+)[^`].*?\2)"
+    r"|(?P<strong>\*\*[^*\s](?:.*?[^*\s])?\*\*|__[^_\s](?:.*?[^_\s])?__)"
+    r"|(?P<emph>\*[^*\s](?:.*?[^*\s])?\*|\b_[^_\s](?:.*?[^_\s])?_\b)"
+    r"|(?P<wikilink>\[\[[^\]]+\]\])"
+    r"|(?P<link>\[(?P<link_text>[^\]]*)\](?P<link_url>\([^)]*\)))"
+    r"|(?P<autolink><https?://[^>]+>)"
+)
+
+HEADING = "class:pygments.generic.heading"
+SUBHEADING = "class:pygments.generic.subheading"
+STRONG = "class:pygments.generic.strong"
+EMPH = "class:pygments.generic.emph"
+CODE = "class:pygments.literal.string.backtick"
+KEYWORD = "class:pygments.keyword"
+LINK_TEXT = "class:pygments.name.tag"
+LINK_URL = "class:pygments.name.attribute"
+
+
+def pygments_token_to_class(token: Any) -> str:
+    """
+    Convert a pygments token type to a style class, the way PygmentsLexer does
+    """
+
+    return "class:pygments." + ".".join(token).lower() if token else ""
+
+
+def next_state(state: State, line: str) -> State:
+    """
+    Get the lexer state at the start of the line after this one
+    """
+
+    if state[0] == "fence":
+        match = FENCE_CLOSE_RE.match(line)
+        if (
+            match
+            and match.group(1)[0] == state[1][0]
+            and len(match.group(1)) >= len(state[1])
+        ):
+            return TEXT_STATE
+        return state
+
+    match = FENCE_OPEN_RE.match(line)
+    if match:
+        return ("fence", match.group(1), match.group(2).lower())
+
+    return TEXT_STATE
+
+
+def common_prefix_length(a: list[str], b: list[str]) -> int:
+    """
+    Count the lines two documents have in common at the start
+
+    Lines are compared in slices of doubling size, so that the comparison runs
+    in C rather than one Python iteration per line.
+    """
+
+    limit = min(len(a), len(b))
+    length = 0
+    step = 1
+
+    while length < limit:
+        end = min(limit, length + step)
+
+        if a[length:end] == b[length:end]:
+            length = end
+            step *= 2
+        elif step == 1:
+            break
+        else:
+            step = 1
+
+    return length
+
+
+def lex_inline(text: str, style: str = "") -> StyleAndTextTuples:
+    """
+    Split text into fragments for code spans, emphasis and links
+    """
+
+    fragments: StyleAndTextTuples = []
+    pos = 0
+
+    for match in INLINE_RE.finditer(text):
+        if match.start() > pos:
+            fragments.append((style, text[pos : match.start()]))
+
+        kind = match.lastgroup
+        if match.group("link"):
+            fragments.append((style, "["))
+            fragments.append((LINK_TEXT, match.group("link_text")))
+            fragments.append((style, "]"))
+            fragments.append((LINK_URL, match.group("link_url")))
+        elif kind == "code":
+            fragments.append((CODE, match.group()))
+        elif kind == "strong":
+            fragments.append((STRONG, match.group()))
+        elif kind == "emph":
+            fragments.append((EMPH, match.group()))
+        else:
+            fragments.append((LINK_TEXT, match.group()))
+
+        pos = match.end()
+
+    if pos < len(text):
+        fragments.append((style, text[pos:]))
+
+    return fragments
+
+
+class MarkdownLexer(Lexer):
+    """
+    A Markdown lexer for qwtd's editor that stays fast as notes grow
+
+    The state at the start of every line is cached. When the document changes,
+    states are kept up to the first changed line, recomputed from there, and as
+    soon as a recomputed state matches the cached state of the same (unchanged)
+    line after the edit, the rest of the cached states are reused. Lines are
+    tokenized from (state, text) on demand, with the results memoized, so only
+    the lines that are actually shown are tokenized.
+
+    Fenced code blocks are highlighted with the pygments lexer for their
+    language, which is only loaded the first time the language is seen. Code is
+    highlighted one line at a time, so constructs spanning several lines (such
+    as multi-line strings) are highlighted per line.
+    """
+
+    def __init__(self):
+        self._lines: list[str] = []
+        # _states[i] is the state at the start of line i
+        self._states: list[State] = [TEXT_STATE]
+
+        # After an edit: (old states, line count difference, first line of the
+        # unchanged tail), used to reuse old states once they match again
+        self._resync: tuple[list[State], int, int] | None = None
+
+        self._tokens: OrderedDict[tuple[State, str], StyleAndTextTuples] = (
+            OrderedDict()
+        )
+        self._code_lexers: dict[str, Any] = {}
+
+    def lex_document(
+        self, document: Document
+    ) -> Callable[[int], StyleAndTextTuples]:
+        lines = document.lines
+
+        def get_line(lineno: int) -> StyleAndTextTuples:
+            if lineno >= len(lines):
+                return []
+
+            # Another document may have been lexed since this one
+            self._update(lines)
+
+            return self._tokenize(self._state_at(lineno), lines[lineno])
+
+        return get_line
+
+    def _update(self, lines: list[str]) -> None:
+        """
+        Switch to a new version of the document, keeping every state that is
+        still valid
+        """
+
+        old = self._lines
+        if lines is old:
+            return
+
+        prefix = common_prefix_length(old, lines)
+        suffix = common_prefix_length(old[prefix:][::-1], lines[prefix:][::-1])
+
+        old_states = self._states
+
+        # The state at the start of the first changed line only depends on the
+        # lines before it, so it is still valid
+        self._states = old_states[: prefix + 1]
+        self._resync = (old_states, len(lines) - len(old), len(lines) - suffix)
+        self._lines = lines
+
+    def _state_at(self, lineno: int) -> State:
+        """
+        Get the state at the start of a line, computing states up to it if needed
+        """
+
+        states = self._states
+
+        while len(states) <= lineno:
+            index = len(states)
+            state = next_state(states[-1], self._lines[index - 1])
+
+            if self._resync is not None:
+                old_states, offset, tail_start = self._resync
+                old_index = index - offset
+
+                if (
+                    index >= tail_start
+                    and old_index < len(old_states)
+                    and old_states[old_index] == state
+                ):
+                    # Everything from here on is unchanged, and so are the states
+                    states.extend(old_states[old_index:])
+                    self._resync = None
+                    continue
+
+            states.append(state)
+
+        return states[lineno]
+
+    def _tokenize(self, state: State, line: str) -> StyleAndTextTuples:
+        """
+        Tokenize a line, starting in the given state
+        """
+
+        key = (state, line)
+        fragments = self._tokens.get(key)
+
+        if fragments is not None:
+            self._tokens.move_to_end(key)
+            return fragments
+
+        if state[0] == "fence":
+            fragments = self._tokenize_code(state, line)
+        else:
+            fragments = self._tokenize_text(line)
+
+        self._tokens[key] = fragments
+        if len(self._tokens) > TOKEN_CACHE_SIZE:
+            self._tokens.popitem(last=False)
+
+        return fragments
+
+    def _tokenize_text(self, line: str) -> StyleAndTextTuples:
+        if FENCE_OPEN_RE.match(line):
+            return [(CODE, line)]
+
+        match = HEADING_RE.match(line)
+        if match:
+            return [(HEADING if len(match.group(1)) == 1 else SUBHEADING, line)]
+
+        if SETEXT_RE.match(line):
+            return [(SUBHEADING, line)]
+
+        fragments: StyleAndTextTuples = []
+        rest = line
+
+        match = QUOTE_RE.match(rest)
+        if match:
+            fragments.append((KEYWORD, match.group()))
+            return fragments + lex_inline(rest[match.end() :], EMPH)
+
+        match = LIST_RE.match(rest)
+        if match:
+            fragments.append(("", match.group(1)))
+            fragments.append((KEYWORD, match.group(2)))
+            fragments.append(("", match.group(3)))
+            if match.group(4):
+                fragments.append((KEYWORD, match.group(4)))
+            rest = rest[match.end() :]
+
+        return fragments + lex_inline(rest)
+
+    def _tokenize_code(self, state: State, line: str) -> StyleAndTextTuples:
+        if FENCE_CLOSE_RE.match(line) and next_state(state, line) == TEXT_STATE:
+            return [(CODE, line)]
+
+        lexer = self._get_code_lexer(state[2])
+        if lexer is None:
+            return [(CODE, line)]
+
+        fragments: StyleAndTextTuples = []
+        for token, text in lexer.get_tokens(line):
+            text = text.replace("\n", "")
+            if text:
+                fragments.append((pygments_token_to_class(token), text))
+
+        return fragments
+
+    def _get_code_lexer(self, language: str) -> Any:
+        """
+        Get the pygments lexer for a language, loading it on first use
+        """
+
+        if language not in self._code_lexers:
+            lexer = None
+
+            if language:
+                from pygments.lexers import get_lexer_by_name
+                from pygments.util import ClassNotFound
+
+                try:
+                    lexer = get_lexer_by_name(language, stripnl=False)
+                except ClassNotFound:
+                    pass
+
+            self._code_lexers[language] = lexer
+
+        return self._code_lexers[language]
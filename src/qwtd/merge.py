@@ -0,0 +1,120 @@
+"""
+Line-based three-way merge, for notes saved from more than one place at once
+"""
+
+from difflib import SequenceMatcher
+
+CONFLICT_START: str = "<<<<<<< this editor\n"
+CONFLICT_SEPARATOR: str = "=======\n"
+CONFLICT_END: str = ">>>>>>> saved elsewhere\n"
+
+
+def changes(base: list[str], other: list[str]) -> list[tuple[int, int, int, int]]:
+    """
+    Get the lines that differ between base and other
+
+    :return: (base start, base end, other start, other end) ranges, in order
+    """
+
+    matcher = SequenceMatcher(None, base, other, autojunk=False)
+
+    return [
+        (i1, i2, j1, j2)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    ]
+
+
+def merge3(base: str, ours: str, theirs: str) -> tuple[str, int]:
+    """
+    Merge two edited versions of the same text, line by line
+
+    Changes that only one side made (or that both made identically) are applied.
+    Where both sides changed the same (or adjacent) lines differently, both
+    versions are kept between conflict markers, like git does.
+
+    :param base: The text both sides started from
+    :param ours: The text as edited here
+    :param theirs: The text as saved elsewhere
+    :return: The merged text, and the number of conflicts in it
+    """
+
+    if ours == theirs or base == theirs:
+        return ours, 0
+    if base == ours:
+        return theirs, 0
+
+    base_lines = base.splitlines(keepends=True)
+    sides = (ours.splitlines(keepends=True), theirs.splitlines(keepends=True))
+
+    # Every change, tagged with the side (0 for ours, 1 for theirs) it's from
+    hunks = sorted(
+        (*hunk, side)
+        for side, lines in enumerate(sides)
+        for hunk in changes(base_lines, lines)
+    )
+
+    merged: list[str] = []
+    conflicts = 0
+
+    # Where each side's lines are relative to the base, outside of changes
+    offsets = [0, 0]
+    position = 0
+    index = 0
+
+    while index < len(hunks):
+        # Group changes that overlap or touch, since they can't be applied
+        # independently
+        start, end = hunks[index][0], hunks[index][1]
+        group = [hunks[index]]
+        index += 1
+
+        while index < len(hunks) and hunks[index][0] <= end:
+            end = max(end, hunks[index][1])
+            group.append(hunks[index])
+            index += 1
+
+        merged += base_lines[position:start]
+        position = end
+
+        regions: list[list[str] | None] = []
+        for side, lines in enumerate(sides):
+            side_hunks = [hunk for hunk in group if hunk[4] == side]
+            if not side_hunks:
+                regions.append(None)
+                continue
+
+            growth = sum((j2 - j1) - (i2 - i1) for i1, i2, j1, j2, _ in side_hunks)
+            regions.append(
+                lines[start + offsets[side] : end + offsets[side] + growth]
+            )
+            offsets[side] += growth
+
+        ours_region, theirs_region = regions
+
+        if theirs_region is None or ours_region == theirs_region:
+            merged += ours_region or []
+        elif ours_region is None:
+            merged += theirs_region
+        else:
+            conflicts += 1
+            merged.append(CONFLICT_START)
+            merged += terminated(ours_region)
+            merged.append(CONFLICT_SEPARATOR)
+            merged += terminated(theirs_region)
+            merged.append(CONFLICT_END)
+
+    merged += base_lines[position:]
+
+    return "".join(merged), conflicts
+
+
+def terminated(lines: list[str]) -> list[str]:
+    """
+    Make sure the last line ends with a newline, so a marker can follow it
+    """
+
+    if lines and not lines[-1].endswith("\n"):
+        return lines[:-1] + [lines[-1] + "\n"]
+
+    return lines
@@ -0,0 +1,385 @@
+"""
+Fuzzy note name completion backed by an incrementally updated index
+"""
+
+import heapq
+import re
+from bisect import bisect_left, insort
+from collections.abc import Callable, Iterable, Iterator
+from datetime import datetime
+
+from prompt_toolkit.completion import CompleteEvent, Completer, Completion
+from prompt_toolkit.document import Document
+from prompt_toolkit.formatted_text import AnyFormattedText
+
+# How many completions to return for a query
+DEFAULT_LIMIT: int = 100
+
+# Rebuild the index once this many of its entries belong to removed names
+COMPACT_THRESHOLD: int = 1000
+
+
+class NoteNameCompleter(Completer):
+    """
+    Completes note names, returning only the best matches
+
+    Matches are ranked by how well they match (names starting with the query,
+    then names containing it, then names containing its characters in order),
+    then by how recently the note was modified, and only the top `limit` are
+    returned.
+
+    Names are kept in sorted order, so names starting with the query are found
+    with a binary search. For the other matches, names are indexed by the
+    characters they contain: a query only looks at the names containing its
+    rarest character. The index of a character is built the first time a query
+    needs it and kept up to date from then on. While typing, each query only
+    looks at the names that matched the one before it.
+
+    The index is updated one name at a time as notes are added, modified,
+    renamed (removed and added) or deleted.
+
+    A query can start with #tags (e.g. "#work meeting") to only match notes
+    with those tags, if tag_filter is set.
+    """
+
+    def __init__(self, limit: int = DEFAULT_LIMIT):
+        """
+        Create a new, empty NoteNameCompleter
+
+        :param limit: The number of completions to return
+        :type limit: int
+        """
+
+        self.limit: int = limit
+
+        # Gets the text shown next to a name in the completion menu (optional).
+        # It is only called once the menu is rendered, but then for every
+        # completion returned (up to limit), every time, so it should be cheap
+        # or memoized.
+        self.display_meta: Callable[[str], AnyFormattedText] | None = None
+
+        # Gets the names of the notes with a tag starting with a prefix
+        # (optional). It is called on every keystroke of a query with a tag in
+        # it, so it should be an index lookup.
+        self.tag_filter: Callable[[str], set[str]] | None = None
+
+        self._ids: dict[str, int] = {}
+        # Indexed by id, None for removed names
+        self._names: list[str | None] = []
+        self._lower: list[str] = []
+        self._recency: list[float] = []
+
+        # (lowercased name, id), sorted, for prefix matches
+        self._sorted: list[tuple[str, int]] = []
+        # Ids of the names containing each character, which may include
+        # removed names
+        self._postings: dict[str, list[int]] = {}
+        self._removed: int = 0
+
+        # Ids of the names that fuzzy match recent queries, by query. Only
+        # queries that the latest one starts with are kept.
+        self._matches: dict[str, list[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._ids
+
+    def rebuild(self, names: Iterable[tuple[str, datetime | None]]):
+        """
+        Replace the index with (name, date_modified) pairs
+        """
+
+        self._ids.clear()
+        self._names.clear()
+        self._lower.clear()
+        self._recency.clear()
+        self._postings.clear()
+        self._matches.clear()
+        self._removed = 0
+
+        for name, date_modified in names:
+            self._add(name, date_modified)
+
+        self._sorted = sorted(zip(self._lower, range(len(self._lower))))
+
+    def update(self, name: str, date_modified: datetime | None):
+        """
+        Add a name, or update when an existing one was modified
+        """
+
+        note_id = self._ids.get(name)
+
+        if note_id is None:
+            note_id = self._add(name, date_modified)
+            insort(self._sorted, (self._lower[note_id], note_id))
+            self._matches.clear()
+        else:
+            self._recency[note_id] = recency(date_modified)
+
+    def remove(self, name: str):
+        """
+        Remove a name (e.g. when a note is permanently deleted)
+        """
+
+        note_id = self._ids.pop(name, None)
+        if note_id is None:
+            return
+
+        key = (self._lower[note_id], note_id)
+        del self._sorted[bisect_left(self._sorted, key)]
+
+        self._names[note_id] = None
+        self._removed += 1
+
+        # Posting lists only grow, so compact them once enough of them is stale
+        if self._removed > max(COMPACT_THRESHOLD, len(self._ids)):
+            self._compact()
+
+    def _add(self, name: str, date_modified: datetime | None) -> int:
+        """
+        Index a new name (without adding it to the sorted list)
+        """
+
+        note_id = len(self._names)
+        lower = name.lower()
+
+        self._ids[name] = note_id
+        self._names.append(name)
+        self._lower.append(lower)
+        self._recency.append(recency(date_modified))
+
+        # Only posting lists that have been built need updating
+        for char in set(lower):
+            postings = self._postings.get(char)
+            if postings is not None:
+                postings.append(note_id)
+
+        return note_id
+
+    def _compact(self):
+        """
+        Rebuild the index without the names that were removed
+        """
+
+        live = [
+            (name, recency_)
+            for name, recency_ in zip(self._names, self._recency)
+            if name is not None
+        ]
+
+        self.rebuild((name, None) for name, _ in live)
+        self._recency = [recency_ for _, recency_ in live]
+
+    def _posting(self, char: str) -> list[int]:
+        """
+        Get the ids of the names containing a character, building its posting
+        list if this is the first time it's needed
+        """
+
+        postings = self._postings.get(char)
+
+        if postings is None:
+            postings = [
+                note_id
+                for note_id, lower in enumerate(self._lower)
+                if char in lower and self._names[note_id] is not None
+            ]
+            self._postings[char] = postings
+
+        return postings
+
+    def _fuzzy_matches(self, query: str, pattern: re.Pattern[str]) -> list[int]:
+        """
+        Get the ids of the names containing the characters of query in order
+        """
+
+        # A name that matches a query also matches every prefix of it, so start
+        # from the longest previous query that this one extends
+        base = max(
+            (previous for previous in self._matches if query.startswith(previous)),
+            key=len,
+            default=None,
+        )
+
+        if base is not None:
+            candidates = self._matches[base]
+        else:
+            candidates = min(map(self._posting, set(query)), key=len)
+
+        if base == query or len(query) == 1:
+            matches = candidates
+        else:
+            lower = self._lower
+            matches = [
+                note_id for note_id in candidates if pattern.search(lower[note_id])
+            ]
+
+        self._matches = {
+            previous: ids
+            for previous, ids in self._matches.items()
+            if query.startswith(previous)
+        }
+        self._matches[query] = matches
+
+        return matches
+
+    def search(self, text: str) -> list[str]:
+        """
+        Get the best matching names for a query, best first
+        """
+
+        limit = self.limit
+
+        if self.tag_filter is not None:
+            tags, rest = split_tags(text)
+            if tags:
+                allowed = set.intersection(*map(self.tag_filter, tags))
+                return self._search_within(allowed, rest.lower())
+
+        query = text.lower()
+
+        if not query:
+            ids = heapq.nlargest(
+                limit, self._ids.values(), key=self._recency.__getitem__
+            )
+            return [self._names[note_id] for note_id in ids]  # type: ignore[misc]
+
+        # Names starting with the query are contiguous in the sorted list
+        start = bisect_left(self._sorted, (query,))
+        end = bisect_left(self._sorted, (query + "\U0010ffff",), start)
+
+        prefix_ids = [note_id for _, note_id in self._sorted[start:end]]
+        results = heapq.nlargest(limit, prefix_ids, key=self._recency.__getitem__)
+
+        if len(results) < limit:
+            pattern = re.compile(".*?".join(map(re.escape, query)), re.DOTALL)
+
+            # Names containing the query, earliest match first, then names
+            # containing its characters in order, shortest and earliest first
+            contains: list[tuple[int, float, int]] = []
+            fuzzy: list[tuple[int, int, float, int]] = []
+
+            for note_id in self._fuzzy_matches(query, pattern):
+                if self._names[note_id] is None:
+                    continue
+
+                lower = self._lower[note_id]
+                position = lower.find(query)
+                if position > 0:
+                    contains.append((position, -self._recency[note_id], note_id))
+                elif position < 0:
+                    length, position = best_match(pattern, lower)
+                    fuzzy.append((length, position, -self._recency[note_id], note_id))
+
+            best_contains = heapq.nsmallest(limit - len(results), contains)
+            results += [note_id for *_, note_id in best_contains]
+
+            best_fuzzy = heapq.nsmallest(limit - len(results), fuzzy)
+            results += [note_id for *_, note_id in best_fuzzy]
+
+        return [self._names[note_id] for note_id in results]  # type: ignore[misc]
+
+    def _search_within(self, names: set[str], query: str) -> list[str]:
+        """
+        Get the best matching names out of a set of names (ranked like search)
+        """
+
+        ids = [self._ids[name] for name in names if name in self._ids]
+        recency_ = self._recency
+
+        if not query:
+            ids = heapq.nlargest(self.limit, ids, key=recency_.__getitem__)
+            return [self._names[note_id] for note_id in ids]  # type: ignore[misc]
+
+        pattern = re.compile(".*?".join(map(re.escape, query)), re.DOTALL)
+
+        # (kind, length or position, position, -recency, id), where kind is 0
+        # for names starting with the query, 1 for names containing it and 2
+        # for names containing its characters in order
+        ranked: list[tuple[int, int, int, float, int]] = []
+
+        for note_id in ids:
+            lower = self._lower[note_id]
+            position = lower.find(query)
+
+            if position >= 0:
+                ranked.append(
+                    (min(position, 1), position, 0, -recency_[note_id], note_id)
+                )
+            elif pattern.search(lower):
+                length, position = best_match(pattern, lower)
+                ranked.append((2, length, position, -recency_[note_id], note_id))
+
+        best = heapq.nsmallest(self.limit, ranked)
+        return [self._names[note_id] for *_, note_id in best]  # type: ignore[misc]
+
+    def get_completions(
+        self, document: Document, complete_event: CompleteEvent
+    ) -> Iterator[Completion]:
+        text = document.text_before_cursor
+        display_meta = self.display_meta
+
+        for name in self.search(text):
+            yield Completion(
+                name,
+                start_position=-len(text),
+                display_meta=(
+                    None
+                    if display_meta is None
+                    # Completion calls this lazily, when the menu is rendered
+                    # (for every completion, to size the menu's meta column)
+                    else lambda name=name: display_meta(name)
+                ),
+            )
+
+
+def recency(date_modified: datetime | None) -> float:
+    """
+    Convert a modification date to a number that is larger for newer notes
+    """
+
+    return date_modified.timestamp() if date_modified is not None else 0.0
+
+
+def split_tags(text: str) -> tuple[list[str], str]:
+    """
+    Split the #tags at the start of a query from the rest of it
+
+    :return: The tags (without the #), and the rest of the query
+    """
+
+    tags: list[str] = []
+    rest = text.lstrip()
+
+    while rest.startswith("#"):
+        tag, _, rest = rest.partition(" ")
+        if len(tag) > 1:
+            tags.append(tag[1:])
+        rest = rest.lstrip()
+
+    return tags, rest
+
+
+def best_match(pattern: re.Pattern[str], text: str) -> tuple[int, int]:
+    """
+    Find the shortest match of a fuzzy pattern in text, which must match it
+
+    :return: The (length, start) of the shortest match
+    """
+
+    best: tuple[int, int] | None = None
+    position = 0
+
+    while True:
+        match = pattern.search(text, position)
+        if match is None:
+            assert best is not None
+            return best
+
+        candidate = (match.end() - match.start(), match.start())
+        if best is None or candidate < best:
+            best = candidate
+
+        position = match.start() + 1
@@ -0,0 +1,349 @@
+"""
+Reading and writing notes, shared by the editor and the headless commands
+"""
+
+from datetime import datetime
+from sqlite3 import Connection
+from typing import TypedDict
+
+from qwtd import blobs
+from qwtd import changelog
+from qwtd import chunks
+from qwtd import links
+from qwtd import revisions
+from qwtd import storage
+
+
+class ConflictError(Exception):
+    """
+    Raised when saving a note that was saved by someone else (e.g. another qwtd
+    instance) since the version the save was based on
+    """
+
+    def __init__(self, name: str):
+        super().__init__(f"Note {name!r} was changed since it was read")
+        self.name: str = name
+
+
+def new_note_content(name: str) -> str:
+    """
+    The initial content of a note that doesn't exist yet
+    """
+
+    return f"# {name}\n\n"
+
+
+def read_note(
+    connection: Connection, name: str
+) -> tuple[str, bool, datetime, int] | None:
+    """
+    Read a note from the database
+
+    :return: A (content, deleted, expires, version) tuple, or None if the note
+        doesn't exist. The version can be passed to save_note to make sure the
+        save doesn't overwrite changes made since.
+    """
+
+    result: (
+        tuple[str | None, str | bytes | None, str | None, int, datetime, int] | None
+    ) = connection.execute(
+        """
+        SELECT notes.codec, blobs.content, blobs.codec, deleted, expires, version
+        FROM notes LEFT JOIN blobs ON blobs.hash = notes.content_hash
+        WHERE notes.name = ?
+        """,
+        (name,),
+    ).fetchone()
+
+    if result is None:
+        return None
+
+    note_codec, content, codec, deleted, expires, version = result
+
+    if note_codec == chunks.CHUNKED:
+        text = chunks.read_chunked(connection, name)
+    else:
+        text = storage.decode_content(content, codec)
+
+    return text, deleted != 0, expires, version
+
+
+def is_chunked(connection: Connection, name: str) -> bool:
+    """
+    Check whether a note is stored in chunks (see chunks.py)
+    """
+
+    result = connection.execute(
+        "SELECT codec FROM notes WHERE name = ?", (name,)
+    ).fetchone()
+
+    return result is not None and result[0] == chunks.CHUNKED
+
+
+# Create a note, or replace the content of an existing one (restoring it if it
+# was deleted). This is an upsert rather than INSERT OR REPLACE so that the row
+# (and its rowid) is updated in place, which the full-text index relies on.
+#
+# The content itself is stored in blobs (see blobs.store_blob), which must hold
+# :content_hash before this runs, unless the note is chunked.
+#
+# Every save increments the note's version. If :version isn't NULL, an existing
+# note is only updated if it's still at that version (and nothing is changed
+# otherwise), which makes saving a compare-and-swap.
+UPSERT_NOTE: str = """
+    INSERT
+    INTO notes (
+        name, codec, content_hash, date_modified, deleted, expires, version
+    )
+    VALUES (
+        :name, :codec, :content_hash, :date_modified, 0, :date_modified, 1
+    )
+    ON CONFLICT(name) DO UPDATE SET
+        codec = excluded.codec,
+        content_hash = excluded.content_hash,
+        date_modified = excluded.date_modified,
+        deleted = 0,
+        expires = excluded.expires,
+        version = notes.version + 1
+    WHERE :version IS NULL OR notes.version = :version
+"""
+
+
+class NoteRow(TypedDict):
+    """
+    The parameters of UPSERT_NOTE
+    """
+
+    name: str
+    # chunks.CHUNKED, or None if the content is in blobs
+    codec: str | None
+    content_hash: str
+    date_modified: datetime
+    # The version the note must be at to be overwritten (None for any)
+    version: int | None
+
+
+def note_row(
+    name: str,
+    content: str,
+    now: datetime,
+    chunked: bool = False,
+    version: int | None = None,
+) -> NoteRow:
+    """
+    Build the parameters of UPSERT_NOTE for a note
+
+    :param chunked: Whether the content is stored in chunks rather than in a
+        blob
+    :param version: The version the note must be at to be overwritten, or None
+        to overwrite it regardless
+    """
+
+    return {
+        "name": name,
+        "codec": chunks.CHUNKED if chunked else None,
+        "content_hash": storage.content_hash(content),
+        "date_modified": now,
+        "version": version,
+    }
+
+
+def begin_write(connection: Connection):
+    """
+    Start a write transaction, unless one is already in progress
+
+    Saving first reads what is stored (to skip writing content that didn't
+    change), so it takes the write lock before that rather than when it first
+    writes, and nothing can change in between.
+    """
+
+    if not connection.in_transaction:
+        connection.execute("BEGIN IMMEDIATE")
+
+
+def stored_state(
+    connection: Connection, name: str
+) -> tuple[str, str | None, int, bool]:
+    """
+    Get what a save compares against: the (content_hash, codec, version,
+    deleted) of a note, or ("", None, 0, False) if it doesn't exist
+    """
+
+    row = connection.execute(
+        "SELECT content_hash, codec, version, deleted FROM notes WHERE name = ?",
+        (name,),
+    ).fetchone()
+
+    if row is None:
+        return "", None, 0, False
+
+    content_hash, codec, version, deleted = row
+    return content_hash, codec, version, deleted != 0
+
+
+def save_note(
+    connection: Connection,
+    name: str,
+    content: str,
+    now: datetime | None = None,
+    version: int | None = None,
+    replicate: bool = True,
+) -> int:
+    """
+    Save content to a note (creating or restoring it) and record a revision
+
+    If the content didn't change, only the note's metadata (modification date,
+    version, ...) is updated: no blob, revision, chunk or index is written.
+
+    This starts a write transaction but doesn't commit, so callers can group
+    several saves in one transaction.
+
+    :param version: The version of the note that content is based on (from
+        read_note, or 0 for a note that didn't exist), or None to overwrite the
+        note whatever its version is
+    :param replicate: Whether to record the change for other devices (see
+        changelog.py), which changes received from them aren't
+    :raises ConflictError: If the note was saved by someone else since version
+        (in which case nothing was written)
+    :return: The note's new version
+    """
+
+    if now is None:
+        now = datetime.now()
+
+    begin_write(connection)
+
+    stored_hash, stored_codec, stored_version, was_deleted = stored_state(
+        connection, name
+    )
+    if version is not None and version != stored_version:
+        raise ConflictError(name)
+
+    is_large = chunks.should_chunk(content)
+    row = note_row(name, content, now, is_large, version)
+    changed = (row["content_hash"], row["codec"]) != (stored_hash, stored_codec)
+
+    if changed and not is_large:
+        blobs.store_blob(connection, row["content_hash"], content)
+
+    result = connection.execute(UPSERT_NOTE + " RETURNING version", row).fetchone()
+
+    if result is None:
+        raise ConflictError(name)
+
+    if changed:
+        store_content(connection, name, content, now, is_large)
+        # The note's previous content may not be used by any note now
+        blobs.collect_garbage(connection)
+
+    if replicate and (changed or was_deleted):
+        changelog.record_change(
+            connection, changelog.UPSERT if changed else changelog.RESTORE, name
+        )
+
+    return result[0]
+
+
+def save_notes(
+    connection: Connection,
+    notes: list[tuple[str, str]],
+    now: datetime | None = None,
+):
+    """
+    Save many (name, content) pairs at once, in a single executemany
+
+    Notes of at least chunk_threshold bytes are stored in chunks, and don't get
+    revisions (diffing them on every save would defeat the point). As in
+    save_note, notes whose content didn't change only have their metadata
+    updated, and this doesn't commit.
+    """
+
+    if now is None:
+        now = datetime.now()
+
+    begin_write(connection)
+
+    rows = [
+        note_row(name, content, now, chunks.should_chunk(content))
+        for name, content in notes
+    ]
+    states = [stored_state(connection, name) for name, _ in notes]
+    changed = [
+        (row["content_hash"], row["codec"]) != state[:2]
+        for row, state in zip(rows, states)
+    ]
+
+    for (_, content), row, is_changed in zip(notes, rows, changed):
+        if is_changed and row["codec"] is None:
+            blobs.store_blob(connection, row["content_hash"], content)
+
+    connection.executemany(UPSERT_NOTE, rows)
+
+    for (name, content), row, is_changed, state in zip(notes, rows, changed, states):
+        if is_changed:
+            store_content(connection, name, content, now, row["codec"] is not None)
+            changelog.record_change(connection, changelog.UPSERT, name)
+        elif state[3]:
+            changelog.record_change(connection, changelog.RESTORE, name)
+
+    blobs.collect_garbage(connection)
+
+
+def set_deleted(
+    connection: Connection,
+    name: str,
+    expires: datetime | None,
+    replicate: bool = True,
+):
+    """
+    Delete a note until expires, or restore it if expires is None
+
+    Like save_note, this doesn't commit.
+
+    :param replicate: As for save_note
+    """
+
+    if expires is not None:
+        cursor = connection.execute(
+            """
+            UPDATE notes
+            SET deleted = 1,
+                expires = ?
+            WHERE name = ?
+            """,
+            (expires, name),
+        )
+    else:
+        cursor = connection.execute(
+            """
+            UPDATE notes
+            SET deleted = 0
+            WHERE name = ?
+            """,
+            (name,),
+        )
+
+    if replicate and cursor.rowcount:
+        changelog.record_change(
+            connection,
+            changelog.DELETE if expires is not None else changelog.RESTORE,
+            name,
+            expires,
+        )
+
+
+def store_content(
+    connection: Connection, name: str, content: str, now: datetime, is_large: bool
+):
+    """
+    Store what doesn't fit in a note's row after it's saved: the chunks of a
+    large note, or otherwise a revision. Its links and tags are indexed too.
+    """
+
+    if is_large:
+        chunks.write_chunks(connection, name, content)
+    else:
+        chunks.delete_chunks(connection, name)
+        revisions.record_revision(connection, name, content, now)
+
+    links.index_note(connection, name, content)
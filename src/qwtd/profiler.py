@@ -0,0 +1,452 @@
+"""
+Opt-in profiling of a qwtd session (qwtd --profile, or `profile` in the config)
+
+Records how long SQL statements, rendering, key presses (until the next paint),
+the lexer and editor operations take, and how much memory each operation
+allocated at its peak. The profile is written as a Chrome trace, which can be
+opened in chrome://tracing, https://ui.perfetto.dev or https://speedscope.app
+(as a flame graph), and summarized on exit.
+"""
+
+import functools
+import inspect
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, TextIO, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # prompt_toolkit is only imported by the TUI
+    from prompt_toolkit import Application
+    from prompt_toolkit.document import Document
+    from prompt_toolkit.formatted_text import StyleAndTextTuples
+    from prompt_toolkit.lexers import Lexer
+
+# Stop recording individual events after this many (totals are still kept), so
+# a long session can't use unbounded memory
+MAX_EVENTS: int = 200_000
+
+# SQL statements are named by their first this many characters
+SQL_NAME_LENGTH: int = 60
+
+# How many of the slowest statements and operations to list in the summary
+SUMMARY_ROWS: int = 10
+
+
+@dataclass
+class Stat:
+    """
+    Totals for one kind of event
+    """
+
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+
+class Profiler:
+    """
+    Records timed events from every part of qwtd that is given it
+
+    When disabled, nothing is recorded and every hook is close to free, so a
+    profiler can be threaded through qwtd unconditionally (like StartupTrace).
+    """
+
+    def __init__(self, enabled: bool, path: str = ""):
+        """
+        Create a new Profiler
+
+        :param enabled: Whether to record anything
+        :type enabled: bool
+        :param path: Where to write the profile when the session ends
+        :type path: str
+        """
+
+        self.enabled: bool = enabled
+        self.path: str = path
+        self.started: float = time.perf_counter()
+
+        # Chrome trace events, and totals by (category, name)
+        self.events: list[dict[str, Any]] = []
+        self.dropped_events: int = 0
+        self.stats: dict[tuple[str, str], Stat] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+        # Operations on each thread that are in progress, so memory is only
+        # measured for the outermost one
+        self._local: threading.local = threading.local()
+
+        # For the status bar overlay: the latest measurements
+        self.last: dict[str, float] = {}
+        self.last_peak: int = 0
+        self._key_pressed: float | None = None
+        self._render_started: float = 0.0
+        self._key_started: float = 0.0
+        self._sql_since_paint: Stat = Stat()
+
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def record(
+        self,
+        category: str,
+        name: str,
+        start: float,
+        duration: float,
+        args: dict[str, Any] | None = None,
+    ):
+        """
+        Record an event that started at start (a perf_counter time) and took
+        duration seconds
+        """
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            stat = self.stats.get((category, name))
+            if stat is None:
+                stat = self.stats[(category, name)] = Stat()
+            stat.add(duration)
+
+            if category == "sql":
+                self._sql_since_paint.add(duration)
+
+            if len(self.events) >= MAX_EVENTS:
+                self.dropped_events += 1
+                return
+
+            event: dict[str, Any] = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.started) * 1e6,
+                "dur": duration * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+            }
+            if args:
+                event["args"] = args
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, category: str, name: str) -> Iterator[None]:
+        """
+        Time the body of a with block
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(category, name, start, time.perf_counter() - start)
+
+    @contextmanager
+    def operation(self, name: str) -> Iterator[None]:
+        """
+        Time the body of a with block as an editor operation, also measuring the
+        peak memory it allocated
+
+        tracemalloc's peak is process-wide, so an operation that runs at the
+        same time as one on another thread may be charged for its allocations.
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        depth: int = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+
+        if depth == 0:
+            tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            # Coroutines on the same thread can interleave, so don't just restore
+            # the old depth
+            self._local.depth -= 1
+
+            args: dict[str, Any] = {}
+            if depth == 0:
+                peak = max(0, tracemalloc.get_traced_memory()[1] - baseline)
+                args["peak_bytes"] = peak
+                self.last_peak = peak
+
+            self.record("operation", name, start, duration, args)
+
+    def connection_factory(self) -> type[sqlite3.Connection]:
+        """
+        Get the class that connections should be made with (see
+        sqlite3.connect's factory), which times every statement when enabled
+        """
+
+        if not self.enabled:
+            return sqlite3.Connection
+
+        return type("ProfiledConnection", (ProfiledConnection,), {"profiler": self})
+
+    def wrap_lexer(self, lexer: "Lexer") -> "Lexer":
+        """
+        Time every line the lexer is asked for, if enabled
+        """
+
+        if not self.enabled:
+            return lexer
+
+        from prompt_toolkit.lexers import Lexer
+
+        profiler = self
+
+        class ProfiledLexer(Lexer):
+            def lex_document(
+                self, document: "Document"
+            ) -> Callable[[int], "StyleAndTextTuples"]:
+                get_line = lexer.lex_document(document)
+
+                def profiled_get_line(lineno: int) -> "StyleAndTextTuples":
+                    with profiler.span("lexer", "lex_line"):
+                        return get_line(lineno)
+
+                return profiled_get_line
+
+            def invalidation_hash(self) -> Any:
+                return lexer.invalidation_hash()
+
+        return ProfiledLexer()
+
+    def attach(self, app: "Application[Any]"):
+        """
+        Time rendering, key handling and keystroke-to-paint latency in an app
+        """
+
+        if not self.enabled:
+            return
+
+        def before_key_press(_: object):
+            self._key_started = time.perf_counter()
+            if self._key_pressed is None:
+                self._key_pressed = self._key_started
+
+        def after_key_press(_: object):
+            self.record(
+                "input",
+                "key",
+                self._key_started,
+                time.perf_counter() - self._key_started,
+            )
+
+        def before_render(_: object):
+            self._render_started = time.perf_counter()
+
+        def after_render(_: object):
+            now = time.perf_counter()
+            self.last["render"] = now - self._render_started
+            self.record("render", "render", self._render_started, self.last["render"])
+
+            # Latency from the first key pressed since the last paint until the
+            # screen showed its result
+            if self._key_pressed is not None:
+                self.last["key_to_paint"] = now - self._key_pressed
+                self.record(
+                    "input", "key_to_paint", self._key_pressed, now - self._key_pressed
+                )
+                self._key_pressed = None
+
+            with self._lock:
+                self.last["sql_count"] = self._sql_since_paint.count
+                self.last["sql"] = self._sql_since_paint.total
+                self._sql_since_paint = Stat()
+
+        app.key_processor.before_key_press += before_key_press
+        app.key_processor.after_key_press += after_key_press
+        app.before_render += before_render
+        app.after_render += after_render
+
+    def overlay(self) -> str:
+        """
+        Summarize the latest measurements in one short line (for the status bar)
+        """
+
+        last = self.last
+        return (
+            f"render {last.get('render', 0) * 1e3:.1f}ms "
+            f"key {last.get('key_to_paint', 0) * 1e3:.1f}ms "
+            f"sql {last.get('sql_count', 0):.0f}q/{last.get('sql', 0) * 1e3:.1f}ms "
+            f"mem {self.last_peak / 1024:.0f}KiB"
+        )
+
+    def write(self) -> None:
+        """
+        Write the profile to self.path as a Chrome trace, if enabled
+        """
+
+        if not self.enabled or not self.path:
+            return
+
+        with self._lock:
+            profile = {
+                "traceEvents": self.events,
+                "displayTimeUnit": "ms",
+                "otherData": {
+                    "dropped_events": self.dropped_events,
+                    "stats": [
+                        {
+                            "category": category,
+                            "name": name,
+                            "count": stat.count,
+                            "total_ms": stat.total * 1e3,
+                            "max_ms": stat.max * 1e3,
+                        }
+                        for (category, name), stat in self.stats.items()
+                    ],
+                },
+            }
+
+            try:
+                with open(
+                    os.path.expanduser(self.path), "w", encoding="utf-8"
+                ) as file:
+                    json.dump(profile, file)
+            except OSError as e:
+                print(f"[QWTD] Error: Couldn't write profile ({e})", file=sys.stderr)
+                self.path = ""
+
+    def report(self, file: TextIO = sys.stderr) -> None:
+        """
+        Print where the time went, if enabled
+        """
+
+        if not self.enabled:
+            return
+
+        # Individual statements and operations are listed below, by category
+        totals: dict[str, Stat] = {}
+        for (category, name), stat in self.stats.items():
+            if category in ("sql", "operation"):
+                name = category
+            total = totals.setdefault(name, Stat())
+            total.count += stat.count
+            total.total += stat.total
+            total.max = max(total.max, stat.max)
+
+        print("[QWTD] Profile:", file=file)
+        for name, stat in sorted(totals.items()):
+            print(f"[QWTD]   {name:<14} {format_stat(stat)}", file=file)
+
+        for category in ("sql", "operation"):
+            slowest = sorted(
+                (
+                    (name, stat)
+                    for (category_, name), stat in self.stats.items()
+                    if category_ == category
+                ),
+                key=lambda item: item[1].total,
+                reverse=True,
+            )[:SUMMARY_ROWS]
+
+            if slowest:
+                print(f"[QWTD] Slowest ({category}, by total time):", file=file)
+            for name, stat in slowest:
+                print(f"[QWTD]   {format_stat(stat)}  {name}", file=file)
+
+        if self.path:
+            print(f"[QWTD] Profile written to {self.path}", file=file)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """
+    Connection that times every statement it executes (and every commit)
+
+    Only statements run through the connection are timed, not ones run on a
+    cursor from connection.cursor(). For queries, the time includes reading the
+    first row but not the rest.
+    """
+
+    # Set on the subclass made by Profiler.connection_factory
+    profiler: Profiler
+
+    def execute(self, sql: str, parameters: Any = (), /) -> sqlite3.Cursor:
+        with self.profiler.span("sql", sql_name(sql)):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters: Any, /) -> sqlite3.Cursor:
+        with self.profiler.span("sql", sql_name(sql)):
+            return super().executemany(sql, parameters)
+
+    def executescript(self, sql_script: str, /) -> sqlite3.Cursor:
+        with self.profiler.span("sql", sql_name(sql_script)):
+            return super().executescript(sql_script)
+
+    def commit(self) -> None:
+        with self.profiler.span("sql", "COMMIT"):
+            super().commit()
+
+
+@functools.lru_cache(maxsize=1024)
+def sql_name(sql: str) -> str:
+    """
+    Name a statement by its start, with whitespace collapsed
+    """
+
+    name = re.sub(r"\s+", " ", sql).strip()
+    if len(name) > SQL_NAME_LENGTH:
+        name = name[: SQL_NAME_LENGTH - 3] + "..."
+
+    return name
+
+
+def format_stat(stat: Stat) -> str:
+    """
+    Format a Stat as its count, total, mean and max
+    """
+
+    mean = stat.total / stat.count if stat.count else 0.0
+    return (
+        f"{stat.count:>7} x  total {stat.total * 1e3:9.2f} ms  "
+        f"mean {mean * 1e3:7.3f} ms  max {stat.max * 1e3:8.2f} ms"
+    )
+
+
+def profiled(method: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Decorator that profiles every call of a method as an operation named after
+    it, using the profiler attribute of the object it's called on
+    """
+
+    if inspect.iscoroutinefunction(method):
+
+        @functools.wraps(method)
+        async def async_wrapper(self: Any, *args: Any, **kwargs: Any) -> Any:
+            with self.profiler.operation(method.__name__):
+                return await method(self, *args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self: Any, *args: Any, **kwargs: Any) -> Any:
+        with self.profiler.operation(method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,130 @@
+"""
+Permanently delete notes whose deletion has expired, in small batches
+"""
+
+from contextlib import AbstractContextManager, nullcontext
+from datetime import datetime
+from sqlite3 import Connection
+
+from qwtd import blobs
+
+# How many notes to delete per transaction, so that a large purge never holds
+# the write lock for long
+PURGE_BATCH_SIZE: int = 200
+
+# How many free pages to give back to the filesystem per incremental_vacuum
+VACUUM_PAGES: int = 1024
+
+# How many pages of the full-text index to merge per step when compacting it
+MERGE_PAGES: int = 256
+
+
+def purge_expired(
+    connection: Connection,
+    now: datetime | None = None,
+    keep: str | None = None,
+    lock: AbstractContextManager[object] | None = None,
+    batch_size: int = PURGE_BATCH_SIZE,
+) -> list[str]:
+    """
+    Permanently delete every deleted note that has expired, then shrink the
+    database file
+
+    Notes are deleted (and committed) batch_size at a time, using the
+    notes_expired index to find them, along with the blobs of content that no
+    other note has. The full-text index (which only records deletions until its
+    segments are merged) is then compacted, and the free pages left behind are
+    released with incremental_vacuum.
+
+    :param keep: A note not to delete even if it has expired (e.g. the note
+        that is open in the editor)
+    :param lock: Lock (or any context manager, e.g. an RLock) to hold while
+        using the connection, if it is shared
+    :return: The names of the notes that were deleted
+    """
+
+    if now is None:
+        now = datetime.now()
+    guard = lock if lock is not None else nullcontext()
+
+    purged: list[str] = []
+
+    while True:
+        with guard:
+            names = connection.execute(
+                """
+                DELETE FROM notes
+                WHERE rowid IN (
+                    SELECT rowid FROM notes
+                    WHERE deleted = 1 AND expires < ? AND name IS NOT ?
+                    LIMIT ?
+                )
+                RETURNING name
+                """,
+                (now, keep, batch_size),
+            ).fetchall()
+            blobs.collect_garbage(connection)
+            connection.commit()
+
+        purged.extend(name for name, in names)
+
+        if len(names) < batch_size:
+            break
+
+    if purged:
+        compact_search_index(connection, lock)
+        vacuum(connection, lock)
+
+    return purged
+
+
+def compact_search_index(
+    connection: Connection, lock: AbstractContextManager[object] | None = None
+):
+    """
+    Merge the segments of the full-text index, MERGE_PAGES at a time, so that
+    the entries of deleted notes are actually removed from it
+    """
+
+    guard = lock if lock is not None else nullcontext()
+
+    while True:
+        with guard:
+            changes = connection.total_changes
+            connection.execute(
+                "INSERT INTO notes_fts(notes_fts, rank) VALUES('merge', ?)",
+                (-MERGE_PAGES,),
+            )
+            connection.commit()
+
+            # A merge step that had nothing left to do changes fewer than 2 rows
+            if connection.total_changes - changes < 2:
+                return
+
+
+def vacuum(
+    connection: Connection, lock: AbstractContextManager[object] | None = None
+):
+    """
+    Return free pages to the filesystem, VACUUM_PAGES at a time
+
+    This only does anything if the database uses auto_vacuum=INCREMENTAL
+    (databases created or migrated since schema version 8 do).
+    """
+
+    guard = lock if lock is not None else nullcontext()
+
+    while True:
+        with guard:
+            free_pages: int = connection.execute("PRAGMA freelist_count").fetchone()[0]
+            if free_pages == 0:
+                return
+
+            # Each step of this pragma frees one page, so it has to be run to
+            # completion
+            connection.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+            connection.commit()
+
+            if connection.execute("PRAGMA freelist_count").fetchone()[0] >= free_pages:
+                # Nothing was released (auto_vacuum isn't incremental)
+                return
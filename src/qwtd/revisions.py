@@ -0,0 +1,266 @@
+"""
+Revision history for notes, stored as line deltas between keyframes
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
+from sqlite3 import Connection
+
+from qwtd import config
+from qwtd import storage
+
+# difflib and json are imported where they are used, since this module is
+# imported on startup but they are only needed when saving or reading history
+
+
+@dataclass(frozen=True)
+class Revision:
+    """
+    A summary of one saved revision of a note
+    """
+
+    revision: int
+    date: datetime
+    keyframe: bool
+    # Length of the content, in characters
+    size: int
+
+
+def make_delta(base: str, content: str) -> str:
+    """
+    Encode content as a delta against base
+
+    The delta is a JSON list of operations on lines: an integer pair [start,
+    count] copies lines from base, and a string inserts new text.
+    """
+
+    import difflib
+    import json
+
+    base_lines = base.splitlines(keepends=True)
+    content_lines = content.splitlines(keepends=True)
+
+    ops: list[list[int] | str] = []
+    matcher = difflib.SequenceMatcher(None, base_lines, content_lines, autojunk=False)
+
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2 - i1])
+        elif j2 > j1:
+            ops.append("".join(content_lines[j1:j2]))
+
+    return json.dumps(ops, ensure_ascii=False, separators=(",", ":"))
+
+
+def apply_delta(base: str, delta: str) -> str:
+    """
+    Rebuild content from base and a delta created by make_delta
+    """
+
+    import json
+
+    base_lines = base.splitlines(keepends=True)
+    parts: list[str] = []
+
+    for op in json.loads(delta):
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            start, count = op
+            parts.extend(base_lines[start : start + count])
+
+    return "".join(parts)
+
+
+def latest_revision(connection: Connection, note: str) -> int:
+    """
+    Get the number of the latest revision of a note, or 0 if it has none
+    """
+
+    row = connection.execute(
+        "SELECT MAX(revision) FROM revisions WHERE note = ?", (note,)
+    ).fetchone()
+
+    return row[0] or 0
+
+
+def list_revisions(connection: Connection, note: str) -> list[Revision]:
+    """
+    List every stored revision of a note, oldest first
+    """
+
+    res = connection.execute(
+        """
+        SELECT revision, date, keyframe, size
+        FROM revisions WHERE note = ?
+        ORDER BY revision ASC
+        """,
+        (note,),
+    )
+
+    return [
+        Revision(revision, date, keyframe == 1, size)
+        for revision, date, keyframe, size in res
+    ]
+
+
+def get_revision(connection: Connection, note: str, revision: int) -> str:
+    """
+    Rebuild the content of a note at a revision
+
+    This reads the nearest keyframe at or before the revision and applies the
+    deltas after it, so it never applies more than the keyframe interval's
+    worth of deltas.
+    """
+
+    res = connection.execute(
+        """
+        SELECT revision, data, codec FROM revisions
+        WHERE note = :note
+            AND revision <= :revision
+            AND revision >= (
+                SELECT MAX(revision) FROM revisions
+                WHERE note = :note AND revision <= :revision AND keyframe = 1
+            )
+        ORDER BY revision ASC
+        """,
+        {"note": note, "revision": revision},
+    )
+
+    found = res.fetchall()
+    if not found or found[-1][0] != revision:
+        raise KeyError(f"Note {note!r} has no revision {revision}")
+
+    rows = [storage.decode_content(data, codec) for _, data, codec in found]
+
+    content = rows[0]
+    for delta in rows[1:]:
+        content = apply_delta(content, delta)
+
+    return content
+
+
+def diff_revisions(connection: Connection, note: str, old: int, new: int) -> str:
+    """
+    Show the changes between two revisions of a note as a unified diff
+    """
+
+    import difflib
+
+    return "".join(
+        difflib.unified_diff(
+            get_revision(connection, note, old).splitlines(keepends=True),
+            get_revision(connection, note, new).splitlines(keepends=True),
+            fromfile=f"{note}@{old}",
+            tofile=f"{note}@{new}",
+        )
+    )
+
+
+def record_revision(
+    connection: Connection, note: str, content: str, date: datetime
+) -> int:
+    """
+    Store content as the newest revision of a note, then apply retention
+
+    The revision is stored as a delta against the previous one, except every
+    revision_keyframe_interval revisions (or when the delta wouldn't be any
+    smaller), where the full content is stored instead. This doesn't commit, so
+    that the revision is saved in the same transaction as the note itself.
+
+    :return: The number of the new revision (or the latest one, if the content
+        is unchanged)
+    """
+
+    interval = max(1, config.get_config().revision_keyframe_interval)
+
+    previous = connection.execute(
+        """
+        SELECT
+            revision,
+            (SELECT MAX(revision) FROM revisions WHERE note = ? AND keyframe = 1)
+        FROM revisions WHERE note = ?
+        ORDER BY revision DESC LIMIT 1
+        """,
+        (note, note),
+    ).fetchone()
+
+    if previous is None:
+        revision, keyframe, data = 1, True, content
+    else:
+        last_revision, last_keyframe = previous
+        base = get_revision(connection, note, last_revision)
+
+        if base == content:
+            return last_revision
+
+        revision = last_revision + 1
+        keyframe = revision - last_keyframe >= interval
+        data = content
+
+        if not keyframe:
+            data = make_delta(base, content)
+            if len(data) >= len(content):
+                keyframe, data = True, content
+
+    connection.execute(
+        """
+        INSERT INTO revisions (note, revision, date, keyframe, size, data, codec)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            note,
+            revision,
+            date,
+            int(keyframe),
+            len(content),
+            *storage.encode_content(data),
+        ),
+    )
+
+    apply_retention(connection, note)
+
+    return revision
+
+
+def apply_retention(connection: Connection, note: str) -> None:
+    """
+    Drop the revisions of a note that are older than the retention policy allows
+
+    If the oldest revision that is kept is a delta, it is turned into a keyframe
+    first, so every kept revision can still be rebuilt.
+    """
+
+    max_revisions = config.get_config().max_revisions
+    if max_revisions <= 0:
+        return
+
+    oldest_kept = latest_revision(connection, note) - max_revisions + 1
+    if oldest_kept <= 1:
+        return
+
+    row = connection.execute(
+        "SELECT keyframe FROM revisions WHERE note = ? AND revision = ?",
+        (note, oldest_kept),
+    ).fetchone()
+
+    if row is not None and row[0] != 1:
+        connection.execute(
+            """
+            UPDATE revisions
+            SET keyframe = 1,
+                data = ?,
+                codec = ?
+            WHERE note = ? AND revision = ?
+            """,
+            (
+                *storage.encode_content(get_revision(connection, note, oldest_kept)),
+                note,
+                oldest_kept,
+            ),
+        )
+
+    connection.execute(
+        "DELETE FROM revisions WHERE note = ? AND revision < ?",
+        (note, oldest_kept),
+    )
@@ -0,0 +1,165 @@
+"""
+Full-text search over note content through the notes_fts index
+"""
+
+import sqlite3
+import threading
+from collections.abc import Iterable
+from sqlite3 import Connection
+
+from prompt_toolkit.completion import CompleteEvent, Completer, Completion
+from prompt_toolkit.document import Document
+from prompt_toolkit.formatted_text import FormattedText
+
+from qwtd.db_wrapper import connect
+from qwtd.profiler import Profiler
+
+# Markers placed around matches by snippet(), chosen so they never appear in notes
+MATCH_START: str = "\x02"
+MATCH_END: str = "\x03"
+
+
+def build_match_query(text: str) -> str:
+    """
+    Turn user input into an FTS5 MATCH expression
+
+    Every word is quoted so that FTS5 operators in the input are matched
+    literally, and the last word is a prefix query so results update as the
+    user types.
+
+    :param text: The text typed into the search box
+    :type text: str
+    """
+
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+
+    if not terms:
+        return ""
+
+    terms[-1] += "*"
+
+    return " ".join(terms)
+
+
+def format_snippet(snippet: str) -> FormattedText:
+    """
+    Convert a snippet with match markers into formatted text on a single line
+    """
+
+    fragments: list[tuple[str, str]] = []
+    style = "class:completion-menu.meta.completion"
+
+    for i, part in enumerate(" ".join(snippet.split()).split(MATCH_START)):
+        if i == 0:
+            fragments.append((style, part))
+            continue
+
+        match, _, rest = part.partition(MATCH_END)
+        fragments.append((style + " class:search-match", match))
+        fragments.append((style, rest))
+
+    return FormattedText(fragments)
+
+
+def search_notes(
+    connection: Connection, query: str, limit: int
+) -> list[tuple[str, str]]:
+    """
+    Run a MATCH expression (see build_match_query) against the index
+
+    :return: Up to limit (note name, snippet) pairs, best match first, with
+        MATCH_START and MATCH_END around the matches in each snippet
+    """
+
+    return connection.execute(
+        f"""
+        SELECT
+            name,
+            snippet(notes_fts, 1, '{MATCH_START}', '{MATCH_END}', '…', 12)
+        FROM notes_fts
+        WHERE notes_fts MATCH ?
+        ORDER BY rank
+        LIMIT ?
+        """,
+        (query, limit),
+    ).fetchall()
+
+
+def plain_snippet(snippet: str) -> str:
+    """
+    Convert a snippet with match markers into plain text on a single line
+    """
+
+    return " ".join(snippet.split()).replace(MATCH_START, "").replace(MATCH_END, "")
+
+
+class NoteSearchCompleter(Completer):
+    """
+    Completer that ranks notes by how well their content matches the input
+
+    Searches run on their own connection so that they can be used from a
+    ThreadedCompleter. A search that is still running when a newer one starts
+    is interrupted, so only the latest input is ever waited on.
+    """
+
+    def __init__(
+        self, db_path: str, limit: int = 20, profiler: Profiler | None = None
+    ):
+        """
+        Create a new NoteSearchCompleter, opening its connection
+
+        :param db_path: Path to the database file
+        :type db_path: str
+        :param limit: The maximum number of results to show
+        :type limit: int
+        :param profiler: Profiler to time the searches' statements with
+        :type profiler: Profiler
+        """
+
+        self.db_path: str = db_path
+        self.limit: int = limit
+
+        self._connection: Connection = connect(db_path, profiler)
+        self._connection.execute("PRAGMA query_only=ON")
+        self._lock: threading.Lock = threading.Lock()
+
+    def search(self, text: str) -> list[tuple[str, str]]:
+        """
+        Find the notes that best match the text
+
+        :return: A list of (note name, snippet) pairs, best match first
+        """
+
+        query = build_match_query(text)
+        if not query:
+            return []
+
+        # Cancel whatever search is still in progress, then wait for our turn
+        self._connection.interrupt()
+
+        with self._lock:
+            try:
+                return search_notes(self._connection, query, self.limit)
+            except sqlite3.OperationalError:
+                # Interrupted by a newer search, or the query wasn't valid
+                return []
+
+    def close(self) -> None:
+        """
+        Close the connection, once any search still running has been interrupted
+        """
+
+        self._connection.interrupt()
+
+        with self._lock:
+            self._connection.close()
+
+    def get_completions(
+        self, document: Document, complete_event: CompleteEvent
+    ) -> Iterable[Completion]:
+        for name, snippet in self.search(document.text):
+            yield Completion(
+                text=name,
+                start_position=-len(document.text),
+                display_meta=format_snippet(snippet),
+            )
@@ -0,0 +1,75 @@
+"""
+Measure how long each phase of startup takes (qwtd --startup-trace)
+"""
+
+import sys
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import TextIO
+
+
+class StartupTrace:
+    """
+    Records the duration of named startup phases and reports them on request
+
+    When disabled, phases are still run but nothing is recorded, so the trace
+    can be threaded through startup unconditionally.
+    """
+
+    def __init__(self, enabled: bool):
+        """
+        Create a new StartupTrace
+
+        :param enabled: Whether to record anything
+        :type enabled: bool
+        """
+
+        self.enabled: bool = enabled
+        self.started: float = time.perf_counter()
+        self.phases: list[tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Time the body of a with block as a phase
+        """
+
+        finish = self.start_phase(name)
+        try:
+            yield
+        finally:
+            finish()
+
+    def start_phase(self, name: str) -> Callable[[], None]:
+        """
+        Start timing a phase that ends somewhere else (e.g. in a callback)
+
+        :return: A function that ends the phase. Only the first call counts.
+        """
+
+        start = time.perf_counter()
+        finished = False
+
+        def finish() -> None:
+            nonlocal finished
+            if self.enabled and not finished:
+                self.phases.append((name, time.perf_counter() - start))
+            finished = True
+
+        return finish
+
+    def report(self, file: TextIO = sys.stderr) -> None:
+        """
+        Print the time spent in each phase, if tracing is enabled
+        """
+
+        if not self.enabled:
+            return
+
+        print("[QWTD] Startup trace:", file=file)
+        for name, duration in self.phases:
+            print(f"[QWTD]   {name:<12} {duration * 1000:8.2f} ms", file=file)
+
+        total = sum(duration for _, duration in self.phases)
+        print(f"[QWTD]   {'total':<12} {total * 1000:8.2f} ms", file=file)
@@ -10,6 +10,7 @@ from prompt_toolkit.key_binding import KeyBindings, KeyPressEvent
 from prompt_toolkit.layout.processors import BeforeInput
 from prompt_toolkit.widgets import FormattedTextToolbar
 
+from qwtd import config
 from qwtd.editor import Editor
 
 
@@ -21,6 +22,8 @@ class StandardStatusBar(FormattedTextToolbar):
     """
 
     def __init__(self, editor: Editor):
+        overlay = editor.profiler.enabled and config.get_config().profile_overlay
+
         def get_text():
             app = get_app()
 
@@ -30,12 +33,26 @@ class StandardStatusBar(FormattedTextToolbar):
                 ("", "|"),
             ]
 
+            if editor.message:
+                vi_display += [("class:info", editor.message), ("", "|")]
+
+            if editor.worker.pending_writes:
+                vi_display += [("class:info", "saving..."), ("", "|")]
+
+            if overlay:
+                vi_display += [("class:info", editor.profiler.overlay()), ("", "|")]
+
+            if editor.is_viewing():
+                vi_display += [("class:keys", "i"), ("", ": Edit|")]
+
             if not editor.current_note_deleted:
                 return vi_display + [
                     ("class:keys", "Ctrl+W"),
                     ("", ": Write|"),
                     ("class:keys", "Ctrl+E"),
                     ("", ": Export|"),
+                    ("class:keys", "Ctrl+L"),
+                    ("", ": Links|"),
                     ("class:keys", "Ctrl+Q"),
                     ("", ": Save & Exit|"),
                     ("class:keys", "Ctrl+A"),
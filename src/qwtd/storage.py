@@ -0,0 +1,95 @@
+"""
+Encoding of note content at rest (transparent compression)
+"""
+
+import hashlib
+import zlib
+from sqlite3 import Connection
+
+from qwtd import config
+
+# Codec markers stored alongside compressed content. Uncompressed content has a
+# codec of NULL and is stored as TEXT.
+CODECS: tuple[str, ...] = ("zlib", "lzma")
+
+
+def encode_content(
+    content: str, codec: str | None = None, threshold: int | None = None
+) -> tuple[str | bytes, str | None]:
+    """
+    Encode note content for storage, compressing it if it is large enough
+
+    Content shorter than compress_threshold bytes (or that doesn't get any
+    smaller) is stored as plain text, so small notes don't pay for compression.
+
+    :param codec: The codec to use, instead of the configured one
+    :param threshold: The size threshold to use, instead of the configured one
+    :return: A (value, codec) pair to store in the database
+    """
+
+    if codec is None:
+        codec = config.get_config().compression
+    if threshold is None:
+        threshold = config.get_config().compress_threshold
+
+    if codec not in CODECS:
+        return content, None
+
+    raw = content.encode("utf-8")
+    if len(raw) < threshold:
+        return content, None
+
+    if codec == "zlib":
+        compressed = zlib.compress(raw, 6)
+    else:
+        import lzma  # Only imported if it is actually used
+
+        compressed = lzma.compress(raw, preset=1)
+
+    if len(compressed) >= len(raw):
+        return content, None
+
+    return compressed, codec
+
+
+def decode_content(value: str | bytes | None, codec: str | None) -> str:
+    """
+    Decode content stored by encode_content back into text
+    """
+
+    if value is None:
+        return ""
+
+    match codec:
+        case None:
+            assert isinstance(value, str)
+            return value
+        case "zlib":
+            assert isinstance(value, bytes)
+            return zlib.decompress(value).decode("utf-8")
+        case "lzma":
+            import lzma
+
+            assert isinstance(value, bytes)
+            return lzma.decompress(value).decode("utf-8")
+        case _:
+            raise ValueError(f"Unknown content codec {codec!r}")
+
+
+def content_hash(content: str) -> str:
+    """
+    Hash note content, to detect whether it changed without comparing it
+    """
+
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def register_functions(connection: Connection):
+    """
+    Register the SQL functions that the schema depends on
+
+    The full-text index reads note content through qwtd_decode, so this must be
+    called on every connection that reads or writes notes.
+    """
+
+    connection.create_function("qwtd_decode", 2, decode_content, deterministic=True)
@@ -0,0 +1,400 @@
+"""
+Replication of notes between devices through a shared folder (e.g. one synced
+by Syncthing), without syncing the database itself
+
+Every device appends the changes made on it (see changelog.py) to its own log
+in the sync folder, <device>.qwtdlog, and reads the other devices' logs from
+where it left off. A log is only ever appended to, and only by its device, so
+a sync tool only transfers the new records and never sees conflicting edits
+of a file. How much is read and written per sync depends on the number of
+changes, not on the size of the database.
+
+A log is one JSON record per line:
+
+    {"seq": 12, "op": "upsert", "name": "...", "stamp": ..., "modified": "...",
+     "content": "..."}
+
+seq numbers a device's records in order. "delete" records have "expires"
+instead of "modified" and "content", and "restore" records have neither.
+
+Each note remembers the (stamp, device) of the latest change applied to it,
+and a change from a log is only applied if it is newer. Every device ends up
+applying the same winner for each note, whatever order the logs are read in. A
+local change that loses is still in the note's revision history.
+"""
+
+import json
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from sqlite3 import Connection
+from typing import Any
+
+from qwtd import changelog
+from qwtd import config
+from qwtd import notes
+
+LOG_SUFFIX: str = ".qwtdlog"
+
+# How many records to apply per transaction when reading a log
+SYNC_BATCH_SIZE: int = 500
+
+
+@dataclass
+class SyncResult:
+    """
+    What one sync did
+    """
+
+    # Records appended to this device's log
+    sent: int = 0
+    # Records read from other devices' logs that were applied
+    applied: int = 0
+    # Records that were older than the change the note already had
+    skipped: int = 0
+    # Lines that couldn't be read (e.g. written by a newer version of qwtd)
+    unreadable: int = 0
+
+
+def get_sync_dir() -> str:
+    """
+    Read the config file and return the sync folder
+    """
+
+    return os.path.expanduser(config.get_config().sync_dir)
+
+
+def log_path(directory: str, device: str) -> str:
+    """
+    Get the path of a device's log
+    """
+
+    return os.path.join(directory, device + LOG_SUFFIX)
+
+
+def sync(connection: Connection) -> SyncResult:
+    """
+    Append this device's new changes to its log, then apply the other devices'
+    new changes (committing as it goes)
+    """
+
+    directory = get_sync_dir()
+
+    result = SyncResult()
+    result.sent = flush_outbox(connection, directory)
+    import_logs(connection, directory, result)
+
+    return result
+
+
+def flush_outbox(connection: Connection, directory: str) -> int:
+    """
+    Append the changes recorded since the last flush to this device's log, and
+    remove them from sync_outbox
+
+    The log is written (and fsynced) before the changes are removed, so a crash
+    in between only means they're written again. The other devices skip them
+    the second time, by their seq.
+
+    If the log doesn't exist yet (the first time this device syncs), every
+    note is published first, so the other devices get the notes that existed
+    before syncing was set up.
+
+    :return: How many records were appended
+    """
+
+    path = log_path(directory, changelog.device_name())
+
+    if not os.path.exists(path):
+        publish_all(connection)
+        connection.commit()
+
+    # Hold the write lock until the changes are removed, so that two flushes
+    # (e.g. by the app and a command) never append the same changes at once
+    notes.begin_write(connection)
+
+    rows: list[tuple[int, str, str, int, datetime | None]] = connection.execute(
+        "SELECT seq, op, name, stamp, expires FROM sync_outbox ORDER BY seq"
+    ).fetchall()
+    if not rows:
+        connection.rollback()
+        return 0
+
+    # An upsert's record holds the note's content as it is now, so when a note
+    # was saved several times, only its last upsert needs to be written
+    last_upsert: dict[str, int] = {
+        name: seq for seq, op, name, _, _ in rows if op == changelog.UPSERT
+    }
+
+    lines: list[bytes] = []
+    for seq, op, name, stamp, expires in rows:
+        record: dict[str, Any] = {"seq": seq, "op": op, "name": name, "stamp": stamp}
+
+        if op == changelog.UPSERT:
+            if last_upsert[name] != seq:
+                continue
+
+            note = connection.execute(
+                "SELECT date_modified FROM notes WHERE name = ?", (name,)
+            ).fetchone()
+            read = notes.read_note(connection, name)
+            if note is None or read is None:
+                # Purged since
+                continue
+
+            record["modified"] = note[0].isoformat()
+            record["content"] = read[0]
+        elif op == changelog.DELETE:
+            assert expires is not None
+            record["expires"] = expires.isoformat()
+
+        lines.append(
+            json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode()
+            + b"\n"
+        )
+
+    try:
+        append_log(path, b"".join(lines))
+    except OSError:
+        connection.rollback()
+        raise
+
+    connection.execute("DELETE FROM sync_outbox WHERE seq <= ?", (rows[-1][0],))
+    connection.commit()
+
+    return len(lines)
+
+
+def append_log(path: str, data: bytes):
+    """
+    Append complete lines to a log, and make sure they're on disk
+
+    If the log ends with part of a line (from a write that was interrupted),
+    that part is cut off first. No device has read it, since they only read
+    whole lines.
+    """
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    with open(path, "ab+") as file:
+        size = file.seek(0, os.SEEK_END)
+        if size:
+            file.seek(max(0, size - 1))
+            if file.read(1) != b"\n":
+                file.seek(0)
+                end = file.read().rfind(b"\n") + 1
+                file.truncate(end)
+
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def publish_all(connection: Connection):
+    """
+    Record every note as changed, so that a new log starts with all of them
+
+    Notes are stamped with the stamp of their latest change, or otherwise their
+    modification date, so publishing doesn't make them win over changes made
+    on other devices since. Notes whose latest change came from another device
+    are already in that device's log, so they're left out. Changes that were
+    already waiting in sync_outbox are moved after the published notes.
+    """
+
+    device = changelog.device_name()
+
+    notes.begin_write(connection)
+
+    pending = connection.execute(
+        "SELECT op, name, stamp, expires FROM sync_outbox ORDER BY seq"
+    ).fetchall()
+    connection.execute("DELETE FROM sync_outbox")
+    pending_names = {name for _, name, _, _ in pending}
+
+    rows = connection.execute(
+        """
+        SELECT notes.name, notes.date_modified, notes.deleted, notes.expires,
+            sync_notes.stamp
+        FROM notes LEFT JOIN sync_notes ON sync_notes.name = notes.name
+        WHERE sync_notes.device IS NULL OR sync_notes.device = ?
+        """,
+        (device,),
+    ).fetchall()
+
+    for name, date_modified, deleted, expires, stamp in rows:
+        if stamp is None:
+            stamp = changelog.datetime_stamp(date_modified)
+            changelog.set_stamp(connection, name, stamp, device)
+
+        # The note's latest change has to come after its content (so it wins),
+        # and end up at the note's stamp: either a pending change, or deleting
+        # it if it's deleted
+        follows = name in pending_names or deleted
+        connection.execute(
+            "INSERT INTO sync_outbox (op, name, stamp) VALUES (?, ?, ?)",
+            (changelog.UPSERT, name, stamp - 1 if follows else stamp),
+        )
+        if deleted and name not in pending_names:
+            connection.execute(
+                """
+                INSERT INTO sync_outbox (op, name, stamp, expires)
+                VALUES (?, ?, ?, ?)
+                """,
+                (changelog.DELETE, name, stamp, expires),
+            )
+
+    connection.executemany(
+        "INSERT INTO sync_outbox (op, name, stamp, expires) VALUES (?, ?, ?, ?)",
+        pending,
+    )
+
+
+def import_logs(connection: Connection, directory: str, result: SyncResult):
+    """
+    Apply the records in every other device's log that haven't been applied
+    yet, starting from where the last import of each log stopped
+    """
+
+    own = changelog.device_name()
+
+    try:
+        filenames = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return
+
+    for filename in filenames:
+        device, suffix = os.path.splitext(filename)
+        if suffix != LOG_SUFFIX or device == own:
+            continue
+
+        import_log(connection, os.path.join(directory, filename), device, result)
+
+
+def import_log(connection: Connection, path: str, device: str, result: SyncResult):
+    """
+    Apply a device's new records, SYNC_BATCH_SIZE per transaction
+
+    How far the log was read (its position and the last seq applied) is
+    committed along with each batch, so a sync that's interrupted carries on
+    from the last batch. If the log got shorter (it was replaced), it's read
+    from the start again, skipping the seqs that were already applied.
+    """
+
+    row = connection.execute(
+        "SELECT position, seq FROM sync_peers WHERE device = ?", (device,)
+    ).fetchone()
+    position, last_seq = row if row is not None else (0, 0)
+
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return
+
+    with file:
+        size = file.seek(0, os.SEEK_END)
+        if size < position:
+            position = 0
+        if size == position:
+            return
+
+        file.seek(position)
+
+        batch = 0
+        notes.begin_write(connection)
+
+        for line in file:
+            if not line.endswith(b"\n"):
+                # Still being written (or cut off), so read it next time
+                break
+
+            position += len(line)
+
+            try:
+                record = json.loads(line)
+                seq = record["seq"]
+            except (ValueError, KeyError, TypeError):
+                result.unreadable += 1
+                continue
+
+            if seq > last_seq:
+                last_seq = seq
+                try:
+                    applied = apply_record(connection, device, record)
+                except (ValueError, KeyError, TypeError):
+                    result.unreadable += 1
+                else:
+                    if applied:
+                        result.applied += 1
+                    else:
+                        result.skipped += 1
+
+            batch += 1
+            if batch >= SYNC_BATCH_SIZE:
+                save_position(connection, device, position, last_seq)
+                connection.commit()
+                notes.begin_write(connection)
+                batch = 0
+
+        save_position(connection, device, position, last_seq)
+        connection.commit()
+
+
+def save_position(connection: Connection, device: str, position: int, seq: int):
+    """
+    Remember how far a device's log has been applied
+    """
+
+    connection.execute(
+        """
+        INSERT INTO sync_peers (device, position, seq) VALUES (?, ?, ?)
+        ON CONFLICT(device) DO UPDATE SET
+            position = excluded.position,
+            seq = excluded.seq
+        """,
+        (device, position, seq),
+    )
+
+
+def apply_record(
+    connection: Connection, device: str, record: dict[str, Any]
+) -> bool:
+    """
+    Apply a record from another device's log, unless the note already has a
+    newer change
+
+    Changes from other devices aren't recorded in this device's log (every
+    device reads every other device's log itself).
+
+    :return: Whether the record was applied
+    """
+
+    name: str = record["name"]
+    stamp: int = record["stamp"]
+    op: str = record["op"]
+
+    current = connection.execute(
+        "SELECT stamp, device FROM sync_notes WHERE name = ?", (name,)
+    ).fetchone()
+    if current is not None and (stamp, device) <= tuple(current):
+        return False
+
+    if op == changelog.UPSERT:
+        notes.save_note(
+            connection,
+            name,
+            record["content"],
+            datetime.fromisoformat(record["modified"]),
+            replicate=False,
+        )
+    elif op == changelog.DELETE:
+        notes.set_deleted(
+            connection, name, datetime.fromisoformat(record["expires"]), False
+        )
+    elif op == changelog.RESTORE:
+        notes.set_deleted(connection, name, None, False)
+    else:
+        raise ValueError(f"Unknown change {op!r}")
+
+    changelog.set_stamp(connection, name, stamp, device)
+
+    return True
@@ -0,0 +1,117 @@
+"""
+Read-only, paged viewer for chunked notes
+"""
+
+from prompt_toolkit.data_structures import Point
+from prompt_toolkit.key_binding import KeyBindings, KeyPressEvent
+from prompt_toolkit.layout import UIContent, UIControl
+from prompt_toolkit.mouse_events import MouseEvent, MouseEventType
+
+from qwtd.chunks import ChunkedNote
+
+# Lines moved by one step of the mouse wheel
+SCROLL_LINES: int = 3
+
+
+class ChunkedNoteControl(UIControl):
+    """
+    Displays a chunked note, loading its chunks on demand as it is scrolled
+
+    Lines are fetched from a ChunkedNote as the window asks for them, so only
+    the chunks around the visible lines are ever read.
+    """
+
+    def __init__(self):
+        self.note: ChunkedNote | None = None
+        self.cursor_line: int = 0
+        # Height of the window the last time it was drawn, for paging
+        self.height: int = 1
+
+        self.key_bindings: KeyBindings = KeyBindings()
+        self._add_bindings(self.key_bindings)
+
+    def open(self, note: ChunkedNote | None):
+        """
+        Show a note (or nothing), starting at the top
+        """
+
+        self.note = note
+        self.cursor_line = 0
+
+    def move(self, lines: int):
+        """
+        Move the view by a number of lines (negative to go up)
+        """
+
+        if self.note is None:
+            return
+
+        self.cursor_line = max(
+            0, min(self.note.line_count - 1, self.cursor_line + lines)
+        )
+
+    def is_focusable(self) -> bool:
+        return True
+
+    def create_content(self, width: int, height: int) -> UIContent:
+        note = self.note
+        self.height = max(1, height)
+
+        if note is None:
+            return UIContent()
+
+        return UIContent(
+            get_line=lambda lineno: [("", note.line(lineno))],
+            line_count=note.line_count,
+            cursor_position=Point(0, self.cursor_line),
+            show_cursor=False,
+        )
+
+    def mouse_handler(self, mouse_event: MouseEvent):
+        if mouse_event.event_type == MouseEventType.SCROLL_DOWN:
+            self.move(SCROLL_LINES)
+        elif mouse_event.event_type == MouseEventType.SCROLL_UP:
+            self.move(-SCROLL_LINES)
+        else:
+            return NotImplemented
+
+        return None
+
+    def get_key_bindings(self) -> KeyBindings:
+        return self.key_bindings
+
+    def _add_bindings(self, kb: KeyBindings):
+        """
+        Register the scrolling keybindings (vi style, plus the usual keys)
+        """
+
+        @kb.add("j")
+        @kb.add("down")
+        def _(event: KeyPressEvent):
+            self.move(event.arg)
+
+        @kb.add("k")
+        @kb.add("up")
+        def _(event: KeyPressEvent):
+            self.move(-event.arg)
+
+        @kb.add("pagedown")
+        @kb.add(" ")
+        def _(event: KeyPressEvent):
+            self.move(self.height)
+
+        @kb.add("pageup")
+        @kb.add("b")
+        def _(event: KeyPressEvent):
+            self.move(-self.height)
+
+        @kb.add("g", "g")
+        @kb.add("home")
+        def _(event: KeyPressEvent):
+            self.move(-self.cursor_line)
+
+        @kb.add("G")
+        @kb.add("end")
+        def _(event: KeyPressEvent):
+            if self.note is not None:
+                self.move(self.note.line_count)
@@ -0,0 +1,289 @@
+"""
+Tests for replicating notes between two databases through a sync folder (see
+sync.py)
+"""
+
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from collections.abc import Iterator
+from datetime import datetime, timedelta
+from unittest import mock
+
+from qwtd import changelog
+from qwtd import config
+from qwtd import db_setup
+from qwtd import notes
+from qwtd import sync
+from qwtd.db_wrapper import connect
+
+
+class SyncTest(unittest.TestCase):
+    """
+    Two devices, "a" and "b", each with a database of its own, sharing a sync
+    folder
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        self.sync_dir: str = os.path.join(directory.name, "sync")
+        self.a: sqlite3.Connection = self.create_db(
+            os.path.join(directory.name, "a.db")
+        )
+        self.b: sqlite3.Connection = self.create_db(
+            os.path.join(directory.name, "b.db")
+        )
+
+    def create_db(self, path: str) -> sqlite3.Connection:
+        """
+        Create an empty database at the latest version
+        """
+
+        connection = connect(path)
+        self.addCleanup(connection.close)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            db_setup.ensure_db(connection, True)
+
+        return connection
+
+    @contextlib.contextmanager
+    def device(self, name: str, syncing: bool = True) -> Iterator[None]:
+        """
+        Act as device name (with sync_dir unset unless syncing)
+        """
+
+        settings = config.Config(
+            sync_dir=self.sync_dir if syncing else "", sync_device=name
+        )
+        with mock.patch.object(config, "get_config", return_value=settings):
+            yield
+
+    def save(
+        self,
+        connection: sqlite3.Connection,
+        name: str,
+        content: str,
+        now: datetime | None = None,
+    ):
+        notes.save_note(connection, name, content, now)
+        connection.commit()
+
+    def content(self, connection: sqlite3.Connection, name: str) -> str | None:
+        note = notes.read_note(connection, name)
+        return None if note is None else note[0]
+
+    def outbox(self, connection: sqlite3.Connection) -> list[tuple[str, str, int]]:
+        """
+        The (op, name, stamp) of every change waiting to be sent, in order
+        """
+
+        return connection.execute(
+            "SELECT op, name, stamp FROM sync_outbox ORDER BY seq"
+        ).fetchall()
+
+    def write_log(self, device: str, records: list[dict]) -> str:
+        """
+        Write a device's log with records (replacing it if it exists)
+        """
+
+        os.makedirs(self.sync_dir, exist_ok=True)
+        path = sync.log_path(self.sync_dir, device)
+
+        with open(path, "wb") as file:
+            for record in records:
+                file.write(json.dumps(record).encode() + b"\n")
+
+        return path
+
+    def test_later_stamp_wins_and_ties_go_to_the_higher_device(self):
+        with mock.patch.object(changelog, "now_stamp", return_value=1000):
+            with self.device("a"):
+                self.save(self.a, "note", "from a")
+                sync.sync(self.a)
+
+            # Same stamp: ("b", 1000) is above ("a", 1000) on both devices
+            with self.device("b"):
+                self.save(self.b, "note", "from b")
+                result = sync.sync(self.b)
+            self.assertEqual((result.applied, result.skipped), (0, 1))
+
+            with self.device("a"):
+                result = sync.sync(self.a)
+            self.assertEqual((result.applied, result.skipped), (1, 0))
+
+            self.assertEqual(self.content(self.a, "note"), "from b")
+            self.assertEqual(self.content(self.b, "note"), "from b")
+
+            # A change made on top of b's wins, even though the clock didn't
+            # move
+            with self.device("a"):
+                self.save(self.a, "note", "from a again")
+                sync.sync(self.a)
+            self.assertEqual(
+                self.a.execute(
+                    "SELECT stamp, device FROM sync_notes WHERE name = 'note'"
+                ).fetchone(),
+                (1001, "a"),
+            )
+
+            with self.device("b"):
+                result = sync.sync(self.b)
+            self.assertEqual(result.applied, 1)
+            self.assertEqual(self.content(self.b, "note"), "from a again")
+
+    def test_publish_all_keeps_each_notes_latest_change_last(self):
+        modified = datetime(2024, 1, 2, 3, 4, 5)
+
+        # Notes that existed before syncing was set up
+        with self.device("a", syncing=False):
+            for name in ("kept", "gone", "edited"):
+                self.save(self.a, name, name, modified)
+            notes.set_deleted(self.a, "gone", modified + timedelta(days=7))
+            self.a.commit()
+
+        with self.device("a"):
+            # A note received from another device, which is in that device's
+            # log already
+            notes.save_note(self.a, "theirs", "theirs", replicate=False)
+            changelog.set_stamp(self.a, "theirs", 1, "b")
+
+            # A change that was waiting to be sent when the log was created
+            self.save(self.a, "edited", "edited again")
+            pending = self.outbox(self.a)
+            self.assertEqual([name for _, name, _ in pending], ["edited"])
+            edited_stamp = pending[0][2]
+
+            sync.publish_all(self.a)
+            outbox = self.outbox(self.a)
+
+        stamp = changelog.datetime_stamp(modified)
+        changes = {name: [] for _, name, _ in outbox}
+        for op, name, change_stamp in outbox:
+            changes[name].append((op, change_stamp))
+
+        self.assertNotIn("theirs", changes)
+        self.assertEqual(changes["kept"], [(changelog.UPSERT, stamp)])
+        # The deleted note's content comes before (and loses to) deleting it
+        self.assertEqual(
+            changes["gone"],
+            [(changelog.UPSERT, stamp - 1), (changelog.DELETE, stamp)],
+        )
+        # The pending change is moved after everything that was published
+        self.assertEqual(
+            changes["edited"],
+            [(changelog.UPSERT, edited_stamp - 1), (changelog.UPSERT, edited_stamp)],
+        )
+        self.assertEqual(outbox[-1], ("upsert", "edited", edited_stamp))
+
+        with self.device("a"):
+            sync.flush_outbox(self.a, self.sync_dir)
+        with self.device("b"):
+            sync.sync(self.b)
+
+        self.assertEqual(self.content(self.b, "kept"), "kept")
+        self.assertEqual(self.content(self.b, "edited"), "edited again")
+        self.assertTrue(notes.read_note(self.b, "gone")[1])
+        self.assertIsNone(self.content(self.b, "theirs"))
+
+    def test_append_log_cuts_off_an_interrupted_line(self):
+        path = os.path.join(self.sync_dir, "a" + sync.LOG_SUFFIX)
+
+        # The folder is created if needed
+        sync.append_log(path, b'{"seq":1}\n')
+        with open(path, "ab") as file:
+            file.write(b'{"seq":2,"op":"ups')
+
+        sync.append_log(path, b'{"seq":2}\n')
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), b'{"seq":1}\n{"seq":2}\n')
+
+        # Nothing but part of a line
+        with open(path, "wb") as file:
+            file.write(b'{"seq":1,')
+
+        sync.append_log(path, b'{"seq":1}\n')
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), b'{"seq":1}\n')
+
+    def test_partial_line_is_read_once_complete(self):
+        path = self.write_log("a", [])
+        record = {
+            "seq": 1,
+            "op": "upsert",
+            "name": "note",
+            "stamp": 10,
+            "modified": "2024-01-02T03:04:05",
+            "content": "text",
+        }
+        line = json.dumps(record).encode() + b"\n"
+
+        with open(path, "wb") as file:
+            file.write(line[:10])
+
+        with self.device("b"):
+            result = sync.sync(self.b)
+            self.assertEqual(result.applied, 0)
+            self.assertIsNone(self.content(self.b, "note"))
+
+            with open(path, "ab") as file:
+                file.write(line[10:])
+
+            result = sync.sync(self.b)
+            self.assertEqual(result.applied, 1)
+            self.assertEqual(self.content(self.b, "note"), "text")
+
+    def test_replaced_log_is_read_from_the_start(self):
+        def upsert(seq: int, name: str, content: str) -> dict:
+            return {
+                "seq": seq,
+                "op": "upsert",
+                "name": name,
+                "stamp": seq * 10,
+                "modified": "2024-01-02T03:04:05",
+                "content": content,
+            }
+
+        path = self.write_log(
+            "a",
+            [
+                upsert(1, "one", "one"),
+                upsert(2, "two", "two"),
+                upsert(3, "big", "x" * 1000),
+            ],
+        )
+
+        with self.device("b"):
+            result = sync.sync(self.b)
+        self.assertEqual(result.applied, 3)
+
+        # E.g. restored from an older copy, then appended to: it's shorter than
+        # what was read, and repeats seqs that were applied already (which
+        # aren't applied again, even though this one would win)
+        replaced = upsert(1, "one", "changed")
+        replaced["stamp"] = 99
+        path = self.write_log("a", [replaced, upsert(4, "four", "four")])
+        size = os.path.getsize(path)
+
+        with self.device("b"):
+            result = sync.sync(self.b)
+
+        self.assertEqual((result.applied, result.skipped), (1, 0))
+        self.assertEqual(self.content(self.b, "one"), "one")
+        self.assertEqual(self.content(self.b, "four"), "four")
+        self.assertEqual(
+            self.b.execute(
+                "SELECT position, seq FROM sync_peers WHERE device = 'a'"
+            ).fetchone(),
+            (size, 4),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()